@@ -1,10 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, g,
+                   Response, make_response, stream_with_context, has_request_context)
+from markupsafe import Markup
+from prometheus_client import (Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST,
+                               REGISTRY, generate_latest, multiprocess)
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import FileWrapper
 import sqlite3
 import os
-from datetime import datetime
+import io
+import csv
+import math
+import gzip
+import mimetypes
+import shutil
+import re
+import json
+import base64
+import hashlib
+import secrets
+import click
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache, wraps
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime, timedelta
 import logging
 
+try:
+    import brotli
+except ImportError:  # optional: assets are then precompressed with gzip only
+    brotli = None
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+except ImportError:  # optional: only postgresql:// databases need it
+    psycopg2 = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -12,19 +52,678 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
-# Database configuration
-DATABASE = 'ecommerce.db'
+# Prometheus metrics. Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+# shared by the workers so /metrics aggregates all of them (see gunicorn.conf.py)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+REQUEST_COUNT = Counter('flask_http_request', 'HTTP requests by route and status',
+                        ['method', 'endpoint', 'status'])
+REQUEST_LATENCY = Histogram('flask_http_request_duration_seconds', 'Time to build the response',
+                            ['method', 'endpoint'],
+                            buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+REQUESTS_IN_PROGRESS = Gauge('flask_http_requests_in_progress', 'Requests being handled',
+                             multiprocess_mode='livesum')
+DB_QUERY_LATENCY = Histogram('ecommerce_db_query_duration_seconds',
+                             'Statement execution time (to the first row) by statement', ['statement'],
+                             buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .5))
+DB_POOL_CONNECTIONS = Gauge('ecommerce_db_pool_connections', 'Pooled SQLite connections by state',
+                            ['state'], multiprocess_mode='livesum')
+CACHE_REQUESTS = Counter('ecommerce_cache_requests', 'Cache lookups by cache and result', ['cache', 'result'])
+CHECKOUTS = Counter('ecommerce_checkouts', 'Checkout attempts by mode and outcome', ['mode', 'outcome'])
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|EXISTS)\s+(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    """Low-cardinality name for a statement: its verb and first table, e.g. 'SELECT products'"""
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ''
+    match = _STATEMENT_TABLE.search(sql)
+    return f'{verb} {match.group(1)}' if match else verb
+
+# Labelled children are looked up once per distinct key: labels() costs more than observe()
+_metric_children = {}
+
+def metric_child(metric, *labels):
+    key = (metric, labels)
+    child = _metric_children.get(key)
+    if child is None:
+        child = _metric_children[key] = metric.labels(*labels)
+    return child
+
+def _query_histogram(sql):
+    child = _metric_children.get(sql)
+    if child is None:
+        child = _metric_children[sql] = DB_QUERY_LATENCY.labels(statement_label(sql))
+    return child
+
+class InstrumentedConnection(sqlite3.Connection):
+    """sqlite3 connection that times every statement into DB_QUERY_LATENCY, and profiles it when SQL_PROFILE is on"""
+
+    def execute(self, sql, parameters=()):
+        if SQL_PROFILE:
+            return profile_statement(self, sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _query_histogram(sql).observe(time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        if SQL_PROFILE:
+            return profile_statement(self, sql, list(parameters), many=True)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            _query_histogram(sql).observe(time.perf_counter() - start)
+
+# SQL profiling (opt-in, costs a timer per fetched row): every statement of a request is
+# recorded with its parameter types, row count and time including fetches; slow ones are logged
+SQL_PROFILE = os.environ.get('SQL_PROFILE', 'false').lower() == 'true'
+SQL_SLOW_QUERY_MS = float(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+SQL_EXPLAIN_SLOW = os.environ.get('SQL_EXPLAIN_SLOW', 'false').lower() == 'true'
+SQL_PROFILE_MAX_STATEMENTS = int(os.environ.get('SQL_PROFILE_MAX_STATEMENTS', 500))
+# Bearer token for /debug/sql; unset disables it even with SQL_PROFILE on
+DEBUG_API_TOKEN = os.environ.get('DEBUG_API_TOKEN')
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Statement text with whitespace collapsed, used as the profile key"""
+    return ' '.join(sql.split())
+
+def _parameter_types(parameters):
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{name}: {type(value).__name__}' for name, value in parameters.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+
+def parameter_shape(parameters, many=False):
+    """Types of the bound parameters without their values, e.g. '(int, str)' or '3 x (int, int)'"""
+    if many:
+        return f'{len(parameters)} x {_parameter_types(parameters[0])}' if parameters else '0 x ()'
+    return _parameter_types(parameters)
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that adds the rows it fetches, and the time spent fetching them, to its statement's record"""
+
+    record = None
+
+    def _fetched(self, rows, start):
+        if self.record is not None:
+            self.record['rows'] += rows
+            self.record['duration'] += time.perf_counter() - start
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(0, start)
+            raise
+        self._fetched(1, start)
+        return row
+
+def profile_statement(conn, sql, parameters, many=False):
+    """Execute on a ProfilingCursor and file the record with the current request (or finish it at once)"""
+    cursor = conn.cursor(ProfilingCursor)
+    start = time.perf_counter()
+    try:
+        if many:
+            cursor.executemany(sql, parameters)
+        else:
+            cursor.execute(sql, parameters)
+    finally:
+        elapsed = time.perf_counter() - start
+        _query_histogram(sql).observe(elapsed)
+    cursor.record = record_statement(sql, parameters, many, max(cursor.rowcount, 0), elapsed)
+    return cursor
 
-def get_db_connection():
-    """Get database connection"""
+def record_statement(sql, parameters, many, rows, elapsed):
+    """File a profile record with the current request, or finish it at once outside one"""
+    record = {
+        'sql': normalize_sql(sql),
+        'parameters': parameter_shape(parameters, many),
+        'rows': rows,
+        'duration': elapsed,
+    }
+    if SQL_EXPLAIN_SLOW:
+        record['values'] = parameters[0] if many and parameters else parameters
+    if has_request_context():
+        request.environ.setdefault('sql.profile', []).append(record)
+    else:
+        # Order workers and CLI commands: rows fetched later are not counted
+        finish_statement(record)
+    return record
+
+def explain_query_plan(sql, parameters=()):
+    """Query plan lines for a statement, from a separate connection that is not profiled"""
+    if is_postgres(DATABASE):
+        conn = psycopg2.connect(DATABASE)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'EXPLAIN {postgres_sql(sql)}', tuple(parameters))
+                return [row[0].strip() for row in cursor]
+        except psycopg2.Error as e:
+            return [f'unavailable: {e}']
+        finally:
+            conn.close()
     conn = sqlite3.connect(DATABASE)
+    try:
+        return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+    except sqlite3.Error as e:
+        return [f'unavailable: {e}']
+    finally:
+        conn.close()
+
+def finish_statement(record):
+    """Add a completed statement to the totals and log it if it was slow"""
+    sql_profiler.add(record)
+    duration_ms = record['duration'] * 1000
+    if duration_ms < SQL_SLOW_QUERY_MS:
+        return
+    message = f"Slow query ({duration_ms:.1f}ms, {record['rows']} rows, params {record['parameters']}): {record['sql']}"
+    if SQL_EXPLAIN_SLOW:
+        message += '\n  plan: ' + '; '.join(explain_query_plan(record['sql'], record['values']))
+    logger.warning(message)
+
+class SQLProfiler:
+    """Per-worker running totals for each distinct statement, to rank them by time spent"""
+
+    def __init__(self, max_statements=None):
+        self.max_statements = max_statements or SQL_PROFILE_MAX_STATEMENTS
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, record):
+        with self._lock:
+            stats = self._stats.get(record['sql'])
+            if stats is None:
+                if len(self._stats) >= self.max_statements:
+                    # Make room by forgetting the statement with the least total time
+                    del self._stats[min(self._stats, key=lambda sql: self._stats[sql]['total'])]
+                stats = self._stats[record['sql']] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'rows': 0}
+            stats['calls'] += 1
+            stats['total'] += record['duration']
+            stats['max'] = max(stats['max'], record['duration'])
+            stats['rows'] += record['rows']
+            stats['parameters'] = record['parameters']
+
+    def top(self, limit=10):
+        """The statements with the most total time, slowest first"""
+        with self._lock:
+            ranked = sorted(self._stats.items(), key=lambda item: item[1]['total'], reverse=True)[:limit]
+            return [{
+                'sql': sql,
+                'calls': stats['calls'],
+                'total_ms': round(stats['total'] * 1000, 3),
+                'mean_ms': round(stats['total'] * 1000 / stats['calls'], 3),
+                'max_ms': round(stats['max'] * 1000, 3),
+                'rows': stats['rows'],
+                'parameters': stats['parameters'],
+            } for sql, stats in ranked]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+sql_profiler = SQLProfiler()
+
+@app.teardown_request
+def finish_sql_profile(exception=None):
+    """Fold the request's statements into the totals once their rows have been fetched"""
+    records = request.environ.pop('sql.profile', None)
+    if not records:
+        return
+    for record in records:
+        finish_statement(record)
+    logger.debug(f"{request.method} {request.path}: {len(records)} statements, "
+                 f"{sum(record['duration'] for record in records) * 1000:.1f}ms in SQL")
+
+class RequestMetricsMiddleware:
+    """Count and time every request that reaches Flask, labelled by route endpoint
+
+    Runs as WSGI middleware rather than Flask request hooks, which cost more
+    per request than the metric updates themselves.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not METRICS_ENABLED:
+            return self.wsgi_app(environ, start_response)
+        statuses = []
+
+        def record_status(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        start = time.perf_counter()
+        REQUESTS_IN_PROGRESS.inc()
+        try:
+            return self.wsgi_app(environ, record_status)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+            endpoint = environ.get('metrics.endpoint') or 'unmatched'
+            method = environ['REQUEST_METHOD']
+            metric_child(REQUEST_LATENCY, method, endpoint).observe(time.perf_counter() - start)
+            metric_child(REQUEST_COUNT, method, endpoint, statuses[-1][:3] if statuses else '500').inc()
+
+app.wsgi_app = RequestMetricsMiddleware(app.wsgi_app)
+
+
+@app.url_value_preprocessor
+def record_endpoint(endpoint, values):
+    """Hand the matched endpoint to RequestMetricsMiddleware"""
+    request.environ['metrics.endpoint'] = endpoint
+
+# Database configuration. DATABASE is a SQLite file path or a postgresql:// URL; DATABASE_URL
+# takes precedence and also accepts sqlite:///path
+def database_from_url(url):
+    """SQLite path for a sqlite:/// URL; paths and postgresql:// URLs are used as they are"""
+    return url[len('sqlite:///'):] if url.startswith('sqlite:///') else url
+
+DATABASE = database_from_url(os.environ.get('DATABASE_URL') or os.environ.get('DATABASE', 'ecommerce.db'))
+# Read replicas (same forms, comma-separated) for catalog reads; writes and per-user reads use DATABASE
+DATABASE_REPLICAS = [database_from_url(url.strip())
+                     for url in os.environ.get('DATABASE_REPLICAS', '').split(',') if url.strip()]
+# Seconds after a catalog change during which cache reloads read the primary, so a lagging
+# replica cannot cache pre-change rows (or a 404 for a new product) for a whole TTL
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+
+DB_ERRORS = (sqlite3.Error, psycopg2.Error) if psycopg2 else (sqlite3.Error,)
+
+def is_postgres(database):
+    return database.startswith(('postgresql://', 'postgres://'))
+
+def sql_dialect(conn):
+    """'sqlite' or 'postgresql', for the few statements that differ between the backends"""
+    return getattr(conn, 'dialect', 'sqlite')
+
+# Connection pool configuration (DB_POOL_SIZE=0 disables pooling)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))
+
+# Storage tuning profiles, applied to every new connection
+DB_TUNING_PROFILES = {
+    # SQLite defaults: rollback journal, writers block readers
+    'legacy': {},
+    # WAL lets readers proceed while a checkout is writing
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,  # KiB
+        'mmap_size': 64 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # ms
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'busy_timeout': 10000,
+    },
+}
+DB_TUNING_PROFILE = os.environ.get('DB_TUNING_PROFILE', 'balanced')
+
+# Bounded retry for writes that still hit "database is locked" across workers
+DB_WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', 5))
+DB_WRITE_RETRY_DELAY = float(os.environ.get('DB_WRITE_RETRY_DELAY', 0.05))
+
+def apply_tuning_profile(conn, profile=None):
+    """Apply the pragmas of a named tuning profile to a connection"""
+    name = profile or DB_TUNING_PROFILE
+    try:
+        pragmas = DB_TUNING_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown DB_TUNING_PROFILE '{name}'")
+    for pragma, value in pragmas.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+_PLACEHOLDER = re.compile(r"'[^']*'|\?")
+
+@lru_cache(maxsize=1024)
+def postgres_sql(sql):
+    """Rewrite this module's SQLite dialect for PostgreSQL: ? placeholders and column types in CREATE TABLE"""
+    sql = _PLACEHOLDER.sub(lambda m: '%s' if m.group() == '?' else m.group().replace('%', '%%'), sql)
+    if re.match(r'\s*CREATE TABLE', sql, re.IGNORECASE):
+        sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY').replace('WITHOUT ROWID', '')
+        sql = re.sub(r'\bREAL\b', 'DOUBLE PRECISION', sql)
+    return sql
+
+if psycopg2:
+    # Timestamps come back as text, as SQLite's CURRENT_TIMESTAMP columns do
+    TIMESTAMP_AS_TEXT = psycopg2.extensions.new_type(
+        (1114,), 'TIMESTAMP_AS_TEXT', lambda value, cursor: value[:19] if value is not None else None)
+
+class PostgresConnection:
+    """psycopg2 connection exposing the part of the sqlite3 API this module uses
+
+    Runs in autocommit mode like a sqlite3 connection outside a transaction;
+    db_write() opens transactions explicitly. Rows support row['column'] and row[0].
+    """
+
+    dialect = 'postgresql'
+
+    def __init__(self, database):
+        if psycopg2 is None:
+            raise RuntimeError('PostgreSQL databases need psycopg2 (pip install psycopg2-binary)')
+        self._conn = psycopg2.connect(database, cursor_factory=psycopg2.extras.DictCursor,
+                                      options='-c timezone=UTC')
+        self._conn.autocommit = True
+        psycopg2.extensions.register_type(TIMESTAMP_AS_TEXT, self._conn)
+
+    @property
+    def in_transaction(self):
+        return self._conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def execute(self, sql, parameters=()):
+        cursor = self._conn.cursor()
+        start = time.perf_counter()
+        try:
+            cursor.execute(postgres_sql(sql), tuple(parameters))
+        finally:
+            elapsed = time.perf_counter() - start
+            if METRICS_ENABLED:
+                _query_histogram(sql).observe(elapsed)
+        if SQL_PROFILE:
+            record_statement(sql, parameters, False, max(cursor.rowcount, 0), elapsed)
+        return cursor
+
+    def executemany(self, sql, parameters):
+        parameters = [tuple(row) for row in parameters]
+        cursor = self._conn.cursor()
+        start = time.perf_counter()
+        try:
+            # One round trip per page of rows instead of per row
+            psycopg2.extras.execute_batch(cursor, postgres_sql(sql), parameters, page_size=1000)
+        finally:
+            elapsed = time.perf_counter() - start
+            if METRICS_ENABLED:
+                _query_histogram(sql).observe(elapsed)
+        if SQL_PROFILE:
+            record_statement(sql, parameters, True, len(parameters), elapsed)
+        return cursor
+
+    def commit(self):
+        if self.in_transaction:
+            self._conn.cursor().execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self._conn.cursor().execute('ROLLBACK')
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+def _connect(database):
+    """Open a new connection to a SQLite file or a PostgreSQL server"""
+    if is_postgres(database):
+        return PostgresConnection(database)
+    factory = InstrumentedConnection if METRICS_ENABLED or SQL_PROFILE else sqlite3.Connection
+    conn = sqlite3.connect(database, check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row
+    return apply_tuning_profile(conn)
+
+class PooledConnection:
+    """Connection handle that returns itself to the pool on close()"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    @property
+    def closed(self):
+        return self._conn is None
+
+    def close(self):
+        """Release the underlying connection back to the pool"""
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+class ConnectionPool:
+    """Per-process pool of connections for one database (SQLite file or PostgreSQL URL)"""
+
+    def __init__(self, database, size=None, health_check_interval=None):
+        self.database = database
+        self.size = DB_POOL_SIZE if size is None else size
+        self.health_check_interval = (DB_POOL_HEALTH_CHECK_INTERVAL if health_check_interval is None
+                                      else health_check_interval)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, released_at) pairs, most recent last
+        self._pid = os.getpid()
+        self._in_use = 0
+        self._created = 0
+        self._reused = 0
+        self._discarded = 0
+
+    def _reset_after_fork(self):
+        """Drop connections inherited from a parent process"""
+        # Database handles must not cross fork(); forget them without closing
+        self._idle = []
+        self._in_use = 0
+        self._pid = os.getpid()
+
+    def _is_healthy(self, conn, released_at):
+        """Ping a connection that has been idle longer than the check interval"""
+        if time.monotonic() - released_at < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except DB_ERRORS:
+            return False
+
+    def acquire(self):
+        """Get a pooled connection handle, opening a new connection if none are idle"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset_after_fork()
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if self._is_healthy(conn, released_at):
+                    self._in_use += 1
+                    self._reused += 1
+                    self._record_metrics()
+                    return PooledConnection(self, conn)
+                self._discarded += 1
+                conn.close()
+            self._in_use += 1
+            self._created += 1
+            self._record_metrics()
+        return PooledConnection(self, _connect(self.database))
+
+    def release(self, conn):
+        """Return a connection to the pool, closing it if the pool is full"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except DB_ERRORS:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._in_use = max(self._in_use - 1, 0)
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                self._record_metrics()
+                return
+            self._discarded += 1
+            self._record_metrics()
+        conn.close()
+
+    def _record_metrics(self):
+        # Called with the lock held
+        if METRICS_ENABLED:
+            metric_child(DB_POOL_CONNECTIONS, 'in_use').set(self._in_use)
+            metric_child(DB_POOL_CONNECTIONS, 'idle').set(len(self._idle))
+
+    def _discard(self, conn):
+        with self._lock:
+            self._in_use = max(self._in_use - 1, 0)
+            self._discarded += 1
+            self._record_metrics()
+        try:
+            conn.close()
+        except DB_ERRORS:
+            pass
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """Pool metrics"""
+        with self._lock:
+            return {
+                'database': self.database,
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'created': self._created,
+                'reused': self._reused,
+                'discarded': self._discarded,
+            }
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(database=None):
+    """Get the connection pool for a database"""
+    database = database or DATABASE
+    pool = _pools.get(database)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(database, ConnectionPool(database))
+    return pool
+
+def close_db_pools():
+    """Close every pool, e.g. when switching databases in tests"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+def pool_stats():
+    """Metrics for all active pools"""
+    return [pool.stats() for pool in list(_pools.values())]
+
+_replica_turn = {'next': 0}
+
+def read_database():
+    """Database for catalog reads: the replicas in turn, else the primary"""
+    if not DATABASE_REPLICAS:
+        return DATABASE
+    # Unlocked round robin: a lost increment only skews the rotation
+    turn = _replica_turn['next']
+    _replica_turn['next'] = turn + 1
+    return DATABASE_REPLICAS[turn % len(DATABASE_REPLICAS)]
+
+def get_db_connection(readonly=False):
+    """Get database connection; readonly=True may be served by a replica
+
+    Only reads that tolerate replication lag (the catalog) should ask for a
+    replica. A user's own orders, cart and account stay on the primary, so
+    they always see the user's latest writes.
+    """
+    database = read_database() if readonly else DATABASE
+    if DB_POOL_SIZE <= 0:
+        return _connect(database)
+    conn = get_pool(database).acquire()
+    if g:
+        # Track handles so teardown can reclaim any that a route forgot to close
+        g.setdefault('_db_handles', []).append(conn)
     return conn
 
-def init_db():
-    """Initialize database with tables"""
-    conn = get_db_connection()
-    
+_write_locks = {}
+
+def _is_retryable_error(error):
+    """SQLite lock contention, or a PostgreSQL serialization failure or deadlock"""
+    if getattr(error, 'pgcode', None) in ('40001', '40P01'):
+        return True
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def db_write(work):
+    """Run work(conn) as one serialized write transaction and return its result
+
+    Writers in this process queue on a per-database lock so only one holds the
+    SQLite write lock at a time; contention with other workers is retried with
+    exponential backoff up to DB_WRITE_RETRIES times. PostgreSQL writers run
+    side by side under row locks, and deadlocks or serialization failures are
+    retried the same way.
+    """
+    if is_postgres(DATABASE):
+        lock = nullcontext()
+    else:
+        with _pools_lock:
+            lock = _write_locks.setdefault(DATABASE, threading.Lock())
+    delay = DB_WRITE_RETRY_DELAY
+    for attempt in range(DB_WRITE_RETRIES + 1):
+        conn = get_db_connection()
+        try:
+            with lock:
+                conn.execute('BEGIN IMMEDIATE' if sql_dialect(conn) == 'sqlite' else 'BEGIN')
+                try:
+                    result = work(conn)
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+            return result
+        except DB_ERRORS as e:
+            if not _is_retryable_error(e) or attempt == DB_WRITE_RETRIES:
+                raise
+            logger.warning(f"Database busy, retrying write ({attempt + 1}/{DB_WRITE_RETRIES})")
+        finally:
+            conn.close()
+        time.sleep(delay)
+        delay *= 2
+
+def _migration_initial_schema(conn):
+    """Core tables and the sample catalog"""
     # Users table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -62,92 +761,1801 @@ def init_db():
         )
     ''')
     
-    # Order items table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS order_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER,
-            product_id INTEGER,
-            quantity INTEGER NOT NULL,
-            price REAL NOT NULL,
-            FOREIGN KEY (order_id) REFERENCES orders (id),
-            FOREIGN KEY (product_id) REFERENCES products (id)
-        )
-    ''')
+    # Order items table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders (id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    ''')
+    
+    # Insert sample products (only into an empty catalog, so re-running never duplicates them)
+    if conn.execute('SELECT 1 FROM products LIMIT 1').fetchone():
+        return
+    sample_products = [
+        ('Laptop', 'High-performance laptop for professionals', 999.99, 10, 'Electronics', '/static/images/laptop.jpg'),
+        ('Smartphone', 'Latest smartphone with advanced features', 699.99, 15, 'Electronics', '/static/images/phone.jpg'),
+        ('Headphones', 'Wireless noise-canceling headphones', 199.99, 20, 'Electronics', '/static/images/headphones.jpg'),
+        ('Coffee Mug', 'Premium ceramic coffee mug', 19.99, 50, 'Home', '/static/images/mug.jpg'),
+        ('T-Shirt', 'Comfortable cotton t-shirt', 29.99, 30, 'Clothing', '/static/images/tshirt.jpg')
+    ]
+    conn.executemany('''
+        INSERT INTO products (name, description, price, stock, category, image_url)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', sample_products)
+
+def _migration_query_indexes(conn):
+    """Indexes for the order history, category filter and order item joins"""
+    # /orders: WHERE user_id = ? ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)')
+    # /products?category=... and SELECT DISTINCT category
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products (category)')
+    # order_items joined on order_id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id, product_id)')
+
+# PostgreSQL search document: name matches rank above description matches
+PG_SEARCH_VECTOR = ("setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+                    "setweight(to_tsvector('simple', coalesce(description, '')), 'B')")
+
+def _migration_product_search(conn):
+    """FTS5 index over the catalog, kept in sync with products by triggers"""
+    if sql_dialect(conn) == 'postgresql':
+        # An expression index stays in sync with products without triggers
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_products_search ON products USING GIN (({PG_SEARCH_VECTOR}))')
+        return
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description,
+            content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    ''')
+    conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+def _migration_server_side_carts(conn):
+    """Cart lines keyed by the cart id stored in the session cookie"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS carts (
+            cart_id TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (cart_id, product_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_carts_updated ON carts (updated_at)')
+
+def _migration_order_idempotency(conn):
+    """Idempotency keys so a retried checkout POST returns the original order"""
+    conn.execute('ALTER TABLE orders ADD COLUMN idempotency_key TEXT')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency
+        ON orders (user_id, idempotency_key) WHERE idempotency_key IS NOT NULL
+    ''')
+
+def _migration_order_queue(conn):
+    """Durable queue of orders waiting for the background order workers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            enqueued_at REAL NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders (id)
+        )
+    ''')
+
+def _migration_product_skus(conn):
+    """Unique SKUs, the key bulk imports upsert on; existing products get one derived from their id"""
+    conn.execute('ALTER TABLE products ADD COLUMN sku TEXT')
+    if sql_dialect(conn) == 'postgresql':
+        conn.execute("UPDATE products SET sku = 'SKU-' || lpad(id::text, 6, '0')")
+    else:
+        conn.execute("UPDATE products SET sku = printf('SKU-%06d', id)")
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products (sku)')
+
+def _migration_order_history_keyset(conn):
+    """Index covering the order history's (created_at, id) keyset order"""
+    if sql_dialect(conn) == 'sqlite':
+        return  # idx_orders_user_created already ends in the rowid, which is orders.id
+    # Whole seconds like SQLite's CURRENT_TIMESTAMP, so cursors compare exactly with what was shown
+    conn.execute('ALTER TABLE orders ALTER COLUMN created_at TYPE TIMESTAMP(0)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created_id ON orders (user_id, created_at, id)')
+    conn.execute('DROP INDEX IF EXISTS idx_orders_user_created')
+
+def _migration_sales_rollups(conn):
+    """Sales rollup tables behind the analytics API, and the queue the batch compactor drains"""
+    for table, column, column_type in SALES_ROLLUPS:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {column} {column_type} PRIMARY KEY,
+                orders INTEGER NOT NULL,
+                units INTEGER NOT NULL,
+                revenue REAL NOT NULL
+            )
+        ''')
+    # Top products and customers by revenue
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sales_by_product_revenue ON sales_by_product (revenue)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sales_by_user_revenue ON sales_by_user (revenue)')
+    conn.execute('CREATE TABLE IF NOT EXISTS sales_pending (order_id INTEGER PRIMARY KEY)')
+
+def _migration_stock_holds(conn):
+    """Stock set aside for carts at checkout, returned to products.stock when a hold expires"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_holds (
+            cart_id TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (cart_id, product_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_holds_expires ON stock_holds (expires_at)')
+
+# Ordered schema migrations; the applied version is stored in PRAGMA user_version
+# (a schema_version table on PostgreSQL).
+# Append new migrations to the end and never edit one that has shipped.
+MIGRATIONS = [
+    (1, 'initial schema', _migration_initial_schema),
+    (2, 'query indexes', _migration_query_indexes),
+    (3, 'product search index', _migration_product_search),
+    (4, 'server-side carts', _migration_server_side_carts),
+    (5, 'order idempotency keys', _migration_order_idempotency),
+    (6, 'order queue', _migration_order_queue),
+    (7, 'product skus', _migration_product_skus),
+    (8, 'order history keyset index', _migration_order_history_keyset),
+    (9, 'sales rollups', _migration_sales_rollups),
+    (10, 'stock holds', _migration_stock_holds),
+]
+
+def get_schema_version(conn):
+    """Schema version recorded in the database"""
+    if sql_dialect(conn) == 'postgresql':
+        if conn.execute("SELECT to_regclass('schema_version')").fetchone()[0] is None:
+            return 0
+        return conn.execute('SELECT version FROM schema_version').fetchone()[0]
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def set_schema_version(conn, version):
+    if sql_dialect(conn) == 'postgresql':
+        conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        conn.execute('DELETE FROM schema_version')
+        conn.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+    else:
+        conn.execute(f'PRAGMA user_version = {int(version)}')
+
+# Advisory lock key held while a PostgreSQL migration runs
+MIGRATION_LOCK_ID = 7201
+
+def migrate(target=None):
+    """Apply pending migrations up to `target` (default: latest), each in its own transaction"""
+    target = MIGRATIONS[-1][0] if target is None else target
+    conn = get_db_connection()
+    current = get_schema_version(conn)
+    conn.close()
+    
+    for version, name, apply in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        
+        def run(conn, version=version, apply=apply):
+            if sql_dialect(conn) == 'postgresql':
+                # Serializes migrating workers like SQLite's write lock does
+                conn.execute('SELECT pg_advisory_xact_lock(?)', (MIGRATION_LOCK_ID,))
+            # Another worker may have applied it while we waited for the write lock
+            if get_schema_version(conn) >= version:
+                return False
+            apply(conn)
+            set_schema_version(conn, version)
+            return True
+        
+        if db_write(run):
+            logger.info(f"Applied migration {version}: {name}")
+        current = version
+    return current
+
+def init_db():
+    """Initialize database with tables"""
+    migrate()
+    invalidate_catalog()
+    logger.info("Database initialized successfully")
+
+# Product search
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 24))
+# Name matches count for more than description matches
+SEARCH_WEIGHTS = (10.0, 1.0)
+
+def build_search_query(text, dialect='sqlite'):
+    """Turn free text into an FTS5 MATCH expression (a tsquery on PostgreSQL) with prefix matching on every term
+
+    Terms are quoted so user input can never inject FTS5 operators. Returns None
+    when the text contains nothing searchable.
+    """
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    if dialect == 'postgresql':
+        return ' & '.join(f"'{term.lower()}':*" for term in terms)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def search_products(conn, text, category=None, page=1, per_page=None):
+    """Ranked (bm25) full-text product search
+
+    Returns (rows, has_next) for the requested 1-based page.
+    """
+    per_page = per_page or SEARCH_PAGE_SIZE
+    match = build_search_query(text, sql_dialect(conn))
+    if match is None:
+        return [], False
+    if sql_dialect(conn) == 'postgresql':
+        return _search_products_postgres(conn, match, category, page, per_page)
+    
+    query = '''
+        SELECT p.* FROM products_fts
+        JOIN products p ON p.id = products_fts.rowid
+        WHERE products_fts MATCH ?
+    '''
+    params = [match]
+    if category:
+        query += ' AND p.category = ?'
+        params.append(category)
+    query += ' ORDER BY bm25(products_fts, ?, ?) LIMIT ? OFFSET ?'
+    params.extend([*SEARCH_WEIGHTS, per_page + 1, (max(page, 1) - 1) * per_page])
+    
+    rows = conn.execute(query, params).fetchall()
+    return rows[:per_page], len(rows) > per_page
+
+def _search_products_postgres(conn, match, category, page, per_page):
+    """search_products() over the GIN-indexed tsvector of migration 3"""
+    query = f'''
+        SELECT * FROM products
+        WHERE {PG_SEARCH_VECTOR} @@ to_tsquery('simple', ?)
+    '''
+    params = [match]
+    if category:
+        query += ' AND category = ?'
+        params.append(category)
+    # ts_rank weights are {D, C, B, A} in [0, 1]: B is the description, A the name
+    query += f'''
+        ORDER BY ts_rank(ARRAY[0, 0, ?, ?]::real[], {PG_SEARCH_VECTOR}, to_tsquery('simple', ?)) DESC, id
+        LIMIT ? OFFSET ?
+    '''
+    top = max(SEARCH_WEIGHTS)
+    params.extend([SEARCH_WEIGHTS[1] / top, SEARCH_WEIGHTS[0] / top, match,
+                   per_page + 1, (max(page, 1) - 1) * per_page])
+    rows = conn.execute(query, params).fetchall()
+    return rows[:per_page], len(rows) > per_page
+
+def rebuild_search_index():
+    """Rebuild the product search index from the products table and merge its segments"""
+    def rebuild(conn):
+        if sql_dialect(conn) == 'postgresql':
+            conn.execute('REINDEX INDEX idx_products_search')
+            return conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('optimize')")
+        return conn.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+    return db_write(rebuild)
+
+# Catalog cache configuration (CATALOG_CACHE_BACKEND=none disables caching)
+CATALOG_CACHE_BACKEND = os.environ.get('CATALOG_CACHE_BACKEND', 'local')
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', 60))
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get('CATALOG_CACHE_MAX_ENTRIES', 1024))
+CATALOG_CACHE_PATH = os.environ.get('CATALOG_CACHE_PATH', 'catalog_cache.db')
+
+class LocalCacheBackend:
+    """In-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or CATALOG_CACHE_MAX_ENTRIES
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._counters = {}
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteCacheBackend:
+    """Cache shared by all workers on a host through a separate SQLite file
+
+    Local stand-in for a networked cache such as Redis: same get/set/incr
+    surface, values stored as JSON.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CATALOG_CACHE_PATH
+        self.evictions = 0
+        self._writes = 0
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.commit()
+        conn.close()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1)
+        conn.execute('PRAGMA synchronous = OFF')
+        return conn
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._conn.execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at >= ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        with self._conn as conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), time.time() + ttl))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                # Expired rows are otherwise only overwritten, never removed
+                self.evictions += conn.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),)).rowcount
+
+    def delete(self, key):
+        with self._conn as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def incr(self, key):
+        with self._conn as conn:
+            conn.execute('INSERT INTO counters (key, value) VALUES (?, 1) '
+                         'ON CONFLICT (key) DO UPDATE SET value = value + 1', (key,))
+            return conn.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()[0]
+
+    def counter(self, key):
+        row = self._conn.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def clear(self):
+        with self._conn as conn:
+            conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+CACHE_BACKENDS = {
+    'local': LocalCacheBackend,
+    'sqlite': SQLiteCacheBackend,
+}
+
+class CatalogCache:
+    """Read-through cache for catalog queries with generation-based invalidation
+
+    Every key is namespaced by a catalog generation counter held in the
+    backend; invalidate() bumps the counter so all cached catalog reads go
+    stale at once, in every worker sharing the backend.
+    """
+
+    GENERATION_KEY = 'catalog:generation'
+    CHANGED_KEY = 'catalog:changed'
+
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend
+        self.ttl = CATALOG_CACHE_TTL if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def _key(self, key):
+        return f'catalog:{self.backend.counter(self.GENERATION_KEY)}:{key}'
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for key, calling loader() to fill it on a miss"""
+        if not self.enabled:
+            return loader()
+        full_key = self._key(key)
+        value = self.backend.get(full_key)
+        if value is not None:
+            self.hits += 1
+            if METRICS_ENABLED:
+                metric_child(CACHE_REQUESTS, 'catalog', 'hit').inc()
+            return value
+        self.misses += 1
+        if METRICS_ENABLED:
+            metric_child(CACHE_REQUESTS, 'catalog', 'miss').inc()
+        value = loader()
+        if value is not None:
+            self.backend.set(full_key, value, self.ttl if ttl is None else ttl)
+        return value
+
+    def invalidate_keys(self, keys):
+        """Drop single cached reads, leaving the rest of the catalog cached"""
+        if self.enabled and keys:
+            for key in keys:
+                self.backend.delete(self._key(key))
+                self.backend.set(f'{self.CHANGED_KEY}:{key}', 1, REPLICA_MAX_LAG)
+            self.invalidations += 1
+
+    def invalidate(self):
+        """Drop every cached catalog read (call whenever products change)"""
+        if self.enabled:
+            self.backend.incr(self.GENERATION_KEY)
+            self.backend.set(self.CHANGED_KEY, 1, REPLICA_MAX_LAG)
+            self.invalidations += 1
+
+    def recently_changed(self, key):
+        """True within REPLICA_MAX_LAG seconds of an invalidation covering key"""
+        return self.enabled and (self.backend.get(self.CHANGED_KEY) is not None
+                                 or self.backend.get(f'{self.CHANGED_KEY}:{key}') is not None)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+    def stats(self):
+        """Hit-rate metrics"""
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.enabled else None,
+            'entries': len(self.backend) if self.enabled else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': getattr(self.backend, 'evictions', 0),
+        }
+
+def create_catalog_cache(backend_name=None):
+    """Build the catalog cache for the configured backend"""
+    name = backend_name or CATALOG_CACHE_BACKEND
+    if name == 'none':
+        return CatalogCache(None)
+    try:
+        return CatalogCache(CACHE_BACKENDS[name]())
+    except KeyError:
+        raise ValueError(f"Unknown CATALOG_CACHE_BACKEND '{name}'")
+
+catalog_cache = create_catalog_cache()
+
+def invalidate_catalog():
+    """Invalidation hook for product rows: edits, imports, new products"""
+    catalog_cache.invalidate()
+
+def invalidate_stock(product_ids):
+    """Invalidation hook for stock-only changes (orders, holds)
+
+    Drops just these products' rows and detail pages, so checkouts do not
+    empty the whole catalog cache. Listings keep the stock they were cached
+    with for up to CATALOG_CACHE_TTL; product and cart pages read current
+    stock from /api/stock, and checkout itself never trusts cached stock.
+    """
+    catalog_cache.invalidate_keys([key for product_id in sorted(set(product_ids))
+                                   for key in (f'product:{product_id}', page_cache_key(f'/product/{product_id}?'))])
+
+def rows_to_dicts(rows):
+    return [dict(row) for row in rows]
+
+def catalog_connection(key):
+    """Connection for (re)loading catalog cache entry key
+
+    A replica, except right after the entry was invalidated: a replica that
+    has not caught up yet would have its old rows cached under the new
+    generation for the full TTL.
+    """
+    return get_db_connection(readonly=not (DATABASE_REPLICAS and catalog_cache.recently_changed(key)))
+
+def load_catalog(key, query, params=()):
+    """Run a catalog query through the cache, returning a list of dicts"""
+    def loader():
+        conn = catalog_connection(key)
+        try:
+            return rows_to_dicts(conn.execute(query, params).fetchall())
+        finally:
+            conn.close()
+    return catalog_cache.get_or_load(key, loader)
+
+def get_categories():
+    return load_catalog('categories', 'SELECT DISTINCT category FROM products ORDER BY category')
+
+def get_product(product_id):
+    """Cached single-product lookup, None if it does not exist"""
+    rows = load_catalog(f'product:{product_id}', 'SELECT * FROM products WHERE id = ?', (product_id,))
+    return rows[0] if rows else None
+
+# Rendered HTML caching: fragments per process keyed by their content, whole
+# catalog pages for anonymous visitors in the catalog cache (PAGE_CACHE_TTL=0 disables)
+FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 4096))
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', 30))
+
+fragment_cache = LocalCacheBackend(max_entries=FRAGMENT_CACHE_MAX_ENTRIES) if FRAGMENT_CACHE_MAX_ENTRIES > 0 else None
+
+def fragment_key(template_name, context):
+    """Version key for a fragment: changes whenever any value it is rendered from changes"""
+    digest = hashlib.blake2b(repr(sorted(context.items())).encode(), digest_size=12).hexdigest()
+    return f'fragment:{template_name}:{digest}'
+
+@app.template_global()
+def cached_fragment(template_name, **context):
+    """Render a template fragment, reusing the HTML for identical context
+
+    Fragments must depend only on the values passed in (product rows,
+    categories, nav state), never on request state read inside them.
+    """
+    if fragment_cache is None:
+        return Markup(render_template(template_name, **context))
+    key = fragment_key(template_name, context)
+    html = fragment_cache.get(key)
+    if METRICS_ENABLED:
+        metric_child(CACHE_REQUESTS, 'fragment', 'miss' if html is None else 'hit').inc()
+    if html is None:
+        html = Markup(render_template(template_name, **context))
+        fragment_cache.set(key, html, FRAGMENT_CACHE_TTL)
+    return html
+
+def page_cache_key(full_path):
+    """Catalog cache key of a whole page, by path and query string as in request.full_path"""
+    return f'page:{full_path}'
+
+def anonymous_visitor():
+    """True when the page cannot show anything of the visitor's own: no login, cart or flash messages"""
+    return not any(session.get(key) for key in ('user_id', 'cart_count', '_flashes'))
+
+def cache_page(view):
+    """Serve catalog pages to anonymous visitors from the catalog cache
+
+    Pages are namespaced by the catalog generation, so any product or stock
+    change drops them along with the catalog reads they were built from.
+    Visitors with a login, a cart or pending flash messages get a fresh render.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if PAGE_CACHE_TTL <= 0 or request.method != 'GET' or not anonymous_visitor():
+            return view(*args, **kwargs)
+        rendered = {}
+
+        def loader():
+            rendered['response'] = view(*args, **kwargs)
+            # Only plain HTML bodies are shared; redirects and error pages are not
+            return rendered['response'] if isinstance(rendered['response'], str) else None
+
+        html = catalog_cache.get_or_load(page_cache_key(request.full_path), loader, ttl=PAGE_CACHE_TTL)
+        return rendered.get('response', html)
+    return wrapper
+
+# Browser and proxy caching per route. Public responses carry a weak ETag hashed
+# from the body, so every worker agrees on it and it changes exactly when the page does
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 30))
+HTTP_CACHE_POLICIES = {
+    'public': f'public, max-age={HTTP_CACHE_MAX_AGE}',
+    'private': 'private, no-cache',
+    'no-store': 'no-store',
+}
+
+def http_cache(policy):
+    """Give a route's responses the Cache-Control of an HTTP_CACHE_POLICIES entry
+
+    'public' only applies to anonymous visitors and plain 200/304 responses;
+    everything else is downgraded to 'private'. Public bodies without an ETag
+    of their own get a weak one hashed from the body (streamed bodies are
+    left alone), and a matching If-None-Match is answered with an empty 304.
+    """
+    cache_control = HTTP_CACHE_POLICIES[policy]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = make_response(view(*args, **kwargs))
+            public = policy == 'public' and request.method in ('GET', 'HEAD') and anonymous_visitor()
+            if policy == 'public' and (not public or session.modified
+                                       or response.status_code not in (200, 304)):
+                response.headers.setdefault('Cache-Control', HTTP_CACHE_POLICIES['private'])
+                return response
+            response.headers.setdefault('Cache-Control', cache_control)
+            if public and response.status_code == 200 and not response.is_streamed:
+                if 'ETag' not in response.headers:
+                    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=12).hexdigest(), weak=True)
+                if request.if_none_match.contains_weak(response.get_etag()[0]):
+                    return Response(status=304, headers={'Cache-Control': response.headers['Cache-Control'],
+                                                         'ETag': response.headers['ETag']})
+            return response
+        return wrapper
+    return decorator
+
+def warm_templates():
+    """Compile every template once at startup instead of on the first request that uses it"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+# Static asset pipeline: `flask build-assets` writes fingerprinted, precompressed
+# copies of static/ to static/dist/ plus a manifest that asset_url() resolves through
+ASSET_DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_URL_PREFIX = f'{app.static_url_path}/dist/'
+ASSET_MANIFEST = 'manifest.json'
+ASSET_COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Serve built assets from disk ahead of Flask (set to false when nginx serves static/dist/)
+ASSET_MIDDLEWARE = os.environ.get('ASSET_MIDDLEWARE', 'true').lower() == 'true'
+
+def build_assets(source=None, output=None):
+    """Fingerprint every static file, write .gz/.br variants and the manifest
+
+    Previously built files are kept so pages rendered before a deploy can
+    still load the assets they reference.
+    """
+    source = os.path.abspath(source or app.static_folder)
+    output = os.path.abspath(output or ASSET_DIST_DIR)
+    skipped = {output, os.path.join(source, 'uploads')}
+    manifest = {}
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) not in skipped)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            logical = os.path.relpath(path, source).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(logical)
+            hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+            target = os.path.join(output, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            variants = [('', data)]
+            if ext in ASSET_COMPRESSIBLE:
+                variants.append(('.gz', gzip.compress(data, compresslevel=9, mtime=0)))
+                if brotli is not None:
+                    variants.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, content in variants:
+                with open(target + suffix, 'wb') as f:
+                    f.write(content)
+            manifest[logical] = hashed
+    # Workers may read the manifest at any moment, so replace it atomically
+    manifest_path = os.path.join(output, ASSET_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    asset_manifest.cache_clear()
+    asset_files.cache_clear()
+    return manifest
+
+@lru_cache(maxsize=None)
+def asset_manifest():
+    """Logical static path -> fingerprinted path, empty until build-assets has run"""
+    try:
+        with open(os.path.join(ASSET_DIST_DIR, ASSET_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@lru_cache(maxsize=None)
+def asset_files():
+    """Fingerprinted path -> {content coding: file on disk} for every built asset"""
+    files = {}
+    for hashed in asset_manifest().values():
+        path = os.path.join(ASSET_DIST_DIR, hashed)
+        variants = {'identity': path}
+        for coding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if os.path.exists(path + suffix):
+                variants[coding] = path + suffix
+        files[hashed] = variants
+    return files
+
+@app.template_global()
+def asset_url(filename):
+    """url_for('static') for templates, pointing at the fingerprinted copy once assets are built"""
+    hashed = asset_manifest().get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=f'dist/{hashed}')
+
+class StaticAssetMiddleware:
+    """Serve built assets straight from disk without entering Flask
+
+    Picks the brotli or gzip variant the client accepts, marks the response
+    immutable (the filename changes with the content) and hands the file to
+    the server's wsgi.file_wrapper, which gunicorn turns into sendfile().
+    Only paths listed in the manifest are served; anything else falls
+    through to the application.
+    """
+
+    def __init__(self, wsgi_app, prefix=ASSET_URL_PREFIX):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix) or environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self.wsgi_app(environ, start_response)
+        variants = asset_files().get(path[len(self.prefix):])
+        if variants is None:
+            return self.wsgi_app(environ, start_response)
+
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+        coding = next((c for c in ('br', 'gzip') if c in variants and accepted.quality(c) > 0), 'identity')
+        filename = variants[coding]
+        headers = [
+            ('Content-Type', mimetypes.guess_type(variants['identity'])[0] or 'application/octet-stream'),
+            ('Content-Length', str(os.path.getsize(filename))),
+            ('Cache-Control', ASSET_CACHE_CONTROL),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if coding != 'identity':
+            headers.append(('Content-Encoding', coding))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return environ.get('wsgi.file_wrapper', FileWrapper)(open(filename, 'rb'), 65536)
+
+if ASSET_MIDDLEWARE:
+    app.wsgi_app = StaticAssetMiddleware(app.wsgi_app)
+
+# Response compression for HTML, JSON and other text produced by the routes
+# (set COMPRESSION_MIDDLEWARE to false when a proxy in front compresses instead)
+COMPRESSION_MIDDLEWARE = os.environ.get('COMPRESSION_MIDDLEWARE', 'true').lower() == 'true'
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # bytes; smaller bodies gain too little
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript', 'application/json',
+                      'application/javascript', 'application/x-ndjson', 'image/svg+xml'}
+COMPRESS_CODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def response_compressor(coding):
+    """(compress, finish) callables for one response body in the given content coding"""
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    return compressor.compress, compressor.flush
+
+class CompressionMiddleware:
+    """Compress text responses with brotli or gzip, whichever the client prefers
+
+    Bodies with a Content-Length are compressed in one piece and keep an exact
+    length; streamed bodies are compressed as they are produced. Responses
+    under min_size bytes, already encoded (built assets) or marked
+    no-transform pass through. Strong ETags are weakened when the bytes change.
+    """
+
+    def __init__(self, wsgi_app, min_size=None):
+        self.wsgi_app = wsgi_app
+        self.min_size = COMPRESS_MIN_SIZE if min_size is None else min_size
+
+    def __call__(self, environ, start_response):
+        coding = None
+        if environ['REQUEST_METHOD'] != 'HEAD':
+            accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))
+            coding = next((c for c in COMPRESS_CODINGS if accepted.quality(c) > 0), None)
+        plan = {}
+
+        def start(status, headers, exc_info=None):
+            headers = Headers(headers)
+            if (headers.get('Content-Type', '').split(';')[0].strip() not in COMPRESS_MIMETYPES
+                    or 'Content-Encoding' in headers or status[:3] in ('204', '206', '304')
+                    or 'no-transform' in headers.get('Cache-Control', '')):
+                return start_response(status, headers.to_wsgi_list(), exc_info)
+            vary = headers.get('Vary')
+            if not vary:
+                headers['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower():
+                headers['Vary'] = f'{vary}, Accept-Encoding'
+            length = headers.get('Content-Length', type=int)
+            if coding is None or (length is not None and length < self.min_size):
+                return start_response(status, headers.to_wsgi_list(), exc_info)
+            headers['Content-Encoding'] = coding
+            etag = headers.get('ETag')
+            if etag and not etag.startswith('W/'):
+                headers['ETag'] = f'W/{etag}'
+            if length is None:
+                plan['stream'] = True
+                return start_response(status, headers.to_wsgi_list(), exc_info)
+            # Sent once the whole body is compressed and its length is known
+            plan['buffered'] = (status, headers, exc_info)
+            plan['chunks'] = []
+            return plan['chunks'].append
+
+        iterable = self.wsgi_app(environ, start)
+        if 'buffered' in plan:
+            compress, finish = response_compressor(coding)
+            try:
+                body = compress(b''.join(plan['chunks'] + list(iterable))) + finish()
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+            status, headers, exc_info = plan['buffered']
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [body]
+        if 'stream' in plan:
+            return self._stream(iterable, coding)
+        return iterable
+
+    def _stream(self, iterable, coding):
+        compress, finish = response_compressor(coding)
+        try:
+            for chunk in iterable:
+                data = compress(chunk)
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+if COMPRESSION_MIDDLEWARE:
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+
+# Server-side cart configuration
+CART_STORE = os.environ.get('CART_STORE', 'sqlite')
+CART_TTL = float(os.environ.get('CART_TTL', 7 * 24 * 3600))
+# Expired carts are purged on roughly one in CART_PURGE_INTERVAL writes
+CART_PURGE_INTERVAL = int(os.environ.get('CART_PURGE_INTERVAL', 500))
+
+class MemoryCartStore:
+    """Carts in a per-process dict; only suitable for a single worker"""
+
+    def __init__(self, ttl=None):
+        self.ttl = CART_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._carts = {}  # cart_id -> (touched_at, {product_id: quantity})
+
+    def get(self, cart_id):
+        entry = self._carts.get(cart_id)
+        if entry is None or entry[0] + self.ttl < time.time():
+            return {}
+        return dict(entry[1])
+
+    def _lines(self, cart_id):
+        touched_at, lines = self._carts.get(cart_id, (None, None))
+        if lines is None or touched_at + self.ttl < time.time():
+            lines = {}
+        self._carts[cart_id] = (time.time(), lines)
+        return lines
+
+    def add(self, cart_id, product_id, quantity=1):
+        with self._lock:
+            lines = self._lines(cart_id)
+            lines[product_id] = lines.get(product_id, 0) + quantity
+            return len(lines)
+
+    def remove(self, cart_id, product_id):
+        with self._lock:
+            lines = self._lines(cart_id)
+            lines.pop(product_id, None)
+            return len(lines)
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [cart_id for cart_id, (touched_at, _) in self._carts.items() if touched_at < cutoff]
+            for cart_id in expired:
+                del self._carts[cart_id]
+        return len(expired)
+
+class SQLiteCartStore:
+    """Carts in the application database, shared by all workers"""
+
+    def __init__(self, ttl=None):
+        self.ttl = CART_TTL if ttl is None else ttl
+        self._writes = 0
+
+    def get(self, cart_id):
+        conn = get_db_connection()
+        try:
+            rows = conn.execute(
+                'SELECT product_id, quantity FROM carts WHERE cart_id = ? AND updated_at >= ?',
+                (cart_id, time.time() - self.ttl)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row['product_id']: row['quantity'] for row in rows}
+
+    def _write(self, cart_id, statement, params):
+        def work(conn):
+            conn.execute(statement, params)
+            # Touch every line so the whole cart expires together
+            conn.execute('UPDATE carts SET updated_at = ? WHERE cart_id = ?', (time.time(), cart_id))
+            return conn.execute('SELECT COUNT(*) FROM carts WHERE cart_id = ?', (cart_id,)).fetchone()[0]
+        count = db_write(work)
+        self._writes += 1
+        if self._writes % CART_PURGE_INTERVAL == 0:
+            self.purge_expired()
+        return count
+
+    def add(self, cart_id, product_id, quantity=1):
+        return self._write(cart_id, '''
+            INSERT INTO carts (cart_id, product_id, quantity, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = carts.quantity + excluded.quantity
+        ''', (cart_id, product_id, quantity, time.time()))
+
+    def remove(self, cart_id, product_id):
+        return self._write(cart_id, 'DELETE FROM carts WHERE cart_id = ? AND product_id = ?', (cart_id, product_id))
+
+    def clear(self, cart_id):
+        db_write(lambda conn: conn.execute('DELETE FROM carts WHERE cart_id = ?', (cart_id,)))
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        return db_write(lambda conn: conn.execute('DELETE FROM carts WHERE updated_at < ?', (cutoff,)).rowcount)
+
+class CacheCartStore:
+    """Carts as JSON documents in a key/value cache backend
+
+    With SQLiteCacheBackend this is the local stand-in for keeping carts in
+    Redis: one key per cart, expiring CART_TTL seconds after the last write.
+    """
+
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend or SQLiteCacheBackend()
+        self.ttl = CART_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+
+    def get(self, cart_id):
+        lines = self.backend.get(f'cart:{cart_id}') or {}
+        return {int(product_id): quantity for product_id, quantity in lines.items()}
+
+    def _update(self, cart_id, change):
+        with self._lock:
+            lines = self.get(cart_id)
+            change(lines)
+            self.backend.set(f'cart:{cart_id}', lines, self.ttl)
+            return len(lines)
+
+    def add(self, cart_id, product_id, quantity=1):
+        return self._update(cart_id, lambda lines: lines.__setitem__(product_id, lines.get(product_id, 0) + quantity))
+
+    def remove(self, cart_id, product_id):
+        return self._update(cart_id, lambda lines: lines.pop(product_id, None))
+
+    def clear(self, cart_id):
+        self.backend.delete(f'cart:{cart_id}')
+
+    def purge_expired(self):
+        # Entries expire on read; the backend purges expired rows as it writes
+        return 0
+
+CART_STORES = {
+    'memory': MemoryCartStore,
+    'sqlite': SQLiteCartStore,
+    'cache': CacheCartStore,
+}
+
+def create_cart_store(name=None):
+    """Build the cart store for the configured backend"""
+    name = name or CART_STORE
+    try:
+        return CART_STORES[name]()
+    except KeyError:
+        raise ValueError(f"Unknown CART_STORE '{name}'")
+
+cart_store = create_cart_store()
+
+def get_cart():
+    """Current visitor's cart as {product_id: quantity}"""
+    cart_id = session.get('cart_id')
+    return cart_store.get(cart_id) if cart_id else {}
+
+def _cart_id():
+    if 'cart_id' not in session:
+        session['cart_id'] = secrets.token_urlsafe(16)
+    return session['cart_id']
+
+def add_cart_item(product_id, quantity=1):
+    session['cart_count'] = cart_store.add(_cart_id(), product_id, quantity)
+
+def remove_cart_item(product_id):
+    session['cart_count'] = cart_store.remove(_cart_id(), product_id)
+
+def clear_cart():
+    if 'cart_id' in session:
+        cart_store.clear(session['cart_id'])
+    session.pop('cart_count', None)
+
+# Cart pricing
+CENT = Decimal('0.01')
+TAX_RATE = Decimal(os.environ.get('TAX_RATE', '0.08'))
+
+@lru_cache(maxsize=4096)
+def to_money(value):
+    """Exact two-place Decimal for a price stored as REAL"""
+    # str() gives the shortest repr of the float, i.e. the price as it was entered
+    return Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+def fetch_cart_products(conn, product_ids):
+    """Product rows for a cart, indexed by id"""
+    if not product_ids:
+        return {}
+    ids = list(product_ids)
+    placeholders = ','.join('?' * len(ids))
+    rows = conn.execute(f'SELECT * FROM products WHERE id IN ({placeholders})', ids).fetchall()
+    return {row['id']: row for row in rows}
+
+def fetch_products(product_ids):
+    """Product rows for a list of ids, in no particular order"""
+    conn = get_db_connection()
+    try:
+        return list(fetch_cart_products(conn, product_ids).values())
+    finally:
+        conn.close()
+
+def price_lines(cart, products_by_id):
+    """Price {product_id: quantity} against an id -> product index in one pass
+
+    Lines whose product no longer exists are skipped. Returns
+    {'items': [...], 'total': Decimal, 'tax': Decimal, 'grand_total': Decimal,
+    'missing': [product_id, ...]}.
+    """
+    items = []
+    missing = []
+    total = Decimal('0.00')
+    for product_id, quantity in cart.items():
+        product = products_by_id.get(product_id)
+        if product is None:
+            missing.append(product_id)
+            continue
+        unit_price = to_money(product['price'])
+        line_total = unit_price * quantity
+        items.append({
+            'product': product,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'total': line_total,
+        })
+        total += line_total
+    tax = (total * TAX_RATE).quantize(CENT, rounding=ROUND_HALF_UP)
+    return {'items': items, 'total': total, 'tax': tax, 'grand_total': total + tax, 'missing': missing}
+
+def price_cart(cart, conn=None):
+    """Fetch and price the products of a cart"""
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    try:
+        products_by_id = fetch_cart_products(conn, cart.keys())
+    finally:
+        if own_conn:
+            conn.close()
+    return price_lines(cart, products_by_id)
+
+# Checkout
+class OutOfStockError(Exception):
+    """Raised when a cart asks for more units than are in stock"""
+
+    def __init__(self, product_ids):
+        super().__init__(f'Insufficient stock for products {product_ids}')
+        self.product_ids = product_ids
+
+class EmptyOrderError(Exception):
+    """Raised when none of the cart's products exist any more"""
+
+def find_order_by_idempotency_key(user_id, idempotency_key):
+    """Id of the order already placed with this key, if any"""
+    if not idempotency_key:
+        return None
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            'SELECT id FROM orders WHERE user_id = ? AND idempotency_key = ?', (user_id, idempotency_key)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row['id'] if row else None
+
+# Checkout mode: 'sync' writes the order inside the request, 'async' enqueues it
+CHECKOUT_MODE = os.environ.get('CHECKOUT_MODE', 'sync')
+ORDER_QUEUE_BATCH_SIZE = int(os.environ.get('ORDER_QUEUE_BATCH_SIZE', 50))
+ORDER_QUEUE_POLL_INTERVAL = float(os.environ.get('ORDER_QUEUE_POLL_INTERVAL', 1.0))
+# Background order workers started in each app process (0: run `flask order-worker` instead)
+ORDER_WORKER_THREADS = int(os.environ.get('ORDER_WORKER_THREADS', 1))
+
+def _reserve_stock(conn, lines, held=None):
+    """Decrement stock for (product_id, quantity, price) lines, all or nothing
+
+    Units already held for the cart ({product_id: quantity}) count towards
+    their line; held units the order does not use go back to stock.
+    """
+    held = dict(held or {})
+    short = []
+    # Products are locked in id order so concurrent PostgreSQL checkouts cannot deadlock
+    for product_id, quantity, _ in sorted(lines):
+        needed = quantity - held.pop(product_id, 0)
+        if needed < 0:
+            _return_stock(conn, {product_id: -needed})
+        elif needed > 0 and conn.execute(
+            'UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?',
+            (needed, product_id, needed)
+        ).rowcount == 0:
+            short.append(product_id)
+    if short:
+        raise OutOfStockError(short)
+    _return_stock(conn, held)
+
+# Stock holds: opening the checkout page sets the cart's units aside for
+# STOCK_HOLD_TTL seconds from the cart's first hold, so they cannot sell out while
+# the customer fills in the form. A hold is a row written in the same transaction as the stock it takes, so
+# nothing is lost or double counted if a worker dies. Expired holds go back to stock
+# whenever a checkout page is opened, or with `flask release-stock-holds`.
+STOCK_HOLD_TTL = float(os.environ.get('STOCK_HOLD_TTL', 600))  # 0 disables holds
+
+def _return_stock(conn, quantities):
+    conn.executemany('UPDATE products SET stock = stock + ? WHERE id = ?',
+                     [(quantity, product_id) for product_id, quantity in sorted(quantities.items()) if quantity])
+
+def _take_holds(conn, cart_id):
+    """Remove a cart's holds and return them as {product_id: quantity}"""
+    rows = conn.execute('SELECT product_id, quantity FROM stock_holds WHERE cart_id = ?', (cart_id,)).fetchall()
+    conn.execute('DELETE FROM stock_holds WHERE cart_id = ?', (cart_id,))
+    return {row['product_id']: row['quantity'] for row in rows}
+
+def _release_expired_holds(conn):
+    now = time.time()
+    rows = conn.execute(
+        'SELECT product_id, SUM(quantity) FROM stock_holds WHERE expires_at < ? GROUP BY product_id', (now,)
+    ).fetchall()
+    released = {row[0]: row[1] for row in rows}
+    _return_stock(conn, released)
+    conn.execute('DELETE FROM stock_holds WHERE expires_at < ?', (now,))
+    return released
+
+def release_expired_holds():
+    """Return the units of every expired hold to stock; returns how many units"""
+    released = db_write(_release_expired_holds)
+    invalidate_stock(released)
+    return sum(released.values())
+
+def hold_stock(cart_id, cart):
+    """Hold the cart's quantities, adjusting the holds it already has
+
+    Holds expire STOCK_HOLD_TTL seconds after the cart's first hold; reopening
+    checkout never extends them, so refreshing the page cannot keep stock off
+    sale. A line that cannot be raised to the cart quantity keeps what it
+    already holds (checkout still tries the rest). Returns the ids of the
+    lines not held in full.
+    """
+    if STOCK_HOLD_TTL <= 0 or not cart_id:
+        return []
+    wanted = {product_id: quantity for product_id, quantity in cart.items() if quantity > 0}
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT product_id, quantity, expires_at FROM stock_holds WHERE cart_id = ?',
+                            (cart_id,)).fetchall()
+    finally:
+        conn.close()
+    if ({row['product_id']: row['quantity'] for row in rows} == wanted
+            and all(row['expires_at'] >= time.time() for row in rows)):
+        return []  # already held as the cart stands: no write, no cache invalidation
+    
+    def work(conn):
+        changed = set(_release_expired_holds(conn))
+        expires_at = conn.execute('SELECT MIN(expires_at) FROM stock_holds WHERE cart_id = ?',
+                                  (cart_id,)).fetchone()[0] or time.time() + STOCK_HOLD_TTL
+        previous = _take_holds(conn, cart_id)
+        held, short = {}, []
+        for product_id, quantity in sorted(wanted.items()):
+            have = previous.pop(product_id, 0)
+            if quantity > have and conn.execute(
+                'UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?',
+                (quantity - have, product_id, quantity - have)
+            ).rowcount == 0:
+                short.append(product_id)
+                quantity = have  # keep the partial hold
+            _return_stock(conn, {product_id: max(have - quantity, 0)})
+            if quantity != have:
+                changed.add(product_id)
+            if quantity:
+                held[product_id] = quantity
+        _return_stock(conn, previous)
+        conn.executemany(
+            'INSERT INTO stock_holds (cart_id, product_id, quantity, expires_at) VALUES (?, ?, ?, ?)',
+            [(cart_id, product_id, quantity, expires_at) for product_id, quantity in held.items()]
+        )
+        return short, changed | set(previous)
+    
+    short, changed = db_write(work)
+    invalidate_stock(changed)
+    return short
+
+def _insert_order_items(conn, order_id, lines):
+    conn.executemany(
+        'INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)',
+        [(order_id, product_id, quantity, price) for product_id, quantity, price in lines]
+    )
+
+def place_order(user_id, cart, idempotency_key=None, mode=None, cart_id=None):
+    """Create an order and reserve its stock in one BEGIN IMMEDIATE transaction
+
+    Stock is decremented with a conditional UPDATE, so concurrent checkouts
+    can never oversell; if any line cannot be reserved the whole order is
+    rolled back and OutOfStockError names the products that ran out.
+    Replaying the same idempotency key returns the original order.
+    
+    In async mode the priced order is stored with status 'queued' and handed
+    to the order queue instead; stock is reserved by the order workers.
+    
+    Stock held for cart_id at checkout is used first. In async mode the held
+    units stay off sale and travel with the queued order, so the order worker
+    uses them before reserving anything else.
+    
+    Returns (order_id, created).
+    """
+    mode = mode or CHECKOUT_MODE
+    stock_changed = {}
+    
+    def work(conn):
+        stock_changed.clear()
+        if idempotency_key:
+            if sql_dialect(conn) == 'postgresql':
+                # Replays of one key queue here; SQLite's write lock already serializes them
+                conn.execute('SELECT pg_advisory_xact_lock(?, hashtext(?))', (user_id or 0, idempotency_key))
+            existing = conn.execute(
+                'SELECT id FROM orders WHERE user_id = ? AND idempotency_key = ?',
+                (user_id, idempotency_key)
+            ).fetchone()
+            if existing:
+                return existing['id'], False
+        
+        quote = price_cart(cart, conn=conn)
+        if not quote['items']:
+            raise EmptyOrderError()
+        lines = [(item['product']['id'], item['quantity'], float(item['unit_price'])) for item in quote['items']]
+        held = _take_holds(conn, cart_id) if cart_id else {}
+        stock_changed.update(held)
+        
+        if mode == 'async':
+            order_id = conn.execute(
+                "INSERT INTO orders (user_id, total_amount, idempotency_key, status) VALUES (?, ?, ?, 'queued') "
+                "RETURNING id",
+                (user_id, float(quote['total']), idempotency_key)
+            ).fetchone()[0]
+            order_queue.enqueue(conn, order_id, lines, held)
+            return order_id, True
+        
+        _reserve_stock(conn, lines, held)
+        stock_changed.update((product_id, quantity) for product_id, quantity, _ in lines)
+        order_id = conn.execute(
+            'INSERT INTO orders (user_id, total_amount, idempotency_key) VALUES (?, ?, ?) RETURNING id',
+            (user_id, float(quote['total']), idempotency_key)
+        ).fetchone()[0]
+        _insert_order_items(conn, order_id, lines)
+        record_sales(conn, [order_id])
+        return order_id, True
+    
+    order_id, created = db_write(work)
+    invalidate_stock(stock_changed)
+    if created and mode == 'async':
+        order_queue.notify()
+        start_order_workers()
+    return order_id, created
+
+class SQLiteOrderQueue:
+    """Durable FIFO of orders awaiting stock reservation, stored in the application database
+
+    Jobs are claimed, processed and deleted inside the worker's write
+    transaction, so a worker that dies mid-batch leaves its jobs queued.
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+
+    def enqueue(self, conn, order_id, lines, held=None):
+        """Queue an order's lines, with the stock already held for it ({product_id: quantity})"""
+        payload = {'lines': lines, 'held': sorted((held or {}).items())}
+        conn.execute(
+            'INSERT INTO order_queue (order_id, payload, enqueued_at) VALUES (?, ?, ?)',
+            (order_id, json.dumps(payload), time.time())
+        )
+
+    def claim(self, conn, limit):
+        query = 'SELECT id, order_id, payload FROM order_queue ORDER BY id LIMIT ?'
+        if sql_dialect(conn) == 'postgresql':
+            # Workers in other processes take the next jobs instead of waiting on these
+            query += ' FOR UPDATE SKIP LOCKED'
+        rows = conn.execute(query, (limit,)).fetchall()
+        jobs = []
+        for row in rows:
+            payload = json.loads(row['payload'])
+            if isinstance(payload, list):  # queued before holds travelled with the order
+                payload = {'lines': payload, 'held': []}
+            jobs.append((row['id'], row['order_id'], payload['lines'], dict(payload['held'])))
+        return jobs
+
+    def ack(self, conn, job_ids):
+        conn.executemany('DELETE FROM order_queue WHERE id = ?', [(job_id,) for job_id in job_ids])
+
+    def depth(self):
+        conn = get_db_connection()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM order_queue').fetchone()[0]
+        finally:
+            conn.close()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def wait(self, timeout):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+order_queue = SQLiteOrderQueue()
+
+def process_order_batch(batch_size=None):
+    """Reserve stock for a batch of queued orders in one transaction
+
+    Each order runs under its own savepoint: it becomes 'pending' when all of
+    its lines are reserved and 'rejected' when any is out of stock. Units held
+    for the order at checkout count first, and go back to stock if it is
+    rejected. Returns {order_id: status} for the orders handled.
+    """
+    batch_size = batch_size or ORDER_QUEUE_BATCH_SIZE
+    
+    stock_changed = set()
+    
+    def work(conn):
+        stock_changed.clear()
+        results = {}
+        jobs = order_queue.claim(conn, batch_size)
+        for job_id, order_id, lines, held in jobs:
+            order = conn.execute('SELECT status FROM orders WHERE id = ?', (order_id,)).fetchone()
+            if order is None or order['status'] != 'queued':
+                continue  # already handled by an earlier, interrupted run
+            conn.execute('SAVEPOINT queued_order')
+            try:
+                _reserve_stock(conn, lines, held)
+                _insert_order_items(conn, order_id, lines)
+                status = 'pending'
+                stock_changed.update(product_id for product_id, _, _ in lines)
+            except OutOfStockError:
+                conn.execute('ROLLBACK TO queued_order')
+                _return_stock(conn, held)
+                stock_changed.update(held)
+                status = 'rejected'
+            conn.execute('RELEASE queued_order')
+            conn.execute('UPDATE orders SET status = ? WHERE id = ?', (status, order_id))
+            results[order_id] = status
+        order_queue.ack(conn, [job[0] for job in jobs])
+        record_sales(conn, [order_id for order_id, status in results.items() if status == 'pending'])
+        return results
+    
+    results = db_write(work)
+    invalidate_stock(stock_changed)
+    if METRICS_ENABLED:
+        for status in results.values():
+            metric_child(CHECKOUTS, 'async', 'reserved' if status == 'pending' else 'rejected').inc()
+    return results
+
+def drain_order_queue(batch_size=None):
+    """Process batches until the queue is empty; returns {order_id: status}"""
+    processed = {}
+    while True:
+        results = process_order_batch(batch_size)
+        if not results and not order_queue.depth():
+            return processed
+        processed.update(results)
+
+def run_order_worker(stop=None, batch_size=None, poll_interval=None):
+    """Drain the queue, then sleep until notified or the poll interval passes"""
+    poll_interval = ORDER_QUEUE_POLL_INTERVAL if poll_interval is None else poll_interval
+    while stop is None or not stop.is_set():
+        try:
+            if not process_order_batch(batch_size):
+                order_queue.wait(poll_interval)
+        except Exception as e:
+            logger.error(f"Order worker error: {e}")
+            time.sleep(poll_interval)
+
+_order_workers = {'pid': None, 'threads': []}
+
+def start_order_workers(count=None):
+    """Start background order workers in this process if they are not running yet
+
+    Servers call this in every serving process at startup when
+    CHECKOUT_MODE=async (gunicorn's post_fork, the ASGI lifespan), so orders
+    queued before a restart drain without waiting for a new checkout.
+    """
+    count = ORDER_WORKER_THREADS if count is None else count
+    if count <= 0 or _order_workers['pid'] == os.getpid():
+        return
+    with _pools_lock:
+        if _order_workers['pid'] == os.getpid():
+            return
+        _order_workers['pid'] = os.getpid()
+        _order_workers['threads'] = [
+            threading.Thread(target=run_order_worker, name=f'order-worker-{i}', daemon=True)
+            for i in range(count)
+        ]
+    for thread in _order_workers['threads']:
+        thread.start()
+
+# Sales analytics. Rollup tables keep running totals per day, product, category and
+# customer, so dashboards read a few rows instead of scanning orders. An order is
+# counted once its stock is reserved: inside the checkout transaction
+# (ANALYTICS_ROLLUP=checkout), or queued in sales_pending for `flask analytics-compact`
+# (batch), which keeps checkout transactions shortest. `off` stops counting.
+ANALYTICS_ROLLUP = os.environ.get('ANALYTICS_ROLLUP', 'checkout')
+ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', 500))
+ANALYTICS_BACKFILL_CHUNK = int(os.environ.get('ANALYTICS_BACKFILL_CHUNK', 10000))
+# Bearer token for /api/analytics/*; unset disables them
+ANALYTICS_API_TOKEN = os.environ.get('ANALYTICS_API_TOKEN')
+
+# (table, key column, key type); a sale line is filed under the key SALES_KEYS derives from it
+SALES_ROLLUPS = (
+    ('sales_daily', 'day', 'TEXT'),
+    ('sales_by_product', 'product_id', 'INTEGER'),
+    ('sales_by_category', 'category', 'TEXT'),
+    ('sales_by_user', 'user_id', 'INTEGER'),
+)
+SALES_KEYS = {
+    'sales_daily': lambda line: str(line['created_at'])[:10],
+    'sales_by_product': lambda line: line['product_id'],
+    'sales_by_category': lambda line: line['category'] or '',
+    'sales_by_user': lambda line: line['user_id'],
+}
+
+SALES_LINES = '''
+    SELECT o.id, o.user_id, o.created_at, oi.product_id, oi.quantity, oi.price, p.category
+    FROM orders o
+    JOIN order_items oi ON oi.order_id = o.id
+    LEFT JOIN products p ON p.id = oi.product_id
+'''
+
+def _add_sales_lines(conn, lines):
+    """Fold sale lines into every rollup table: one upsert batch per table"""
+    for table, column, _ in SALES_ROLLUPS:
+        totals = {}
+        for line in lines:
+            key = SALES_KEYS[table](line)
+            if key is None:
+                continue  # e.g. orders without a user
+            entry = totals.setdefault(key, [set(), 0, 0.0])
+            entry[0].add(line['id'])
+            entry[1] += line['quantity']
+            entry[2] += line['quantity'] * line['price']
+        conn.executemany(f'''
+            INSERT INTO {table} ({column}, orders, units, revenue) VALUES (?, ?, ?, ?)
+            ON CONFLICT ({column}) DO UPDATE SET
+                orders = {table}.orders + excluded.orders, units = {table}.units + excluded.units,
+                revenue = {table}.revenue + excluded.revenue
+        ''', [(key, len(orders), units, round(revenue, 2)) for key, (orders, units, revenue) in totals.items()])
+
+def apply_sales(conn, order_ids):
+    """Add orders to the rollups, in the caller's transaction"""
+    if not order_ids:
+        return
+    placeholders = ', '.join('?' * len(order_ids))
+    _add_sales_lines(conn, conn.execute(f'{SALES_LINES} WHERE o.id IN ({placeholders})', list(order_ids)).fetchall())
+
+def record_sales(conn, order_ids):
+    """Count orders whose stock was just reserved, now or via the compactor per ANALYTICS_ROLLUP"""
+    if not order_ids or ANALYTICS_ROLLUP == 'off':
+        return
+    if ANALYTICS_ROLLUP == 'batch':
+        conn.executemany('INSERT INTO sales_pending (order_id) VALUES (?)', [(order_id,) for order_id in order_ids])
+    else:
+        apply_sales(conn, order_ids)
+
+def compact_sales(batch_size=None):
+    """Move queued orders into the rollups, batch_size orders per transaction; returns how many"""
+    batch_size = batch_size or ANALYTICS_BATCH_SIZE
+    
+    def work(conn):
+        query = 'SELECT order_id FROM sales_pending ORDER BY order_id LIMIT ?'
+        if sql_dialect(conn) == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+        order_ids = [row[0] for row in conn.execute(query, (batch_size,)).fetchall()]
+        apply_sales(conn, order_ids)
+        conn.executemany('DELETE FROM sales_pending WHERE order_id = ?', [(order_id,) for order_id in order_ids])
+        return len(order_ids)
     
-    # Insert sample products
-    sample_products = [
-        ('Laptop', 'High-performance laptop for professionals', 999.99, 10, 'Electronics', '/static/images/laptop.jpg'),
-        ('Smartphone', 'Latest smartphone with advanced features', 699.99, 15, 'Electronics', '/static/images/phone.jpg'),
-        ('Headphones', 'Wireless noise-canceling headphones', 199.99, 20, 'Electronics', '/static/images/headphones.jpg'),
-        ('Coffee Mug', 'Premium ceramic coffee mug', 19.99, 50, 'Home', '/static/images/mug.jpg'),
-        ('T-Shirt', 'Comfortable cotton t-shirt', 29.99, 30, 'Clothing', '/static/images/tshirt.jpg')
-    ]
+    total = 0
+    while True:
+        count = db_write(work)
+        total += count
+        if count < batch_size:
+            return total
+
+def backfill_sales(chunk_size=None, progress=None):
+    """Rebuild every rollup from orders and order_items, chunk_size orders per transaction
+
+    Orders placed after the rollups are cleared are counted by checkout as
+    usual. Drain the order queue first: an async order reserved while the
+    backfill runs can otherwise be counted twice. Returns the orders counted.
+    """
+    chunk_size = chunk_size or ANALYTICS_BACKFILL_CHUNK
     
-    for product in sample_products:
-        conn.execute('''
-            INSERT OR IGNORE INTO products (name, description, price, stock, category, image_url)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', product)
+    def reset(conn):
+        for table, _, _ in SALES_ROLLUPS:
+            conn.execute(f'DELETE FROM {table}')
+        conn.execute('DELETE FROM sales_pending')
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM orders').fetchone()[0]
     
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully")
+    def work(conn, first, last):
+        lines = conn.execute(
+            f"{SALES_LINES} WHERE o.id > ? AND o.id <= ? AND o.status NOT IN ('queued', 'rejected')", (first, last)
+        ).fetchall()
+        _add_sales_lines(conn, lines)
+        return len({line['id'] for line in lines})
+    
+    high = db_write(reset)
+    counted = 0
+    # Ranges of the primary key, so each chunk is an index range scan however large the table
+    for first in range(0, high, chunk_size):
+        counted += db_write(lambda conn: work(conn, first, min(first + chunk_size, high)))
+        if progress:
+            progress(counted, min(first + chunk_size, high), high)
+    return counted
+
+# Password hashing
+AUTH_HASH_PROFILES = {
+    'interactive': 'pbkdf2:sha256:600000',  # werkzeug's default
+    'low': 'pbkdf2:sha256:100000',
+    'scrypt': 'scrypt:32768:8:1',
+}
+AUTH_HASH_PROFILE = os.environ.get('AUTH_HASH_PROFILE', 'interactive')
+# Concurrent hashes per worker process, and how many more may wait before logins are turned away
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', 2))
+AUTH_HASH_QUEUE = int(os.environ.get('AUTH_HASH_QUEUE', 8))
+AUTH_HASH_TIMEOUT = float(os.environ.get('AUTH_HASH_TIMEOUT', 10))
+# Login/register attempts allowed per client IP per window
+AUTH_RATE_LIMIT = int(os.environ.get('AUTH_RATE_LIMIT', 10))
+AUTH_RATE_WINDOW = float(os.environ.get('AUTH_RATE_WINDOW', 60))
+# Reverse proxies in front of the app (nginx, a load balancer) whose X-Forwarded-For
+# and X-Forwarded-Proto entries are trusted; 0 when clients connect directly
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+
+if TRUSTED_PROXY_HOPS:
+    # request.remote_addr becomes the client address the nearest trusted proxy saw
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+
+class AuthBusyError(Exception):
+    """Raised when the hashing pool is saturated"""
+
+def hash_method():
+    """werkzeug hash method string for the configured cost profile"""
+    try:
+        return AUTH_HASH_PROFILES[AUTH_HASH_PROFILE]
+    except KeyError:
+        raise ValueError(f"Unknown AUTH_HASH_PROFILE '{AUTH_HASH_PROFILE}'")
+
+def needs_rehash(password_hash):
+    """True if a stored hash was made with different cost parameters"""
+    return password_hash.split('$', 1)[0] != hash_method()
+
+class HashingPool:
+    """Bounded thread pool for password KDFs with admission control
+
+    hashlib releases the GIL while it hashes, so the work runs in parallel
+    with request threads; at most `workers` hashes run at once and at most
+    `queue` more wait, beyond which submit() fails fast with AuthBusyError.
+    A hash that outlives `timeout` also ends in AuthBusyError; its slot stays
+    taken until the hash actually finishes.
+    """
+
+    def __init__(self, workers=None, queue=None, timeout=None):
+        self.workers = AUTH_HASH_WORKERS if workers is None else workers
+        self.queue = AUTH_HASH_QUEUE if queue is None else queue
+        self.timeout = AUTH_HASH_TIMEOUT if timeout is None else timeout
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._pid = None
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='auth-hash')
+                self._pid = os.getpid()
+            return self._executor
+
+    def _release_slot(self, future):
+        self._slots.release()
+
+    def run(self, fn, *args):
+        """Run fn(*args) on the pool and wait for the result"""
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise AuthBusyError()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self.timed_out += 1
+            raise AuthBusyError()
+
+auth_pool = HashingPool()
+
+class RateLimiter:
+    """Sliding-window request counter per key (client IP), per process"""
+
+    def __init__(self, limit=None, window=None):
+        self.limit = AUTH_RATE_LIMIT if limit is None else limit
+        self.window = AUTH_RATE_WINDOW if window is None else window
+        self._lock = threading.Lock()
+        self._hits = {}
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.setdefault(key, deque())
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            if len(self._hits) > 10000:
+                # Forget idle clients so the table cannot grow without bound
+                for stale in [k for k, v in self._hits.items() if not v or v[-1] <= now - self.window]:
+                    del self._hits[stale]
+            return True
+
+    def reset(self):
+        with self._lock:
+            self._hits.clear()
+
+auth_rate_limiter = RateLimiter()
+
+def hash_password(password):
+    return auth_pool.run(generate_password_hash, password, hash_method())
+
+def verify_password(password_hash, password):
+    return auth_pool.run(check_password_hash, password_hash, password)
+
+def auth_throttled(template):
+    """Response for a throttled auth POST, or None if the client may proceed"""
+    if auth_rate_limiter.allow(request.remote_addr or 'unknown'):
+        return None
+    flash('Too many attempts. Please wait a minute and try again.', 'error')
+    return render_template(template), 429, {'Retry-After': str(int(AUTH_RATE_WINDOW))}
+
+def auth_busy(template):
+    flash('We are handling a lot of sign-ins right now. Please try again in a moment.', 'error')
+    return render_template(template), 503, {'Retry-After': '1'}
+
+class APIError(Exception):
+    """Client error reported as a JSON body"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(APIError)
+def handle_api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """Return any connections still held by this app context to the pool"""
+    for conn in g.pop('_db_handles', []):
+        conn.close()
 
 @app.route('/')
+@http_cache('public')
+@cache_page
 def home():
     """Home page with featured products"""
     try:
-        conn = get_db_connection()
-        products = conn.execute('SELECT * FROM products LIMIT 6').fetchall()
-        conn.close()
-        return render_template('home.html', products=products)
-    except sqlite3.OperationalError as e:
+        products = load_catalog('home', 'SELECT * FROM products ORDER BY id LIMIT 6')
+    except DB_ERRORS as e:
+        # Schema setup belongs to deployment (`flask migrate`), never to a request
         logger.error(f"Database error in home route: {e}")
-        # Try to initialize database and retry
-        init_db()
-        try:
-            conn = get_db_connection()
-            products = conn.execute('SELECT * FROM products LIMIT 6').fetchall()
-            conn.close()
-            return render_template('home.html', products=products)
-        except Exception as e2:
-            logger.error(f"Failed to recover from database error: {e2}")
-            return render_template('home.html', products=[])
-    except Exception as e:
-        logger.error(f"Unexpected error in home route: {e}")
-        return render_template('home.html', products=[])
+        return render_template('home.html', products=[]), 503
+    return render_template('home.html', products=products)
 
 @app.route('/products')
+@http_cache('public')
+@cache_page
 def products():
     """All products page with filtering"""
     category = request.args.get('category')
     search = request.args.get('search')
-    
-    conn = get_db_connection()
-    query = 'SELECT * FROM products WHERE 1=1'
-    params = []
-    
-    if category:
-        query += ' AND category = ?'
-        params.append(category)
+    page = request.args.get('page', 1, type=int)
+    has_next = False
     
     if search:
-        query += ' AND (name LIKE ? OR description LIKE ?)'
-        params.extend([f'%{search}%', f'%{search}%'])
-    
-    products = conn.execute(query, params).fetchall()
-    categories = conn.execute('SELECT DISTINCT category FROM products').fetchall()
-    conn.close()
+        search_key = f'search:{category}:{page}:{search}'
+
+        def load_search():
+            conn = catalog_connection(search_key)
+            try:
+                rows, more = search_products(conn, search, category=category, page=page)
+            finally:
+                conn.close()
+            return {'products': rows_to_dicts(rows), 'has_next': more}
+        result = catalog_cache.get_or_load(search_key, load_search)
+        products, has_next = result['products'], result['has_next']
+    else:
+        query = 'SELECT * FROM products WHERE 1=1'
+        params = []
+        
+        if category:
+            query += ' AND category = ?'
+            params.append(category)
+        query += ' ORDER BY id'
+        
+        products = load_catalog(f'products:{category}', query, params)
+    categories = get_categories()
     
-    return render_template('products.html', products=products, categories=categories)
+    return render_template('products.html', products=products, categories=categories,
+                           page=page, has_next=has_next)
 
 @app.route('/product/<int:product_id>')
+@http_cache('public')
+@cache_page
 def product_detail(product_id):
     """Product detail page"""
-    conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
+    product = get_product(product_id)
     
     if product is None:
         flash('Product not found', 'error')
@@ -159,6 +2567,10 @@ def product_detail(product_id):
 def register():
     """User registration"""
     if request.method == 'POST':
+        throttled = auth_throttled('register.html')
+        if throttled:
+            return throttled
+        
         username = request.form['username']
         email = request.form['email']
         password = request.form['password']
@@ -174,20 +2586,21 @@ def register():
             'SELECT id FROM users WHERE username = ? OR email = ?',
             (username, email)
         ).fetchone()
+        conn.close()
         
         if existing_user:
             flash('Username or email already exists', 'error')
-            conn.close()
             return render_template('register.html')
         
         # Create new user
-        password_hash = generate_password_hash(password)
-        conn.execute(
+        try:
+            password_hash = hash_password(password)
+        except AuthBusyError:
+            return auth_busy('register.html')
+        db_write(lambda conn: conn.execute(
             'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
             (username, email, password_hash)
-        )
-        conn.commit()
-        conn.close()
+        ))
         
         flash('Registration successful! Please log in.', 'success')
         return redirect(url_for('login'))
@@ -198,6 +2611,10 @@ def register():
 def login():
     """User login"""
     if request.method == 'POST':
+        throttled = auth_throttled('login.html')
+        if throttled:
+            return throttled
+        
         username = request.form['username']
         password = request.form['password']
         
@@ -207,7 +2624,23 @@ def login():
         ).fetchone()
         conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = user is not None and verify_password(user['password_hash'], password)
+        except AuthBusyError:
+            return auth_busy('login.html')
+        
+        if valid and needs_rehash(user['password_hash']):
+            # Cost parameters changed since this hash was made; upgrade it while we know the password.
+            # Best effort: a busy pool or database only postpones it to a later login
+            try:
+                new_hash = hash_password(password)
+                db_write(lambda conn: conn.execute(
+                    'UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user['id'])
+                ))
+            except (AuthBusyError, *DB_ERRORS) as e:
+                logger.warning(f"Skipped password rehash for user {user['id']}: {e!r}")
+        
+        if valid:
             session['user_id'] = user['id']
             session['username'] = user['username']
             flash('Login successful!', 'success')
@@ -225,139 +2658,146 @@ def logout():
     return redirect(url_for('home'))
 
 @app.route('/cart')
+@http_cache('no-store')
 def cart():
     """Shopping cart page"""
-    if 'cart' not in session:
-        session['cart'] = []
-    
-    cart_items = []
-    total = 0
+    quote = price_cart(get_cart())
     
-    if session['cart']:
-        conn = get_db_connection()
-        cart_ids = [item['product_id'] for item in session['cart']]
-        placeholders = ','.join('?' * len(cart_ids))
-        products = conn.execute(
-            f'SELECT * FROM products WHERE id IN ({placeholders})', cart_ids
-        ).fetchall()
-        conn.close()
-        
-        for cart_item in session['cart']:
-            for product in products:
-                if product['id'] == cart_item['product_id']:
-                    item_total = product['price'] * cart_item['quantity']
-                    cart_items.append({
-                        'product': product,
-                        'quantity': cart_item['quantity'],
-                        'total': item_total
-                    })
-                    total += item_total
-                    break
-    
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    return render_template('cart.html', cart_items=quote['items'], total=quote['total'],
+                           tax=quote['tax'], grand_total=quote['grand_total'])
 
 @app.route('/add_to_cart/<int:product_id>')
 def add_to_cart(product_id):
     """Add product to cart"""
-    if 'cart' not in session:
-        session['cart'] = []
-    
     # Check if product exists
-    conn = get_db_connection()
-    product = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
-    conn.close()
+    product = get_product(product_id)
     
     if not product:
         flash('Product not found', 'error')
         return redirect(url_for('products'))
     
-    # Check if product already in cart
-    for item in session['cart']:
-        if item['product_id'] == product_id:
-            item['quantity'] += 1
-            break
-    else:
-        session['cart'].append({'product_id': product_id, 'quantity': 1})
-    
-    session.modified = True
+    add_cart_item(product_id)
     flash(f'{product["name"]} added to cart!', 'success')
     return redirect(url_for('products'))
 
 @app.route('/remove_from_cart/<int:product_id>')
 def remove_from_cart(product_id):
     """Remove product from cart"""
-    if 'cart' in session:
-        session['cart'] = [item for item in session['cart'] if item['product_id'] != product_id]
-        session.modified = True
+    if 'cart_id' in session:
+        remove_cart_item(product_id)
         flash('Item removed from cart', 'info')
     
     return redirect(url_for('cart'))
 
+@app.route('/api/cart/quote')
+@http_cache('no-store')
+def api_cart_quote():
+    """Priced contents of the current cart; money is returned as exact decimal strings"""
+    quote = price_cart(get_cart())
+    return jsonify({
+        'items': [{
+            'product_id': item['product']['id'],
+            'name': item['product']['name'],
+            'quantity': item['quantity'],
+            'unit_price': str(item['unit_price']),
+            'line_total': str(item['total']),
+        } for item in quote['items']],
+        'item_count': sum(item['quantity'] for item in quote['items']),
+        'total': str(quote['total']),
+        'tax': str(quote['tax']),
+        'grand_total': str(quote['grand_total']),
+        'unavailable': quote['missing'],
+    })
+
+STOCK_API_MAX_IDS = 100
+
+@app.route('/api/stock')
+@http_cache('no-store')
+def api_stock():
+    """Current stock for ?ids=1,2,3, read live so cached pages can show it
+
+    Units held for the caller's own cart count as available to them.
+    """
+    try:
+        ids = sorted({int(value) for value in request.args.get('ids', '').split(',') if value.strip()})
+    except ValueError:
+        raise APIError('ids must be comma-separated product ids')
+    if not 1 <= len(ids) <= STOCK_API_MAX_IDS:
+        raise APIError(f'ids must name between 1 and {STOCK_API_MAX_IDS} products')
+    placeholders = ', '.join('?' * len(ids))
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(f'''
+            SELECT p.id, p.stock + COALESCE(h.quantity, 0) AS stock FROM products p
+            LEFT JOIN stock_holds h ON h.product_id = p.id AND h.cart_id = ?
+            WHERE p.id IN ({placeholders})
+        ''', [session.get('cart_id', ''), *ids]).fetchall()
+    finally:
+        conn.close()
+    return jsonify({'stock': {str(row['id']): row['stock'] for row in rows}})
+
+def record_checkout(outcome):
+    if METRICS_ENABLED:
+        metric_child(CHECKOUTS, CHECKOUT_MODE, outcome).inc()
+
 @app.route('/checkout', methods=['GET', 'POST'])
+@http_cache('no-store')
 def checkout():
     """Checkout process"""
     if 'user_id' not in session:
         flash('Please log in to checkout', 'error')
         return redirect(url_for('login'))
     
-    if 'cart' not in session or not session['cart']:
+    idempotency_key = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+    if request.method == 'POST':
+        # A retried POST whose first attempt succeeded (and emptied the cart)
+        order_id = find_order_by_idempotency_key(session['user_id'], idempotency_key)
+        if order_id:
+            record_checkout('duplicate')
+            return redirect(url_for('order_confirmation', order_id=order_id))
+    
+    cart = get_cart()
+    if not cart:
+        if request.method == 'POST':
+            record_checkout('empty')
         flash('Your cart is empty', 'error')
         return redirect(url_for('cart'))
     
     if request.method == 'POST':
         # Process order
-        conn = get_db_connection()
-        
-        # Calculate total
-        cart_items = session['cart']
-        cart_ids = [item['product_id'] for item in cart_items]
-        placeholders = ','.join('?' * len(cart_ids))
-        products = conn.execute(
-            f'SELECT * FROM products WHERE id IN ({placeholders})', cart_ids
-        ).fetchall()
-        
-        total_amount = 0
-        order_items = []
-        
-        for cart_item in cart_items:
-            for product in products:
-                if product['id'] == cart_item['product_id']:
-                    item_total = product['price'] * cart_item['quantity']
-                    total_amount += item_total
-                    order_items.append({
-                        'product_id': product['id'],
-                        'quantity': cart_item['quantity'],
-                        'price': product['price']
-                    })
-                    break
-        
-        # Create order
-        cursor = conn.execute(
-            'INSERT INTO orders (user_id, total_amount) VALUES (?, ?)',
-            (session['user_id'], total_amount)
-        )
-        order_id = cursor.lastrowid
-        
-        # Add order items
-        for item in order_items:
-            conn.execute(
-                'INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)',
-                (order_id, item['product_id'], item['quantity'], item['price'])
-            )
-        
-        conn.commit()
-        conn.close()
+        try:
+            order_id, created = place_order(session['user_id'], cart, idempotency_key, cart_id=session.get('cart_id'))
+        except OutOfStockError as e:
+            record_checkout('out_of_stock')
+            products = fetch_products(e.product_ids)
+            names = ', '.join(product['name'] for product in products)
+            flash(f'Not enough stock for: {names}. Please update your cart.', 'error')
+            return redirect(url_for('cart'))
+        except EmptyOrderError:
+            record_checkout('empty')
+            clear_cart()
+            flash('The products in your cart are no longer available', 'error')
+            return redirect(url_for('cart'))
+        except Exception:
+            record_checkout('error')
+            raise
+        record_checkout('placed' if created else 'duplicate')
         
         # Clear cart
-        session['cart'] = []
-        session.modified = True
+        clear_cart()
         
         flash('Order placed successfully!', 'success')
         return redirect(url_for('order_confirmation', order_id=order_id))
     
-    return render_template('checkout.html')
+    short = hold_stock(session.get('cart_id'), cart)
+    if short:
+        names = ', '.join(product['name'] for product in fetch_products(short))
+        flash(f'Not enough stock to hold: {names}. Those items may sell out before you order.', 'info')
+    return render_template('checkout.html', quote=price_cart(cart), idempotency_key=secrets.token_urlsafe(16),
+                           hold_minutes=int(STOCK_HOLD_TTL // 60))
 
 @app.route('/order_confirmation/<int:order_id>')
+@http_cache('no-store')
 def order_confirmation(order_id):
     """Order confirmation page"""
     if 'user_id' not in session:
@@ -377,36 +2817,630 @@ def order_confirmation(order_id):
     
     return render_template('order_confirmation.html', order=order)
 
+@app.route('/api/orders/<int:order_id>/status')
+@http_cache('no-store')
+def api_order_status(order_id):
+    """Order status for polling while an async checkout is queued"""
+    if 'user_id' not in session:
+        raise APIError('Login required', 401)
+    conn = get_db_connection()
+    order = conn.execute(
+        'SELECT id, status FROM orders WHERE id = ? AND user_id = ?', (order_id, session['user_id'])
+    ).fetchone()
+    conn.close()
+    if order is None:
+        raise APIError('Order not found', 404)
+    return jsonify({'id': order['id'], 'status': order['status']})
+
+# Order history: newest first, paged with a (created_at, id) keyset cursor so a
+# page costs the same however many orders the user has
+ORDER_HISTORY_PAGE_SIZE = int(os.environ.get('ORDER_HISTORY_PAGE_SIZE', 20))
+ORDER_HISTORY_MAX_PAGE_SIZE = int(os.environ.get('ORDER_HISTORY_MAX_PAGE_SIZE', 100))
+
+def encode_order_cursor(order):
+    position = {'created_at': order['created_at'], 'id': order['id']}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+def decode_order_cursor(cursor):
+    """Decode an order history cursor into the (created_at, id) of the last order shown"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+        return str(position['created_at']), int(position['id'])
+    except (ValueError, KeyError, TypeError):
+        raise APIError('Invalid cursor')
+
+def fetch_order_items(conn, order_ids):
+    """Line items with their product names for several orders in one query, grouped by order id"""
+    items = {order_id: [] for order_id in order_ids}
+    if not order_ids:
+        return items
+    placeholders = ', '.join('?' * len(order_ids))
+    rows = conn.execute(f'''
+        SELECT oi.order_id, oi.product_id, oi.quantity, oi.price, p.name, p.image_url
+        FROM order_items oi LEFT JOIN products p ON p.id = oi.product_id
+        WHERE oi.order_id IN ({placeholders})
+        ORDER BY oi.order_id, oi.id
+    ''', list(order_ids)).fetchall()
+    for row in rows:
+        item = dict(row)
+        items[item.pop('order_id')].append(item)
+    return items
+
+def load_order_history(user_id, after=None, limit=None):
+    """One page of a user's orders, newest first, each with its items
+
+    Two queries per page whatever its size: the orders (a range scan of
+    idx_orders_user_created from the cursor) and all of their items.
+    Returns {'orders': [...], 'next_cursor': cursor or None}.
+    """
+    limit = limit or ORDER_HISTORY_PAGE_SIZE
+    query = 'SELECT id, total_amount, status, created_at FROM orders WHERE user_id = ?'
+    params = [user_id]
+    if after:
+        query += ' AND (created_at, id) < (?, ?)'
+        params.extend(after)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    
+    conn = get_db_connection()
+    try:
+        orders = rows_to_dicts(conn.execute(query, params).fetchall())
+        has_more = len(orders) > limit
+        orders = orders[:limit]
+        items = fetch_order_items(conn, [order['id'] for order in orders])
+    finally:
+        conn.close()
+    for order in orders:
+        order['items'] = items[order['id']]
+    return {'orders': orders, 'next_cursor': encode_order_cursor(orders[-1]) if has_more else None}
+
 @app.route('/orders')
+@http_cache('private')
 def orders():
     """User's order history"""
     if 'user_id' not in session:
         flash('Please log in to view orders', 'error')
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    orders = conn.execute(
-        'SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC',
-        (session['user_id'],)
-    ).fetchall()
-    conn.close()
+    try:
+        after = decode_order_cursor(request.args.get('cursor'))
+    except APIError:
+        return redirect(url_for('orders'))
+    history = load_order_history(session['user_id'], after)
     
-    return render_template('orders.html', orders=orders)
+    return render_template('orders.html', orders=history['orders'], next_cursor=history['next_cursor'])
+
+@app.route('/api/orders')
+@http_cache('private')
+def api_orders():
+    """Order history API: ?cursor= from the previous page's next_cursor, ?limit= orders per page"""
+    if 'user_id' not in session:
+        raise APIError('Login required', 401)
+    limit = request.args.get('limit', ORDER_HISTORY_PAGE_SIZE, type=int)
+    if not 1 <= limit <= ORDER_HISTORY_MAX_PAGE_SIZE:
+        raise APIError(f'limit must be between 1 and {ORDER_HISTORY_MAX_PAGE_SIZE}')
+    return jsonify(load_order_history(session['user_id'], decode_order_cursor(request.args.get('cursor')), limit))
 
 @app.route('/api/products')
+@http_cache('public')
 def api_products():
     """API endpoint for products"""
-    conn = get_db_connection()
-    products = conn.execute('SELECT * FROM products').fetchall()
-    conn.close()
+    products = load_catalog('api_products', 'SELECT * FROM products ORDER BY id')
+    
+    return jsonify(products)
+
+# Products API v2
+PRODUCT_FIELDS = ('id', 'sku', 'name', 'description', 'price', 'stock', 'category', 'image_url', 'created_at')
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 50))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 500))
+API_STREAM_BATCH = int(os.environ.get('API_STREAM_BATCH', 1000))
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode an opaque keyset cursor into the last id already returned"""
+    if not cursor:
+        return 0
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))['id'])
+    except (ValueError, KeyError, TypeError):
+        raise APIError('Invalid cursor')
+
+def parse_fields(value):
+    """Validate ?fields= against the product columns; id is always included for cursors"""
+    if not value:
+        return PRODUCT_FIELDS
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = sorted(set(fields) - set(PRODUCT_FIELDS))
+    if unknown:
+        raise APIError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(['id', *fields]))
+
+def iter_product_batches(fields, category=None, after_id=0, batch_size=None, cache_key=None):
+    """Yield lists of product dicts in id order using keyset pagination
+
+    cache_key names the catalog cache entry the rows are loaded for, if any.
+    """
+    batch_size = batch_size or API_STREAM_BATCH
+    query = f"SELECT {', '.join(fields)} FROM products WHERE id > ?"
+    if category:
+        query += ' AND category = ?'
+    query += ' ORDER BY id LIMIT ?'
+    while True:
+        params = [after_id, category, batch_size] if category else [after_id, batch_size]
+        conn = catalog_connection(cache_key) if cache_key else get_db_connection(readonly=True)
+        try:
+            rows = rows_to_dicts(conn.execute(query, params).fetchall())
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1]['id']
+
+def load_product_page(fields, category, after_id, limit):
+    """One keyset page plus a content ETag, cached with the rest of the catalog"""
+    key = f"api_v2:{category}:{after_id}:{limit}:{','.join(fields)}"
+
+    def loader():
+        batches = iter_product_batches(fields, category, after_id, batch_size=limit + 1, cache_key=key)
+        rows = next(batches, [])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        page = {
+            'items': rows,
+            'next_cursor': encode_cursor(rows[-1]['id']) if has_more else None,
+        }
+        body = json.dumps(page, separators=(',', ':'))
+        return {'body': body, 'etag': hashlib.sha1(body.encode()).hexdigest()}
+    return catalog_cache.get_or_load(key, loader)
+
+def stream_products(fields, category, after_id, fmt):
+    """Generator producing the whole catalog as NDJSON lines or one JSON array"""
+    first = True
+    if fmt == 'array':
+        yield '['
+    for rows in iter_product_batches(fields, category, after_id):
+        for row in rows:
+            if fmt == 'ndjson':
+                yield json.dumps(row, separators=(',', ':')) + '\n'
+            else:
+                yield ('' if first else ',') + json.dumps(row, separators=(',', ':'))
+            first = False
+    if fmt == 'array':
+        yield ']'
+
+@app.route('/api/v2/products')
+@http_cache('public')
+def api_products_v2():
+    """Paginated products API with keyset cursors, field selection and streaming"""
+    fields = parse_fields(request.args.get('fields'))
+    category = request.args.get('category') or None
+    after_id = decode_cursor(request.args.get('cursor'))
+    fmt = request.args.get('format', 'page')
+    
+    if fmt in ('ndjson', 'array'):
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+        return Response(stream_with_context(stream_products(fields, category, after_id, fmt)), mimetype=mimetype)
+    if fmt != 'page':
+        raise APIError("format must be one of 'page', 'ndjson', 'array'")
     
-    return jsonify([dict(product) for product in products])
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    if not 1 <= limit <= API_MAX_PAGE_SIZE:
+        raise APIError(f'limit must be between 1 and {API_MAX_PAGE_SIZE}')
+    
+    page = load_product_page(fields, category, after_id, limit)
+    if request.if_none_match.contains_weak(page['etag']):
+        return Response(status=304, headers={'ETag': f'"{page["etag"]}"'})
+    response = Response(page['body'], mimetype='application/json')
+    response.set_etag(page['etag'])
+    return response
+
+# Catalog bulk import/export. Files are streamed in chunks so memory stays bounded
+# whatever the catalog size; each chunk is one executemany in its own write transaction
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 50000))
+IMPORT_MAX_ERRORS = 20  # rejected records quoted in an import report
+# Bearer token for /api/catalog/import and /export; unset disables both
+CATALOG_API_TOKEN = os.environ.get('CATALOG_API_TOKEN')
+CATALOG_FIELDS = ('sku', 'name', 'description', 'price', 'stock', 'category', 'image_url')
+CATALOG_FORMATS = ('csv', 'ndjson', 'parquet')
+
+PRODUCT_UPSERT = '''
+    INSERT INTO products (sku, name, description, price, stock, category, image_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (sku) DO UPDATE SET
+        name = excluded.name, description = excluded.description, price = excluded.price,
+        stock = excluded.stock, category = excluded.category, image_url = excluded.image_url
+'''
+
+def _parquet():
+    try:
+        import pyarrow.parquet
+    except ImportError:  # optional, and imported on first use: it is slow to load
+        raise ValueError('Parquet files need pyarrow (pip install pyarrow)')
+    return pyarrow.parquet
+
+def catalog_format(path, fmt=None):
+    """Explicit format, else the one named by the file extension"""
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    fmt = {'jsonl': 'ndjson', 'pq': 'parquet'}.get(fmt, fmt)
+    if fmt not in CATALOG_FORMATS:
+        raise ValueError(f"Unknown catalog format '{fmt}', expected one of {', '.join(CATALOG_FORMATS)}")
+    return fmt
+
+def read_product_records(source, fmt, batch_size=None):
+    """Yield product dicts from a text stream (csv, ndjson) or a file path (parquet)"""
+    if fmt == 'csv':
+        yield from csv.DictReader(source)
+    elif fmt == 'ndjson':
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        parquet_file = _parquet().ParquetFile(source)
+        columns = [name for name in parquet_file.schema_arrow.names if name in CATALOG_FIELDS]
+        for batch in parquet_file.iter_batches(batch_size=batch_size or IMPORT_CHUNK_SIZE, columns=columns):
+            yield from batch.to_pylist()
+
+def product_row(record):
+    """Validate an imported record into the PRODUCT_UPSERT parameters"""
+    sku = str(record.get('sku') or '').strip()
+    name = str(record.get('name') or '').strip()
+    if not sku or not name:
+        raise ValueError('sku and name are required')
+    price = float(record.get('price'))
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f'invalid price {record.get("price")!r}')
+    stock = int(record.get('stock') or 0)
+    if stock < 0:
+        raise ValueError(f'invalid stock {stock}')
+    return (sku, name, record.get('description') or None, round(price, 2), stock,
+            record.get('category') or None, record.get('image_url') or None)
+
+def _drop_deferred_indexes(conn):
+    """Drop the products indexes and search triggers that are cheaper to rebuild once than to maintain per row"""
+    if sql_dialect(conn) == 'postgresql':
+        rows = conn.execute('''
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = 'products' AND indexname NOT IN ('products_pkey', 'idx_products_sku')
+        ''').fetchall()
+        for row in rows:
+            conn.execute(f"DROP INDEX {row['indexname']}")
+        return [row['indexdef'] for row in rows]
+    rows = conn.execute('''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE tbl_name = 'products' AND type IN ('index', 'trigger')
+          AND sql IS NOT NULL AND name != 'idx_products_sku'
+    ''').fetchall()
+    for row in rows:
+        conn.execute(f"DROP {row['type'].upper()} {row['name']}")
+    return [row['sql'] for row in rows]
+
+def _restore_deferred_indexes(conn, statements):
+    for statement in statements:
+        conn.execute(statement)
+    if sql_dialect(conn) == 'sqlite':
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+def import_products(records, chunk_size=None, defer_indexes=False, progress=None):
+    """Upsert product records by SKU and return a load report with throughput
+
+    With defer_indexes the category index and search triggers are dropped for
+    the load and rebuilt once at the end (also when the load fails). Chunks
+    committed before a failure stay committed. Invalid records are counted and
+    skipped; progress(report) is called after every chunk.
+    """
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    report = {'rows': 0, 'rejected': 0, 'errors': []}
+    start = time.perf_counter()
+
+    def write(chunk):
+        db_write(lambda conn: conn.executemany(PRODUCT_UPSERT, chunk))
+        report['rows'] += len(chunk)
+        report['seconds'] = round(time.perf_counter() - start, 3)
+        report['rows_per_second'] = round(report['rows'] / max(time.perf_counter() - start, 1e-9))
+        if progress:
+            progress(report)
+
+    deferred = db_write(_drop_deferred_indexes) if defer_indexes else []
+    try:
+        chunk = []
+        for number, record in enumerate(records, 1):
+            try:
+                chunk.append(product_row(record))
+            except (ValueError, TypeError, AttributeError) as e:
+                report['rejected'] += 1
+                if len(report['errors']) < IMPORT_MAX_ERRORS:
+                    report['errors'].append(f'record {number}: {e}')
+                continue
+            if len(chunk) >= chunk_size:
+                write(chunk)
+                chunk = []
+        if chunk:
+            write(chunk)
+    finally:
+        if deferred:
+            db_write(lambda conn: _restore_deferred_indexes(conn, deferred))
+        invalidate_catalog()
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    report['rows_per_second'] = round(report['rows'] / max(report['seconds'], 1e-9))
+    return report
+
+def iter_catalog_rows(batch_size=None):
+    """Yield CATALOG_FIELDS dicts for the whole catalog in id order, one keyset batch at a time"""
+    for rows in iter_product_batches(('id', *CATALOG_FIELDS), batch_size=batch_size or IMPORT_CHUNK_SIZE):
+        for row in rows:
+            del row['id']
+        yield rows
+
+def export_products(fmt):
+    """Generator producing the catalog as CSV or NDJSON text, a batch at a time"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, CATALOG_FIELDS)
+        writer.writeheader()
+        for rows in iter_catalog_rows():
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    elif fmt == 'ndjson':
+        for rows in iter_catalog_rows():
+            yield ''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in rows)
+    else:
+        raise ValueError(f"Streaming export supports csv and ndjson, not '{fmt}'")
+
+def export_products_parquet(path):
+    """Write the catalog to a Parquet file, one row group per batch"""
+    parquet = _parquet()
+    import pyarrow
+    schema = pyarrow.schema([
+        ('sku', pyarrow.string()), ('name', pyarrow.string()), ('description', pyarrow.string()),
+        ('price', pyarrow.float64()), ('stock', pyarrow.int64()), ('category', pyarrow.string()),
+        ('image_url', pyarrow.string()),
+    ])
+    count = 0
+    with parquet.ParquetWriter(path, schema) as writer:
+        for rows in iter_catalog_rows():
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+            count += len(rows)
+    return count
+
+def require_bearer_token(token, name):
+    """Reject calls to an API that lack its bearer token; the API is off (404) while no token is set"""
+    if not token:
+        raise APIError(f'{name} API is disabled', 404)
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        raise APIError(f'Invalid {name.lower()} API token', 401)
+
+def require_catalog_token():
+    require_bearer_token(CATALOG_API_TOKEN, 'Catalog')
+
+@app.route('/api/catalog/import', methods=['POST'])
+def api_catalog_import():
+    """Bulk upsert products from a streamed CSV or NDJSON request body"""
+    require_catalog_token()
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        raise APIError("format must be 'csv' or 'ndjson'")
+    source = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', newline='')
+    defer_indexes = request.args.get('defer_indexes', 'false').lower() == 'true'
+    try:
+        report = import_products(read_product_records(source, fmt), defer_indexes=defer_indexes)
+    except (ValueError, csv.Error) as e:
+        raise APIError(f'Unreadable {fmt} body: {e}')
+    return jsonify(report)
+
+@app.route('/api/catalog/export')
+def api_catalog_export():
+    """Stream the whole catalog as CSV or NDJSON"""
+    require_catalog_token()
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('csv', 'ndjson'):
+        raise APIError("format must be 'csv' or 'ndjson'")
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_products(fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=products.{fmt}'})
+
+# Analytics API: reads the sales rollups only, never orders
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_LIMIT = 100
+
+def _analytics_day(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise APIError(f'{name} must be a YYYY-MM-DD date')
+
+@app.route('/api/analytics/revenue')
+def api_analytics_revenue():
+    """Orders, units and revenue per day for ?from=...&to=... (default: the last 30 days)"""
+    require_bearer_token(ANALYTICS_API_TOKEN, 'Analytics')
+    today = datetime.utcnow().date()
+    end = _analytics_day('to', today.isoformat())
+    start = _analytics_day('from', (today - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)).isoformat())
+    conn = get_db_connection()
+    try:
+        days = rows_to_dicts(conn.execute(
+            'SELECT day, orders, units, revenue FROM sales_daily WHERE day >= ? AND day <= ? ORDER BY day',
+            (start, end)
+        ).fetchall())
+    finally:
+        conn.close()
+    totals = {name: sum(day[name] for day in days) for name in ('orders', 'units', 'revenue')}
+    totals['revenue'] = round(totals['revenue'], 2)
+    for day in days:
+        day['revenue'] = round(day['revenue'], 2)
+    return jsonify({'from': start, 'to': end, 'days': days, 'totals': totals})
+
+# Top-N queries per dimension: key column and the label joined in for display
+ANALYTICS_TOP = {
+    'products': ('SELECT s.product_id, p.name, s.orders, s.units, s.revenue FROM sales_by_product s '
+                 'LEFT JOIN products p ON p.id = s.product_id'),
+    'categories': 'SELECT category, orders, units, revenue FROM sales_by_category s',
+    'customers': ('SELECT s.user_id, u.username, s.orders, s.units, s.revenue FROM sales_by_user s '
+                  'LEFT JOIN users u ON u.id = s.user_id'),
+}
+
+@app.route('/api/analytics/<any(products, categories, customers):dimension>')
+def api_analytics_top(dimension):
+    """Best sellers per product, category or customer: ?sort=revenue|units, ?limit=N"""
+    require_bearer_token(ANALYTICS_API_TOKEN, 'Analytics')
+    sort = request.args.get('sort', 'revenue')
+    if sort not in ('revenue', 'units'):
+        raise APIError("sort must be 'revenue' or 'units'")
+    limit = request.args.get('limit', 10, type=int)
+    if not 1 <= limit <= ANALYTICS_MAX_LIMIT:
+        raise APIError(f'limit must be between 1 and {ANALYTICS_MAX_LIMIT}')
+    conn = get_db_connection()
+    try:
+        rows = rows_to_dicts(conn.execute(
+            f'{ANALYTICS_TOP[dimension]} ORDER BY s.{sort} DESC LIMIT ?', (limit,)
+        ).fetchall())
+    finally:
+        conn.close()
+    for row in rows:
+        row['revenue'] = round(row['revenue'], 2)
+        if dimension == 'categories':
+            row['category'] = row['category'] or None
+    return jsonify({dimension: rows})
+
+# Health checks: /health is liveness (the process answers) and touches nothing;
+# /ready is readiness, built from dependency probes that run at most once per TTL
+HEALTH_PROBE_TTL = float(os.environ.get('HEALTH_PROBE_TTL', 5))
+HEALTH_POOL_MAX_IN_USE = int(os.environ.get('HEALTH_POOL_MAX_IN_USE', max(DB_POOL_SIZE, 1) * 4))
+HEALTH_QUEUE_MAX_DEPTH = int(os.environ.get('HEALTH_QUEUE_MAX_DEPTH', 1000))
+HEALTH_DISK_MIN_FREE_MB = float(os.environ.get('HEALTH_DISK_MIN_FREE_MB', 100))
+
+def probe_database():
+    """Round-trip to the database and confirm the schema is fully migrated"""
+    conn = get_db_connection()
+    try:
+        version = get_schema_version(conn)
+    finally:
+        conn.close()
+    latest = MIGRATIONS[-1][0]
+    return {'ok': version >= latest, 'schema_version': version, 'latest': latest}
+
+def probe_pool():
+    """Connections checked out of this worker's pool"""
+    stats = get_pool().stats() if DB_POOL_SIZE > 0 else {'in_use': 0, 'idle': 0, 'size': 0}
+    return {'ok': stats['in_use'] < HEALTH_POOL_MAX_IN_USE, 'in_use': stats['in_use'],
+            'idle': stats['idle'], 'limit': HEALTH_POOL_MAX_IN_USE}
+
+def probe_order_queue():
+    """Backlog of async checkouts waiting for an order worker"""
+    depth = order_queue.depth()
+    return {'ok': depth <= HEALTH_QUEUE_MAX_DEPTH, 'depth': depth, 'limit': HEALTH_QUEUE_MAX_DEPTH}
+
+def probe_disk():
+    """Free space on the volume holding the database"""
+    if is_postgres(DATABASE):
+        return {'ok': True, 'skipped': 'database is on a server'}
+    free_mb = shutil.disk_usage(os.path.dirname(os.path.abspath(DATABASE))).free / 1048576
+    return {'ok': free_mb >= HEALTH_DISK_MIN_FREE_MB, 'free_mb': round(free_mb, 1),
+            'limit_mb': HEALTH_DISK_MIN_FREE_MB}
+
+class HealthProbes:
+    """Run dependency probes and cache the combined result
+
+    At most one refresh runs at a time per process; callers arriving during
+    a refresh get the previous result rather than queueing behind it, so a
+    burst of checks costs one set of probes per TTL.
+    """
+
+    def __init__(self, probes, ttl=None):
+        self.probes = probes
+        self.ttl = HEALTH_PROBE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = 0.0
+        self.runs = 0
+
+    def check(self):
+        if self._result is not None and time.monotonic() - self._checked_at < self.ttl:
+            return self._result
+        if not self._lock.acquire(blocking=self._result is None):
+            return self._result
+        try:
+            if self._result is None or time.monotonic() - self._checked_at >= self.ttl:
+                self._result = self._run()
+                self._checked_at = time.monotonic()
+        finally:
+            self._lock.release()
+        return self._result
+
+    def _run(self):
+        checks = {}
+        for name, probe in self.probes.items():
+            start = time.perf_counter()
+            try:
+                result = probe()
+            except Exception as e:
+                result = {'ok': False, 'error': str(e)}
+            result['latency_ms'] = round((time.perf_counter() - start) * 1000, 2)
+            checks[name] = result
+        self.runs += 1
+        return {
+            'status': 'ready' if all(check['ok'] for check in checks.values()) else 'unavailable',
+            'checked_at': datetime.now().isoformat(),
+            'checks': checks,
+        }
+
+    def reset(self):
+        self._result = None
+
+health_probes = HealthProbes({
+    'database': probe_database,
+    'pool': probe_pool,
+    'order_queue': probe_order_queue,
+    'disk': probe_disk,
+})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint, aggregated across workers in multiprocess mode"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/debug/sql', methods=['GET', 'DELETE'])
+def debug_sql():
+    """Top statements by total time in the worker that answers (DELETE resets); only with SQL_PROFILE on"""
+    if not SQL_PROFILE:
+        raise APIError('SQL profiling is disabled', 404)
+    require_bearer_token(DEBUG_API_TOKEN, 'Debug')
+    if request.method == 'DELETE':
+        sql_profiler.reset()
+        return '', 204
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify({'slow_query_ms': SQL_SLOW_QUERY_MS, 'statements': sql_profiler.top(limit)})
 
 @app.route('/health')
 def health():
-    """Health check endpoint for load balancer"""
+    """Liveness check: the worker is up and answering requests"""
     return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()}), 200
 
+@app.route('/ready')
+def ready():
+    """Readiness check for load balancers: 503 while a dependency is unusable"""
+    result = health_probes.check()
+    return jsonify(result), 200 if result['status'] == 'ready' else 503
+
 @app.errorhandler(404)
 def not_found(error):
     """404 error handler"""
@@ -418,32 +3452,190 @@ def internal_error(error):
     logger.error(f"Internal server error: {error}")
     return render_template('500.html'), 500
 
-# Initialize database when app starts
+# Startup. Importing this module does no I/O; schema setup runs once per deployment
+# (`flask migrate`, or create_app() in a preloading master), never per request
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'true').lower() == 'true'
+_startup_lock = threading.Lock()
+_startup = {'done': False}
+
 def init_db_if_needed():
-    """Initialize database if it doesn't exist or is empty"""
+    """Migrate the database if it doesn't exist or its schema is out of date, return whether it did"""
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
-        # Check if tables exist
-        tables = conn.execute(
-            "SELECT name FROM sqlite_master WHERE type='table'"
-        ).fetchall()
+        version = get_schema_version(conn)
+    finally:
         conn.close()
-        
-        if not tables:
-            logger.info("Database is empty, initializing...")
-            init_db()
-    except Exception as e:
-        logger.info(f"Database needs initialization: {e}")
-        init_db()
-
-# Initialize database on app startup
-try:
-    init_db_if_needed()
-except Exception as e:
-    logger.error(f"Failed to initialize database: {e}")
+    if version >= MIGRATIONS[-1][0]:
+        return False
+    logger.info(f"Database schema at version {version}, migrating...")
+    init_db()
+    return True
+
+def create_app(auto_migrate=None):
+    """Finish startup and return the app, once per process tree
+
+    Servers should call this rather than import `app` directly, e.g.
+    `gunicorn --preload 'app:create_app()'`: it then runs in the master
+    only, and every forked worker inherits compiled templates and a
+    migrated schema instead of repeating the work.
+    """
+    with _startup_lock:
+        if _startup['done']:
+            return app
+        if AUTO_MIGRATE if auto_migrate is None else auto_migrate:
+            init_db_if_needed()
+        warm_templates()
+        # Connections opened here belong to the master, not to the workers forked from it
+        close_db_pools()
+        _startup['done'] = True
+    return app
+
+@app.cli.command('search-rebuild')
+def search_rebuild_command():
+    """Rebuild the product full-text search index"""
+    count = rebuild_search_index()
+    invalidate_catalog()
+    click.echo(f'Search index rebuilt for {count} products')
+
+@app.cli.command('order-worker')
+@click.option('--batch-size', type=int, default=None, help='Orders per transaction')
+@click.option('--drain', is_flag=True, help='Exit once the queue is empty')
+def order_worker_command(batch_size, drain):
+    """Process queued async checkouts"""
+    if drain:
+        processed = drain_order_queue(batch_size)
+        click.echo(f'Processed {len(processed)} queued orders')
+        return
+    click.echo('Order worker running, press Ctrl+C to stop')
+    run_order_worker(batch_size=batch_size)
+
+@app.cli.command('analytics-compact')
+@click.option('--batch-size', type=int, default=None, help='Orders per transaction')
+@click.option('--interval', type=float, default=None, help='Keep running, compacting every N seconds')
+def analytics_compact_command(batch_size, interval):
+    """Fold orders queued by ANALYTICS_ROLLUP=batch into the sales rollups"""
+    while True:
+        count = compact_sales(batch_size)
+        click.echo(f'Compacted {count} orders into the sales rollups')
+        if interval is None:
+            return
+        time.sleep(interval)
+
+@app.cli.command('analytics-backfill')
+@click.option('--chunk-size', type=int, default=None, help='Orders per transaction')
+def analytics_backfill_command(chunk_size):
+    """Rebuild the sales rollups from the orders tables"""
+    start = time.perf_counter()
+    
+    def progress(counted, position, high):
+        click.echo(f'{position}/{high} order ids scanned, {counted} orders counted', err=True)
+    counted = backfill_sales(chunk_size, progress=progress)
+    click.echo(f'Rebuilt sales rollups from {counted} orders in {time.perf_counter() - start:.1f}s')
+
+@app.cli.command('release-stock-holds')
+def release_stock_holds_command():
+    """Return the stock of expired checkout holds"""
+    click.echo(f'Released {release_expired_holds()} held units')
+
+@app.cli.command('purge-carts')
+def purge_carts_command():
+    """Delete carts untouched for longer than CART_TTL"""
+    click.echo(f'Purged {cart_store.purge_expired()} expired cart lines')
+
+@app.cli.command('cache-clear')
+def cache_clear_command():
+    """Invalidate the catalog cache in every worker sharing its backend"""
+    invalidate_catalog()
+    click.echo('Catalog cache invalidated')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist"""
+    manifest = build_assets()
+    click.echo(f'Built {len(manifest)} assets into {ASSET_DIST_DIR}'
+               + ('' if brotli else ' (gzip only, install Brotli for .br variants)'))
+
+@app.cli.command('import-products')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), default=None,
+              help='File format (default: from the extension; - reads stdin)')
+@click.option('--chunk-size', type=int, default=None, help='Rows per transaction')
+@click.option('--defer-indexes/--keep-indexes', default=True,
+              help='Rebuild the category index and search index once after the load')
+def import_products_command(path, fmt, chunk_size, defer_indexes):
+    """Upsert products by SKU from a CSV, NDJSON or Parquet file"""
+    try:
+        fmt = catalog_format(path, fmt or ('ndjson' if path == '-' else None))
+
+        def progress(report):
+            click.echo(f"{report['rows']} rows, {report['rows_per_second']} rows/s", err=True)
+
+        if fmt == 'parquet':
+            report = import_products(read_product_records(path, fmt, chunk_size), chunk_size, defer_indexes, progress)
+        else:
+            source = click.get_text_stream('stdin') if path == '-' else open(path, newline='', encoding='utf-8')
+            with source:
+                report = import_products(read_product_records(source, fmt), chunk_size, defer_indexes, progress)
+    except (ValueError, csv.Error) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Imported {report['rows']} products in {report['seconds']}s "
+               f"({report['rows_per_second']} rows/s), rejected {report['rejected']}")
+    for error in report['errors']:
+        click.echo(f'  {error}', err=True)
+
+@app.cli.command('export-products')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(CATALOG_FORMATS), default=None,
+              help='File format (default: from the extension; - writes stdout)')
+def export_products_command(path, fmt):
+    """Write the catalog to a CSV, NDJSON or Parquet file"""
+    try:
+        fmt = catalog_format(path, fmt or ('ndjson' if path == '-' else None))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    start = time.perf_counter()
+    if fmt == 'parquet':
+        try:
+            count = export_products_parquet(path)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo(f'Exported {count} products in {time.perf_counter() - start:.1f}s', err=True)
+        return
+    with (click.get_text_stream('stdout') if path == '-' else open(path, 'w', newline='', encoding='utf-8')) as out:
+        for text in export_products(fmt):
+            out.write(text)
+    click.echo(f'Exported the catalog in {time.perf_counter() - start:.1f}s', err=True)
+
+@app.cli.command('sql-profile')
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--requests', 'repeat', type=int, default=20, help='Times each path is requested')
+@click.option('--limit', type=int, default=10, help='Statements to show')
+def sql_profile_command(paths, repeat, limit):
+    """Request PATHS in-process with SQL profiling on and print the top statements by total time"""
+    global SQL_PROFILE
+    SQL_PROFILE = True
+    close_db_pools()  # reconnect with the profiling connection class
+    sql_profiler.reset()
+    client = app.test_client()
+    for _ in range(repeat):
+        for path in paths:
+            client.get(path)
+    click.echo(f"{'total ms':>10} {'calls':>7} {'mean ms':>9} {'rows':>8}  statement")
+    for stats in sql_profiler.top(limit):
+        click.echo(f"{stats['total_ms']:>10.2f} {stats['calls']:>7} {stats['mean_ms']:>9.3f} {stats['rows']:>8}  "
+                   f"{stats['sql'][:100]} {stats['parameters']}")
+
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None, help='Schema version to migrate to (default: latest)')
+def migrate_command(target):
+    """Apply pending schema migrations"""
+    version = migrate(target)
+    click.echo(f'Database {DATABASE} at schema version {version}')
 
 if __name__ == '__main__':
-    init_db()
+    create_app()
+    if CHECKOUT_MODE == 'async':
+        start_order_workers()
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for the Flask E-Commerce application
+
+Serves the same Flask routes from an asyncio server so that slow clients and
+idle keep-alive connections cost a coroutine rather than a whole worker.
+Request bodies are read and responses are written on the event loop; the
+route code itself runs on a bounded thread pool sized to the database
+connection pool, where it uses the same pooled database connections as the
+WSGI deployment.
+
+Usage:
+    uvicorn asgi:application --workers 4 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker --workers 4 asgi:application
+"""
+
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as app_module
+
+# Route handlers running at once per process; extra requests wait on the event loop
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', max(app_module.DB_POOL_SIZE, 1) * 2))
+# Response bytes coalesced before they are handed to the event loop
+ASGI_CHUNK_SIZE = int(os.environ.get('ASGI_CHUNK_SIZE', 64 * 1024))
+# Chunks buffered per streaming response before the route thread waits for the client
+ASGI_STREAM_BUFFER = int(os.environ.get('ASGI_STREAM_BUFFER', 16))
+
+_END = object()
+
+
+class WSGIBridge:
+    """Run a WSGI application behind an ASGI server on a bounded thread pool"""
+
+    def __init__(self, wsgi_app, threads=None):
+        self.wsgi_app = wsgi_app
+        self.threads = threads or ASGI_THREADS
+        self._executor = None
+        self._pid = None
+
+    @property
+    def executor(self):
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+            self._pid = os.getpid()
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise NotImplementedError(f"Unsupported ASGI scope type '{scope['type']}'")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if app_module.CHECKOUT_MODE == 'async':
+                    app_module.start_order_workers()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                app_module.close_db_pools()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    def _environ(self, scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': (path or '/').encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                environ['CONTENT_LENGTH'] = value
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def _watch_disconnect(self, receive, task):
+        """Cancel the response task when the client goes away mid-response"""
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        task.cancel()
+
+    def _run(self, environ, loop, queue, cancelled):
+        """Call the WSGI app on a pool thread, pushing the start line and body chunks to the event loop
+
+        Stops producing once `cancelled` is set, so a client that went away
+        never leaves the thread blocked on a full queue.
+        """
+        def put(item):
+            if cancelled.is_set():
+                return
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    return future.result(timeout=1)
+                except FutureTimeoutError:
+                    if cancelled.is_set():
+                        future.cancel()
+                        return
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = (int(status.split(' ', 1)[0]), headers)
+
+        def flush(buffer):
+            if not response.get('sent'):
+                put(response['start'])
+                response['sent'] = True
+            if buffer:
+                put(b''.join(buffer))
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                buffer = []
+                buffered = 0
+                for chunk in iterable:
+                    if cancelled.is_set():
+                        break
+                    if not chunk:
+                        continue
+                    buffer.append(chunk)
+                    buffered += len(chunk)
+                    if buffered >= ASGI_CHUNK_SIZE:
+                        flush(buffer)
+                        buffer, buffered = [], 0
+                flush(buffer)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            put(_END)
+
+    async def _http(self, scope, receive, send):
+        body = await self._read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=ASGI_STREAM_BUFFER)
+        cancelled = threading.Event()
+        job = loop.run_in_executor(self.executor, self._run, self._environ(scope, body), loop, queue, cancelled)
+        task = asyncio.current_task()
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, task))
+
+        started = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, tuple):
+                    status, headers = item
+                    await send({
+                        'type': 'http.response.start',
+                        'status': status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers],
+                    })
+                    started = True
+                else:
+                    await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+            await job  # re-raise errors from the route thread
+        except BaseException:
+            # Client gone (failed send or http.disconnect) or server shutting down: stop the
+            # route thread, which closes its iterable, and unblock a put it may be waiting on
+            cancelled.set()
+            while not queue.empty():
+                queue.get_nowait()
+            if watcher.done() and not watcher.cancelled():
+                task.uncancel()
+                return
+            raise
+        finally:
+            watcher.cancel()
+        if started:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+application = WSGIBridge(app_module.create_app())
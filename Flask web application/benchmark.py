@@ -0,0 +1,1297 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Flask E-Commerce application
+Runs against a temporary database so the local ecommerce.db is never touched.
+
+Usage:
+    python benchmark.py pool [--requests N] [--threads N]
+    python benchmark.py contention [--writers N] [--readers M] [--checkouts N] [--profiles ...]
+    python benchmark.py indexes [--rows 10000 1000000 ...]
+    python benchmark.py search [--products 10000 1000000 ...]
+    python benchmark.py cache [--requests N] [--threads N] [--backends none local sqlite]
+    python benchmark.py stream [--products 10000 100000 ...]
+    python benchmark.py pricing [--lines 1 10 100 1000]
+    python benchmark.py flash-sale [--buyers N] [--stock N] [--processes N] [--mode sync|async]
+    python benchmark.py login-storm [--attackers N] [--readers N] [--seconds N]
+    python benchmark.py startup [--runs N]
+    python benchmark.py metrics [--requests N] [--rounds N]
+    python benchmark.py render [--requests N] [--products N]
+    python benchmark.py asgi [--connections 10 100 1000] [--seconds N] [--workers N]
+    python benchmark.py http-cache [--requests N] [--products N] [--mbps N]
+    python benchmark.py import [--products 100000 1000000 ...]
+    python benchmark.py orders [--orders 1000 10000 50000 ...]
+    python benchmark.py analytics [--orders 10000 1000000 ...]
+    python benchmark.py load [--users N] [--seconds N] [--products N] [--save-baseline] [--tolerance 0.2]
+"""
+
+import argparse
+import asyncio
+import csv
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as app_module
+
+
+CATEGORIES = ['Electronics', 'Home', 'Clothing', 'Books', 'Toys', 'Garden', 'Sports', 'Beauty']
+SEED_CHUNK = 50000
+
+
+@contextmanager
+def temporary_database(schema_version=None):
+    """Point the app at a fresh, initialized database for the duration of a benchmark"""
+    db_fd, db_path = tempfile.mkstemp(suffix='.db')
+    original_database = app_module.DATABASE
+    app_module.DATABASE = db_path
+    try:
+        app_module.migrate(schema_version)
+        yield db_path
+    finally:
+        app_module.close_db_pools()
+        app_module.DATABASE = original_database
+        os.close(db_fd)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+def _chunks(rows, size=SEED_CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+WORDS = ['wireless', 'premium', 'compact', 'ergonomic', 'stainless', 'organic', 'portable', 'vintage',
+         'laptop', 'kettle', 'backpack', 'lamp', 'jacket', 'speaker', 'blender', 'camera', 'desk', 'novel']
+
+
+def seed_products(count, seed=42):
+    """Insert `count` synthetic products with searchable names and descriptions"""
+    rng = random.Random(seed)
+    conn = app_module.get_db_connection()
+    try:
+        for chunk in _chunks(
+            (' '.join(rng.sample(WORDS, 2)).title() + f' {i}', ' '.join(rng.choices(WORDS, k=8)),
+             round(rng.uniform(1, 500), 2), rng.randint(0, 100), rng.choice(CATEGORIES))
+            for i in range(count)
+        ):
+            conn.executemany(
+                'INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)', chunk
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def seed_synthetic(orders, seed=42):
+    """Fill the current database with `orders` orders plus proportional users, products and items"""
+    rng = random.Random(seed)
+    users = max(orders // 50, 10)
+    products = max(orders // 100, 100)
+    conn = app_module.get_db_connection()
+    try:
+        conn.executemany(
+            'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+            ((f'user{i}', f'user{i}@example.com', 'x') for i in range(users))
+        )
+        conn.executemany(
+            'INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)',
+            ((f'Product {i}', f'Synthetic product number {i}', round(rng.uniform(1, 500), 2),
+              rng.randint(0, 100), rng.choice(CATEGORIES)) for i in range(products))
+        )
+        for chunk in _chunks(
+            (rng.randint(1, users), round(rng.uniform(5, 1000), 2),
+             f'2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00')
+            for _ in range(orders)
+        ):
+            conn.executemany('INSERT INTO orders (user_id, total_amount, created_at) VALUES (?, ?, ?)', chunk)
+        for chunk in _chunks(
+            (order_id, rng.randint(1, products), rng.randint(1, 3), round(rng.uniform(1, 500), 2))
+            for order_id in range(1, orders + 1) for _ in range(2)
+        ):
+            conn.executemany(
+                'INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)', chunk
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    return {'users': users, 'products': products, 'orders': orders, 'order_items': orders * 2}
+
+
+def run_requests(path, total, threads=1):
+    """Issue `total` GET requests to `path` across `threads` test clients, return requests/sec"""
+    per_thread = max(total // threads, 1)
+    errors = []
+
+    def worker():
+        client = app_module.app.test_client()
+        for _ in range(per_thread):
+            response = client.get(path)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise RuntimeError(f'{len(errors)} failed requests to {path} (first status {errors[0]})')
+    return per_thread * threads / elapsed
+
+
+def bench_pool(args):
+    """Compare requests/sec with and without the connection pool"""
+    paths = ['/products', '/api/products']
+    original_size = app_module.DB_POOL_SIZE
+    results = {}
+
+    with temporary_database():
+        for label, size in (('unpooled', 0), ('pooled', original_size or 5)):
+            app_module.DB_POOL_SIZE = size
+            app_module.close_db_pools()
+            for path in paths:
+                run_requests(path, min(args.requests, 50), args.threads)  # warm up
+                results[(label, path)] = run_requests(path, args.requests, args.threads)
+        stats = app_module.pool_stats()
+    app_module.DB_POOL_SIZE = original_size
+
+    print(f"{'route':<16}{'unpooled req/s':>16}{'pooled req/s':>16}{'speedup':>10}")
+    for path in paths:
+        before = results[('unpooled', path)]
+        after = results[('pooled', path)]
+        print(f'{path:<16}{before:>16.1f}{after:>16.1f}{after / before:>9.2f}x')
+    for pool in stats:
+        print(f"pool: created={pool['created']} reused={pool['reused']} discarded={pool['discarded']}")
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(int(round(pct / 100 * len(ordered) + 0.5)) - 1, len(ordered) - 1)
+    return ordered[max(index, 0)]
+
+
+def _checkout_worker(user_id, checkouts, results):
+    """Place `checkouts` orders as `user_id` and report (ok, failed, seconds)"""
+    client = app_module.app.test_client()
+    ok = failed = 0
+    start = time.perf_counter()
+    for i in range(checkouts):
+        cart_id = f'bench-{os.getpid()}-{i}'
+        app_module.cart_store.add(cart_id, 1 + i % 5)
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['cart_id'] = cart_id
+        response = client.post('/checkout')
+        if response.status_code == 302:
+            ok += 1
+        else:
+            failed += 1
+    results.put(('writer', ok, failed, time.perf_counter() - start))
+
+
+def _catalog_reader(stop, results):
+    """Browse /products until told to stop and report per-request latencies"""
+    client = app_module.app.test_client()
+    latencies = []
+    failed = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = client.get('/products')
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            failed += 1
+    results.put(('reader', latencies, failed))
+
+
+def bench_contention(args):
+    """N concurrent checkout processes against M concurrent catalog readers, per tuning profile"""
+    ctx = multiprocessing.get_context('fork')
+    original_profile = app_module.DB_TUNING_PROFILE
+
+    print(f"{'profile':<10}{'orders/s':>10}{'failed':>8}{'read p50 ms':>13}{'read p95 ms':>13}{'read p99 ms':>13}")
+    for profile in args.profiles:
+        app_module.DB_TUNING_PROFILE = profile
+        with temporary_database():
+            conn = app_module.get_db_connection()
+            conn.execute(
+                "INSERT INTO users (username, email, password_hash) VALUES ('bench', 'bench@example.com', 'x')"
+            )
+            conn.commit()
+            user_id = conn.execute("SELECT id FROM users WHERE username = 'bench'").fetchone()['id']
+            conn.close()
+            app_module.close_db_pools()
+
+            results = ctx.Queue()
+            stop = ctx.Event()
+            readers = [ctx.Process(target=_catalog_reader, args=(stop, results)) for _ in range(args.readers)]
+            writers = [ctx.Process(target=_checkout_worker, args=(user_id, args.checkouts, results))
+                       for _ in range(args.writers)]
+            for proc in readers + writers:
+                proc.start()
+
+            collected = [results.get() for _ in writers]
+            stop.set()
+            collected += [results.get() for _ in readers]
+            for proc in readers + writers:
+                proc.join()
+
+        orders = sum(r[1] for r in collected if r[0] == 'writer')
+        failed = sum(r[2] for r in collected if r[0] in ('writer', 'reader'))
+        elapsed = max(r[3] for r in collected if r[0] == 'writer')
+        latencies = [sample for r in collected if r[0] == 'reader' for sample in r[1]]
+        print(f'{profile:<10}{orders / elapsed:>10.1f}{failed:>8}'
+              f'{percentile(latencies, 50) * 1000:>13.2f}'
+              f'{percentile(latencies, 95) * 1000:>13.2f}'
+              f'{percentile(latencies, 99) * 1000:>13.2f}')
+    app_module.DB_TUNING_PROFILE = original_profile
+
+
+INDEX_QUERIES = [
+    ('orders by user', 'SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC', lambda n: (n['users'] // 2,)),
+    ('products by category', 'SELECT * FROM products WHERE category = ?', lambda n: ('Books',)),
+    ('items of order',
+     'SELECT oi.*, p.name FROM order_items oi JOIN products p ON p.id = oi.product_id WHERE oi.order_id = ?',
+     lambda n: (n['orders'] // 2,)),
+]
+
+
+def _time_query(conn, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def bench_indexes(args):
+    """Query plans and latency before/after the index migration at several data sizes"""
+    latest = app_module.MIGRATIONS[-1][0]
+    for rows in args.rows:
+        with temporary_database(schema_version=1):
+            sizes = seed_synthetic(rows)
+            conn = app_module.get_db_connection()
+            before = {name: _time_query(conn, sql, params(sizes), args.repeat) for name, sql, params in INDEX_QUERIES}
+            conn.close()
+
+            app_module.migrate(latest)
+            conn = app_module.get_db_connection()
+            conn.execute('ANALYZE')
+            print(f'\n== {rows} orders ({sizes["order_items"]} items, {sizes["products"]} products) ==')
+            print(f"{'query':<22}{'v1 ms':>10}{'v' + str(latest) + ' ms':>10}  plan")
+            for name, sql, params in INDEX_QUERIES:
+                after = _time_query(conn, sql, params(sizes), args.repeat)
+                plan = '; '.join(row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params(sizes)))
+                print(f'{name:<22}{before[name] * 1000:>10.3f}{after * 1000:>10.3f}  {plan}')
+            conn.close()
+
+
+def bench_search(args):
+    """LIKE '%term%' scans vs. the FTS5 index as the catalog grows"""
+    like_sql = 'SELECT * FROM products WHERE (name LIKE ? OR description LIKE ?) LIMIT ?'
+    print(f"{'products':>10}{'LIKE ms':>10}{'FTS ms':>10}")
+    for count in args.products:
+        with temporary_database():
+            seed_products(count)
+            conn = app_module.get_db_connection()
+            term = args.term
+            like_samples, fts_samples = [], []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                conn.execute(like_sql, (f'%{term}%', f'%{term}%', app_module.SEARCH_PAGE_SIZE)).fetchall()
+                like_samples.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                app_module.search_products(conn, term)
+                fts_samples.append(time.perf_counter() - start)
+            conn.close()
+        print(f'{count:>10}{statistics.median(like_samples) * 1000:>10.2f}'
+              f'{statistics.median(fts_samples) * 1000:>10.2f}')
+
+
+def bench_cache(args):
+    """Catalog route throughput per cache backend"""
+    paths = ['/', '/products', '/product/1', '/api/products']
+    original_cache = app_module.catalog_cache
+    results = {}
+    with temporary_database():
+        seed_products(args.products)
+        for backend in args.backends:
+            app_module.catalog_cache = app_module.create_catalog_cache(backend)
+            app_module.catalog_cache.clear()
+            for path in paths:
+                results[(backend, path)] = run_requests(path, args.requests, args.threads)
+            results[(backend, 'stats')] = app_module.catalog_cache.stats()
+    app_module.catalog_cache = original_cache
+
+    print(f"{'route':<16}" + ''.join(f'{backend + " req/s":>16}' for backend in args.backends))
+    for path in paths:
+        print(f'{path:<16}' + ''.join(f'{results[(backend, path)]:>16.1f}' for backend in args.backends))
+    for backend in args.backends:
+        stats = results[(backend, 'stats')]
+        print(f"{backend}: hit_rate={stats['hit_rate']:.3f} entries={stats['entries']}")
+
+
+def _measure_rss(path, results):
+    """Consume one response without keeping it and report the growth of peak RSS in KiB"""
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    client = app_module.app.test_client()
+    start = time.perf_counter()
+    response = client.get(path, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    elapsed = time.perf_counter() - start
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline, size, elapsed))
+
+
+def bench_stream(args):
+    """Peak RSS and latency of the full-catalog v1 endpoint vs. the streaming v2 endpoint"""
+    ctx = multiprocessing.get_context('fork')
+    paths = ['/api/products', '/api/v2/products?format=ndjson', '/api/v2/products?format=array']
+    original_cache = app_module.catalog_cache
+    app_module.catalog_cache = app_module.create_catalog_cache('none')
+    print(f"{'products':>10}  {'route':<34}{'peak RSS +KiB':>14}{'MiB out':>9}{'seconds':>9}")
+    for count in args.products:
+        with temporary_database():
+            seed_products(count)
+            app_module.close_db_pools()
+            for path in paths:
+                results = ctx.Queue()
+                proc = ctx.Process(target=_measure_rss, args=(path, results))
+                proc.start()
+                rss, size, elapsed = results.get()
+                proc.join()
+                print(f'{count:>10}  {path:<34}{rss:>14}{size / 1048576:>9.1f}{elapsed:>9.2f}')
+    app_module.catalog_cache = original_cache
+
+
+def _write_catalog_csv(path, count, seed=42):
+    """Write a synthetic catalog file in the import format"""
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(app_module.CATALOG_FIELDS)
+        for i in range(count):
+            writer.writerow((f'BENCH-{i:08d}', ' '.join(rng.sample(WORDS, 2)).title() + f' {i}',
+                             ' '.join(rng.choices(WORDS, k=8)), round(rng.uniform(1, 500), 2),
+                             rng.randint(0, 100), rng.choice(CATEGORIES), ''))
+
+
+def _timed_import(path, defer_indexes, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(path, newline='') as source:
+        report = app_module.import_products(app_module.read_product_records(source, 'csv'),
+                                            defer_indexes=defer_indexes)
+    results.put((report, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+
+
+def bench_import(args):
+    """Bulk CSV import throughput and memory, indexes maintained per row vs. rebuilt after the load"""
+    ctx = multiprocessing.get_context('fork')
+    print(f"{'products':>10}  {'indexes':<9}{'pass':<8}{'seconds':>9}{'rows/s':>10}{'peak RSS +KiB':>15}")
+    for count in args.products:
+        csv_fd, csv_path = tempfile.mkstemp(suffix='.csv')
+        os.close(csv_fd)
+        try:
+            _write_catalog_csv(csv_path, count)
+            for defer_indexes in (False, True):
+                with temporary_database():
+                    # Second pass hits existing SKUs, so it measures the update side of the upsert
+                    for label in ('insert', 'upsert'):
+                        app_module.close_db_pools()
+                        results = ctx.Queue()
+                        proc = ctx.Process(target=_timed_import, args=(csv_path, defer_indexes, results))
+                        proc.start()
+                        report, rss = results.get()
+                        proc.join()
+                        print(f"{count:>10}  {'deferred' if defer_indexes else 'kept':<9}{label:<8}"
+                              f"{report['seconds']:>9.2f}{report['rows_per_second']:>10}{rss:>15}")
+        finally:
+            os.unlink(csv_path)
+
+
+def _seed_power_user(orders, seed=42):
+    """One user with `orders` orders of two items each, spread over a year"""
+    rng = random.Random(seed)
+    base = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+    conn = app_module.get_db_connection()
+    try:
+        conn.execute("INSERT INTO users (username, email, password_hash) VALUES ('power', 'power@example.com', 'x')")
+        user_id = conn.execute("SELECT id FROM users WHERE username = 'power'").fetchone()[0]
+        for chunk in _chunks(
+            (user_id, round(rng.uniform(5, 1000), 2),
+             time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(base + rng.randint(0, 365 * 86400))))
+            for _ in range(orders)
+        ):
+            conn.executemany('INSERT INTO orders (user_id, total_amount, created_at) VALUES (?, ?, ?)', chunk)
+        for chunk in _chunks(
+            (order_id, rng.randint(1, 5), rng.randint(1, 3), round(rng.uniform(1, 500), 2))
+            for order_id in range(1, orders + 1) for _ in range(2)
+        ):
+            conn.executemany(
+                'INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)', chunk
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    return user_id
+
+
+def _full_history_with_items(user_id):
+    """The old order history (every order) with items loaded one order at a time"""
+    conn = app_module.get_db_connection()
+    try:
+        orders = conn.execute('SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC', (user_id,)).fetchall()
+        for order in orders:
+            conn.execute('SELECT oi.*, p.name FROM order_items oi LEFT JOIN products p ON p.id = oi.product_id '
+                         'WHERE oi.order_id = ?', (order['id'],)).fetchall()
+    finally:
+        conn.close()
+
+
+def bench_orders(args):
+    """Order history latency as one user's orders grow: full list + N+1 items vs. keyset pages"""
+    print(f"{'orders':>8}{'full+N+1 ms':>14}{'first page ms':>15}{'deep page ms':>14}")
+    for count in args.orders:
+        with temporary_database():
+            user_id = _seed_power_user(count)
+            # A cursor two thirds of the way down the history
+            page = app_module.load_order_history(user_id, limit=max(count * 2 // 3, 1))
+            deep = app_module.decode_order_cursor(page['next_cursor']) if page['next_cursor'] else None
+            timings = {'full': [], 'first': [], 'deep': []}
+            for _ in range(args.repeat):
+                for name, run in (('full', lambda: _full_history_with_items(user_id)),
+                                  ('first', lambda: app_module.load_order_history(user_id)),
+                                  ('deep', lambda: app_module.load_order_history(user_id, deep))):
+                    start = time.perf_counter()
+                    run()
+                    timings[name].append(time.perf_counter() - start)
+        medians = {name: statistics.median(samples) * 1000 for name, samples in timings.items()}
+        print(f"{count:>8}{medians['full']:>14.2f}{medians['first']:>15.2f}{medians['deep']:>14.2f}")
+
+
+ANALYTICS_QUERIES = [
+    ('revenue by day',
+     "SELECT substr(created_at, 1, 10) AS day, COUNT(*), SUM(total_amount) FROM orders "
+     "WHERE status NOT IN ('queued', 'rejected') GROUP BY day ORDER BY day",
+     'SELECT day, orders, revenue FROM sales_daily ORDER BY day'),
+    ('top 10 products',
+     'SELECT product_id, SUM(quantity) AS units, SUM(quantity * price) AS revenue FROM order_items '
+     'GROUP BY product_id ORDER BY revenue DESC LIMIT 10',
+     'SELECT product_id, units, revenue FROM sales_by_product ORDER BY revenue DESC LIMIT 10'),
+    ('revenue by category',
+     'SELECT p.category, SUM(oi.quantity * oi.price) FROM order_items oi JOIN products p ON p.id = oi.product_id '
+     'GROUP BY p.category',
+     'SELECT category, revenue FROM sales_by_category'),
+]
+
+
+def bench_analytics(args):
+    """Dashboard queries over the raw order tables vs. the sales rollups, and backfill throughput"""
+    for count in args.orders:
+        with temporary_database():
+            seed_synthetic(count)
+            start = time.perf_counter()
+            app_module.backfill_sales()
+            elapsed = time.perf_counter() - start
+            print(f'\n== {count} orders: backfill {elapsed:.2f}s ({count / elapsed:,.0f} orders/s) ==')
+            print(f"{'query':<22}{'scan ms':>10}{'rollup ms':>11}")
+            conn = app_module.get_db_connection()
+            for name, scan_sql, rollup_sql in ANALYTICS_QUERIES:
+                scan = _time_query(conn, scan_sql, (), args.repeat)
+                rollup = _time_query(conn, rollup_sql, (), args.repeat)
+                print(f'{name:<22}{scan * 1000:>10.2f}{rollup * 1000:>11.3f}')
+            conn.close()
+
+
+def _nested_loop_pricing(cart_items, products):
+    """The original O(n*m) matching from cart()/checkout(), kept as the baseline"""
+    total = 0
+    items = []
+    for cart_item in cart_items:
+        for product in products:
+            if product['id'] == cart_item['product_id']:
+                item_total = product['price'] * cart_item['quantity']
+                items.append({'product': product, 'quantity': cart_item['quantity'], 'total': item_total})
+                total += item_total
+                break
+    return items, total
+
+
+def bench_pricing(args):
+    """Nested-loop vs. hash-join cart pricing for carts of increasing size"""
+    rng = random.Random(42)
+    print(f"{'lines':>6}{'nested us':>12}{'hash-join us':>14}{'speedup':>10}")
+    for lines in args.lines:
+        products = [{'id': i, 'price': round(rng.uniform(1, 500), 2)} for i in range(1, lines + 1)]
+        rng.shuffle(products)
+        cart = {i: rng.randint(1, 5) for i in range(1, lines + 1)}
+        cart_items = [{'product_id': pid, 'quantity': qty} for pid, qty in cart.items()]
+
+        number = max(1, 20000 // lines)
+        nested = min(timeit.repeat(lambda: _nested_loop_pricing(cart_items, products),
+                                   number=number, repeat=3)) / number
+        hashed = min(timeit.repeat(lambda: app_module.price_lines(cart, {p['id']: p for p in products}),
+                                   number=number, repeat=3)) / number
+        print(f'{lines:>6}{nested * 1e6:>12.1f}{hashed * 1e6:>14.1f}{nested / hashed:>9.1f}x')
+
+
+def _flash_sale_buyers(user_ids, product_id, results):
+    """Each user in its own thread tries to buy one unit, retrying the POST once with the same key"""
+    outcomes = []
+
+    def buy(user_id):
+        client = app_module.app.test_client()
+        cart_id = f'flash-{user_id}'
+        app_module.cart_store.add(cart_id, product_id)
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['cart_id'] = cart_id
+        start = time.perf_counter()
+        key = f'flash-{user_id}'
+        response = client.post('/checkout', data={'idempotency_key': key})
+        client.post('/checkout', data={'idempotency_key': key})  # duplicate submit
+        location = response.headers.get('Location', '')
+        outcomes.append(('/order_confirmation/' in location, time.perf_counter() - start))
+
+    threads = [threading.Thread(target=buy, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(outcomes)
+
+
+def bench_flash_sale(args):
+    """Hundreds of concurrent buyers competing for a product with limited stock"""
+    ctx = multiprocessing.get_context('fork')
+    original_mode = app_module.CHECKOUT_MODE
+    app_module.CHECKOUT_MODE = args.mode
+    with temporary_database():
+        conn = app_module.get_db_connection()
+        conn.executemany(
+            'INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+            ((f'buyer{i}', f'buyer{i}@example.com', 'x') for i in range(args.buyers))
+        )
+        conn.execute('UPDATE products SET stock = ? WHERE id = 1', (args.stock,))
+        conn.commit()
+        user_ids = [row['id'] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+        conn.close()
+        app_module.close_db_pools()
+
+        results = ctx.Queue()
+        groups = [user_ids[i::args.processes] for i in range(args.processes)]
+        procs = [ctx.Process(target=_flash_sale_buyers, args=(group, 1, results)) for group in groups]
+        start = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        outcomes = [outcome for _ in procs for outcome in results.get()]
+        for proc in procs:
+            proc.join()
+        accepted = time.perf_counter() - start
+        app_module.drain_order_queue()  # finish anything the workers' order threads left queued
+        elapsed = time.perf_counter() - start
+
+        conn = app_module.get_db_connection()
+        final_stock = conn.execute('SELECT stock FROM products WHERE id = 1').fetchone()['stock']
+        orders = conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'pending'").fetchone()[0]
+        total_orders = conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+        units = conn.execute('SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id = 1').fetchone()[0]
+        conn.close()
+
+    app_module.CHECKOUT_MODE = original_mode
+
+    won = sum(1 for ok, _ in outcomes if ok)
+    latencies = [latency for _, latency in outcomes]
+    print(f'mode={args.mode} buyers={args.buyers} stock={args.stock} processes={args.processes} '
+          f'accepted in {accepted:.2f}s, settled in {elapsed:.2f}s')
+    print(f'orders confirmed={orders} of {total_orders} (buyers redirected to confirmation={won}) '
+          f'units sold={units} stock left={final_stock}')
+    print(f'checkout p50={percentile(latencies, 50) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms')
+    # Sync buyers only see a confirmation when they won; async buyers all get a queued order
+    expected_won = orders if args.mode == 'sync' else total_orders
+    consistent = (orders == units == args.stock - final_stock and final_stock >= 0
+                  and won == expected_won and total_orders <= args.buyers)
+    print('consistency: ' + ('OK' if consistent else 'OVERSOLD OR DUPLICATED'))
+    if not consistent:
+        sys.exit(1)
+
+
+def bench_login_storm(args):
+    """Catalog latency while a burst of logins competes for CPU, unbounded vs. bounded hashing"""
+    original_pool, original_limit = app_module.auth_pool, app_module.auth_rate_limiter.limit
+    app_module.auth_rate_limiter.limit = 10 ** 9  # measure hashing admission, not the per-IP limit
+    configs = [
+        ('none', None),
+        ('unbounded', app_module.HashingPool(workers=args.attackers, queue=args.attackers)),
+        ('bounded', app_module.HashingPool()),
+    ]
+    print(f"{'hashing':<11}{'logins/s':>10}{'turned away':>13}{'catalog p50 ms':>16}{'catalog p99 ms':>16}")
+    with temporary_database():
+        app_module.app.test_client().post('/register', data={
+            'username': 'storm', 'email': 'storm@example.com', 'password': 'storm-password'})
+        for label, pool in configs:
+            if pool is not None:
+                app_module.auth_pool = pool
+            stop = threading.Event()
+            logins, rejected, latencies = [], [], []
+
+            def attacker():
+                client = app_module.app.test_client()
+                while not stop.is_set():
+                    response = client.post('/login', data={'username': 'storm', 'password': 'storm-password'})
+                    (rejected if response.status_code == 503 else logins).append(1)
+
+            def reader():
+                client = app_module.app.test_client()
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    client.get('/products')
+                    latencies.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+            if pool is not None:
+                threads += [threading.Thread(target=attacker) for _ in range(args.attackers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            print(f'{label:<11}{len(logins) / args.seconds:>10.1f}{len(rejected):>13}'
+                  f'{percentile(latencies, 50) * 1000:>16.2f}{percentile(latencies, 99) * 1000:>16.2f}')
+    app_module.auth_pool, app_module.auth_rate_limiter.limit = original_pool, original_limit
+
+
+STARTUP_SCENARIOS = [
+    ('interpreter only', 'pass'),
+    ('import app', 'import app'),
+    ('create_app, migrated db', 'import app; app.create_app()'),
+    ('create_app, new db', 'import app; app.create_app()'),
+    ('first request, new process', "import app; app.create_app().test_client().get('/products')"),
+]
+
+
+def _time_process(code, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True, env=env,
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def _time_forked_request():
+    """First request served by a worker forked from this (preloaded) process"""
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = app_module.app.test_client().get('/products').status_code
+        os._exit(0 if status == 200 else 1)
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('forked worker failed its first request')
+    return time.perf_counter() - start
+
+
+def bench_startup(args):
+    """Cold start of a worker: fresh interpreter imports vs. fork from a preloaded master"""
+    print(f"{'scenario':<30}{'median ms':>12}{'min ms':>10}")
+    with temporary_database() as db_path:
+        for label, code in STARTUP_SCENARIOS:
+            samples = []
+            for _ in range(args.runs):
+                env = {**os.environ, 'DATABASE': db_path, 'CATALOG_CACHE_BACKEND': 'local'}
+                if label.endswith('new db'):
+                    fd, env['DATABASE'] = tempfile.mkstemp(suffix='.db')
+                    os.close(fd)
+                try:
+                    samples.append(_time_process(code, env))
+                finally:
+                    if label.endswith('new db'):
+                        for suffix in ('', '-wal', '-shm'):
+                            if os.path.exists(env['DATABASE'] + suffix):
+                                os.unlink(env['DATABASE'] + suffix)
+            print(f'{label:<30}{statistics.median(samples) * 1000:>12.1f}{min(samples) * 1000:>10.1f}')
+
+        app_module.create_app()
+        samples = [_time_forked_request() for _ in range(args.runs)]
+        print(f"{'first request, forked worker':<30}{statistics.median(samples) * 1000:>12.1f}"
+              f'{min(samples) * 1000:>10.1f}')
+
+
+def bench_metrics(args):
+    """Per-request cost of Prometheus instrumentation, best of alternating rounds"""
+    paths = ['/products', '/api/products', '/api/v2/products?limit=20', '/product/1', '/health']
+    original = app_module.METRICS_ENABLED
+    timings = {(enabled, path): [] for enabled in (False, True) for path in paths}
+    with temporary_database():
+        client = app_module.app.test_client()
+        for _ in range(args.rounds):
+            for enabled in (False, True):
+                app_module.METRICS_ENABLED = enabled
+                app_module.close_db_pools()  # connections pick their factory when opened
+                for path in paths:
+                    client.get(path)  # warm up
+                    start = time.process_time()
+                    for _ in range(args.requests):
+                        client.get(path)
+                    timings[(enabled, path)].append((time.process_time() - start) / args.requests)
+    app_module.METRICS_ENABLED = original
+
+    print(f"{'route':<30}{'off req/s':>12}{'on req/s':>12}{'overhead':>10}")
+    for path in paths:
+        off = min(timings[(False, path)])
+        on = min(timings[(True, path)])
+        print(f'{path:<30}{1 / off:>12.1f}{1 / on:>12.1f}{(on - off) / off * 100:>9.1f}%')
+
+
+def bench_render(args):
+    """CPU time per catalog page view with no HTML caching, fragment caching, and whole-page caching"""
+    paths = ['/', '/products', '/products?category=Electronics', '/product/1']
+    original = app_module.fragment_cache, app_module.PAGE_CACHE_TTL
+    modes = [
+        ('none', None, 0),
+        ('fragments', app_module.LocalCacheBackend(max_entries=app_module.FRAGMENT_CACHE_MAX_ENTRIES), 0),
+        ('fragments+page', app_module.LocalCacheBackend(max_entries=app_module.FRAGMENT_CACHE_MAX_ENTRIES),
+         app_module.PAGE_CACHE_TTL or 30),
+    ]
+    print(f"{'route':<34}" + ''.join(f'{label + " ms":>18}' for label, _, _ in modes))
+    results = {}
+    with temporary_database():
+        seed_products(args.products)
+        client = app_module.app.test_client()
+        for label, fragments, page_ttl in modes:
+            app_module.fragment_cache, app_module.PAGE_CACHE_TTL = fragments, page_ttl
+            app_module.catalog_cache.clear()
+            for path in paths:
+                client.get(path)  # warm up
+                start = time.process_time()
+                for _ in range(args.requests):
+                    client.get(path)
+                results[(label, path)] = (time.process_time() - start) / args.requests
+    app_module.fragment_cache, app_module.PAGE_CACHE_TTL = original
+    for path in paths:
+        print(f'{path:<34}' + ''.join(f'{results[(label, path)] * 1000:>18.3f}' for label, _, _ in modes))
+
+
+async def _read_response(reader, raw_headers=None):
+    """Read one HTTP/1.1 response, return (status, body, whether the server keeps the connection)
+
+    Header lines are appended to `raw_headers` as (lowercase name, value) when a list is given.
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed before response')
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+        if raw_headers is not None:
+            raw_headers.append((name.strip().lower(), value.strip()))
+
+    if headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        while True:
+            chunk_size = int((await reader.readline()).split(b';')[0], 16)
+            chunks.append((await reader.readexactly(chunk_size + 2))[:-2])
+            if chunk_size == 0:
+                break
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        return status, await reader.read(), False
+    return status, body, headers.get('connection') != 'close'
+
+
+async def _http_client(host, port, paths, deadline, latencies, errors):
+    """Issue keep-alive GETs in a loop until the deadline, reconnecting whenever the server closes"""
+    reader = writer = None
+    index = 0
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+            status, _, keep_alive = await _read_response(reader)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            errors.append('connection')
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.01)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(status)
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def http_load(host, port, paths, connections, seconds):
+    """Drive `connections` concurrent HTTP clients for `seconds`, return requests/sec, latencies and errors"""
+    latencies, errors = [], []
+
+    async def run():
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(_http_client(host, port, paths, deadline, latencies, errors)
+                               for _ in range(connections)))
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    return {'rps': len(latencies) / elapsed, 'latencies': latencies, 'errors': errors}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def serve(command, port, env=None, timeout=30):
+    """Run a server command in the background until it answers /health"""
+    proc = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, **(env or {})},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1).read()
+                break
+            except OSError:
+                if proc.poll() is not None or time.time() > deadline:
+                    raise RuntimeError(f"server did not start: {' '.join(command)}")
+                time.sleep(0.2)
+        yield proc
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+# Steps of one shopping session, in order; a browse-only visitor stops after add_to_cart
+FLOW_STEPS = ['home', 'products', 'search', 'product', 'add_to_cart', 'cart', 'checkout_page', 'checkout', 'orders']
+LOAD_PASSWORD = 'load-test-password'
+LOAD_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'load_baseline.json')
+
+
+def seed_load_data(products, accounts):
+    """Synthetic catalog with stock that outlasts the run, plus shopper accounts sharing one password"""
+    seed_products(products)
+    password_hash = app_module.hash_password(LOAD_PASSWORD)
+    conn = app_module.get_db_connection()
+    try:
+        conn.execute('UPDATE products SET stock = 1000000')
+        conn.executemany('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                         ((f'shopper{i}', f'shopper{i}@example.com', password_hash) for i in range(accounts)))
+        conn.commit()
+        product_ids = [row[0] for row in conn.execute('SELECT id FROM products')]
+    finally:
+        conn.close()
+    return product_ids
+
+
+class Shopper:
+    """One simulated user on a keep-alive connection, carrying its own session cookie"""
+
+    def __init__(self, host, port, username, product_ids, rng, latencies, errors):
+        self.host, self.port = host, port
+        self.username = username
+        self.product_ids = product_ids
+        self.rng = rng
+        self.latencies = latencies
+        self.errors = errors
+        self.cookies = {}
+        self.reader = self.writer = None
+
+    async def request(self, step, method, path, form=None, headers=None):
+        body = urllib.parse.urlencode(form).encode() if form else b''
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}']
+        if self.cookies:
+            lines.append('Cookie: ' + '; '.join(f'{name}={value}' for name, value in self.cookies.items()))
+        if method == 'POST':
+            lines += ['Content-Type: application/x-www-form-urlencoded', f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        start = time.perf_counter()
+        try:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+            raw_headers = []
+            status, content, keep_alive = await _read_response(self.reader, raw_headers)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+            self.errors.append((step, 'connection'))
+            self.close()
+            return None
+        if step is not None:
+            self.latencies.setdefault(step, []).append(time.perf_counter() - start)
+        for name, value in raw_headers:
+            if name == 'set-cookie':
+                cookie_name, _, cookie_value = value.split(';', 1)[0].partition('=')
+                self.cookies[cookie_name] = cookie_value
+        if status >= 400:
+            self.errors.append((step or 'login', status))
+        if not keep_alive:
+            self.close()
+        return content
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def login(self):
+        """Log in, untimed: password hashing is deliberately slow and would swamp the flow latencies"""
+        await self.request(None, 'POST', '/login', {'username': self.username, 'password': LOAD_PASSWORD})
+
+    async def shop(self, deadline, buy_ratio):
+        while time.perf_counter() < deadline:
+            product_id = self.rng.choice(self.product_ids)
+            await self.request('home', 'GET', '/')
+            await self.request('products', 'GET', '/products')
+            await self.request('search', 'GET', f'/products?search={self.rng.choice(WORDS)}')
+            await self.request('product', 'GET', f'/product/{product_id}')
+            await self.request('add_to_cart', 'GET', f'/add_to_cart/{product_id}')
+            if self.rng.random() >= buy_ratio:
+                continue
+            await self.request('cart', 'GET', '/cart')
+            await self.request('checkout_page', 'GET', '/checkout')
+            await self.request('checkout', 'POST', '/checkout',
+                               headers={'Idempotency-Key': f'{self.rng.getrandbits(64):016x}'})
+            await self.request('orders', 'GET', '/orders')
+        self.close()
+
+
+def run_shoppers(host, port, usernames, product_ids, seconds, buy_ratio, seed=42):
+    """Log in one shopper per username, then shop concurrently for `seconds`; return latencies, errors, elapsed"""
+    latencies, errors = {}, []
+    elapsed = {}
+
+    async def run():
+        shoppers = [Shopper(host, port, username, product_ids, random.Random(seed + i), latencies, errors)
+                    for i, username in enumerate(usernames)]
+        await asyncio.gather(*(shopper.login() for shopper in shoppers))
+        start = time.perf_counter()
+        await asyncio.gather(*(shopper.shop(start + seconds, buy_ratio) for shopper in shoppers))
+        elapsed['seconds'] = time.perf_counter() - start
+
+    asyncio.run(run())
+    return latencies, errors, elapsed['seconds']
+
+
+def summarize_load(latencies, errors, elapsed):
+    """Requests/sec and p50/p95/p99 in ms per step and for all steps together"""
+    summary = {}
+    everything = []
+    for step in FLOW_STEPS:
+        samples = latencies.get(step, [])
+        everything += samples
+        if samples:
+            summary[step] = _load_stats(samples, elapsed, sum(1 for error_step, _ in errors if error_step == step))
+    summary['total'] = _load_stats(everything, elapsed, len(errors))
+    return summary
+
+
+def _load_stats(samples, elapsed, error_count):
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / elapsed, 1),
+        'p50': round(percentile(samples, 50) * 1000, 2),
+        'p95': round(percentile(samples, 95) * 1000, 2),
+        'p99': round(percentile(samples, 99) * 1000, 2),
+        'errors': error_count,
+    }
+
+
+def load_regressions(summary, baseline, tolerance):
+    """Steps whose throughput fell, or whose p95 rose, by more than `tolerance` against the baseline"""
+    regressions = []
+    for step, base in baseline['steps'].items():
+        current = summary.get(step)
+        if current is None:
+            regressions.append(f'{step}: not measured')
+            continue
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{step}: {current['rps']} req/s vs. baseline {base['rps']}")
+        if current['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append(f"{step}: p95 {current['p95']} ms vs. baseline {base['p95']}")
+    if summary['total']['errors']:
+        regressions.append(f"{summary['total']['errors']} failed requests")
+    return regressions
+
+
+def bench_load(args):
+    """Shopping flows against the production gunicorn setup, compared with a stored baseline"""
+    config = {'users': args.users, 'seconds': args.seconds, 'products': args.products,
+              'workers': args.workers, 'buy_ratio': args.buy_ratio}
+    with temporary_database() as db_path, tempfile.TemporaryDirectory() as metrics_dir:
+        product_ids = seed_load_data(args.products, args.users)
+        app_module.close_db_pools()
+        port = _free_port()
+        # The Dockerfile's start command: gunicorn.conf.py, preloaded create_app(), no auto-migrate
+        env = {'DATABASE': db_path, 'PORT': str(port), 'WEB_CONCURRENCY': str(args.workers),
+               'AUTO_MIGRATE': 'false', 'PROMETHEUS_MULTIPROC_DIR': metrics_dir,
+               # Every shopper logs in from 127.0.0.1
+               'AUTH_RATE_LIMIT': str(args.users * 10)}
+        with serve([sys.executable, '-m', 'gunicorn', 'app:create_app()'], port, env=env):
+            usernames = [f'shopper{i}' for i in range(args.users)]
+            run_shoppers('127.0.0.1', port, usernames[:min(args.users, 4)], product_ids, 1, args.buy_ratio)  # warm up
+            latencies, errors, elapsed = run_shoppers('127.0.0.1', port, usernames, product_ids,
+                                                      args.seconds, args.buy_ratio)
+    summary = summarize_load(latencies, errors, elapsed)
+
+    print(f"{'step':<15}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for step, stats in summary.items():
+        print(f"{step:<15}{stats['requests']:>10}{stats['rps']:>9.1f}{stats['p50']:>9.1f}"
+              f"{stats['p95']:>9.1f}{stats['p99']:>9.1f}{stats['errors']:>8}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'steps': summary}, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}; record one with --save-baseline')
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['config'] != config:
+        print(f"Warning: baseline was recorded with {baseline['config']}")
+    regressions = load_regressions(summary, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+    print(f'No regressions beyond {args.tolerance:.0%} of the baseline')
+
+
+def bench_asgi(args):
+    """Throughput and latency of gunicorn sync workers vs. the ASGI entry point under uvicorn"""
+    paths = ['/products', '/api/products', '/health']
+    workers = str(args.workers)
+    servers = [
+        ('gunicorn sync', lambda port: [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+                                        '--workers', workers, '--backlog', '4096', '--preload',
+                                        'app:create_app()']),
+        ('uvicorn asgi', lambda port: [sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1',
+                                       '--port', str(port), '--workers', workers, '--backlog', '4096',
+                                       '--no-access-log', '--log-level', 'warning', 'asgi:application']),
+    ]
+    print(f"{'server':<15}{'conns':>7}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    with temporary_database() as db_path:
+        app_module.close_db_pools()
+        for label, command in servers:
+            port = _free_port()
+            with serve(command(port), port, env={'DATABASE': db_path}):
+                for connections in args.connections:
+                    http_load('127.0.0.1', port, paths, min(connections, 10), 1)  # warm up
+                    result = http_load('127.0.0.1', port, paths, connections, args.seconds)
+                    latencies = result['latencies']
+                    print(f"{label:<15}{connections:>7}{result['rps']:>10.1f}"
+                          f'{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 99) * 1000:>10.1f}'
+                          f"{len(result['errors']):>8}")
+
+
+def _timed_get(conn, path, headers):
+    """GET over a kept-alive connection, return (status, headers, wire bytes, TTFB s, total s)"""
+    start = time.perf_counter()
+    conn.request('GET', path, headers=headers)
+    response = conn.getresponse()
+    first_byte = time.perf_counter() - start
+    body = response.read()
+    return response.status, dict(response.getheaders()), len(body), first_byte, time.perf_counter() - start
+
+
+def bench_http_cache(args):
+    """Bytes on the wire and time to first byte per content coding, and for ETag revalidation"""
+    paths = ['/', '/products', '/product/1', '/api/products', '/api/v2/products?limit=200']
+    modes = [('identity', {}), ('gzip', {'Accept-Encoding': 'gzip'})]
+    if app_module.brotli is not None:
+        modes.append(('br', {'Accept-Encoding': 'br, gzip'}))
+    modes.append(('revalidate', {'Accept-Encoding': 'br, gzip'}))
+    print(f"{'route':<28}{'mode':<12}{'status':>7}{'bytes':>9}{'TTFB ms':>9}{'total ms':>10}"
+          f"{f'@{args.mbps:g}Mbit ms':>14}")
+    with temporary_database() as db_path:
+        seed_products(args.products)
+        app_module.close_db_pools()
+        port = _free_port()
+        command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', '1',
+                   'app:create_app()']
+        with serve(command, port, env={'DATABASE': db_path}):
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            for path in paths:
+                for mode, headers in modes:
+                    if mode == 'revalidate':
+                        etag = _timed_get(conn, path, headers)[1].get('ETag')
+                        headers = {**headers, 'If-None-Match': etag} if etag else headers
+                    samples = [_timed_get(conn, path, headers) for _ in range(args.requests)]
+                    status, _, size = samples[-1][:3]
+                    first_byte = statistics.median(sample[3] for sample in samples)
+                    total = statistics.median(sample[4] for sample in samples)
+                    # Loopback hides transfer time; estimate it for a client link of --mbps
+                    link = total + size * 8 / (args.mbps * 1e6)
+                    print(f'{path:<28}{mode:<12}{status:>7}{size:>9}{first_byte * 1000:>9.2f}'
+                          f'{total * 1000:>10.2f}{link * 1000:>14.2f}')
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask E-Commerce benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pool_parser = subparsers.add_parser('pool', help='connection pool vs. connect-per-query')
+    pool_parser.add_argument('--requests', type=int, default=2000)
+    pool_parser.add_argument('--threads', type=int, default=4)
+    pool_parser.set_defaults(func=bench_pool)
+
+    contention_parser = subparsers.add_parser('contention', help='concurrent checkouts vs. catalog readers')
+    contention_parser.add_argument('--writers', type=int, default=4)
+    contention_parser.add_argument('--readers', type=int, default=4)
+    contention_parser.add_argument('--checkouts', type=int, default=100, help='orders per writer')
+    contention_parser.add_argument('--profiles', nargs='+', default=['legacy', 'balanced'],
+                                   choices=sorted(app_module.DB_TUNING_PROFILES))
+    contention_parser.set_defaults(func=bench_contention)
+
+    indexes_parser = subparsers.add_parser('indexes', help='query plans and latency with/without indexes')
+    indexes_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 1000000, 10000000],
+                                help='number of orders to generate')
+    indexes_parser.add_argument('--repeat', type=int, default=20)
+    indexes_parser.set_defaults(func=bench_indexes)
+
+    search_parser = subparsers.add_parser('search', help='LIKE scan vs. full-text search latency')
+    search_parser.add_argument('--products', type=int, nargs='+', default=[10000, 100000, 1000000])
+    search_parser.add_argument('--term', default='4242', help='search term (default matches a handful of SKUs)')
+    search_parser.add_argument('--repeat', type=int, default=10)
+    search_parser.set_defaults(func=bench_search)
+
+    cache_parser = subparsers.add_parser('cache', help='catalog route throughput per cache backend')
+    cache_parser.add_argument('--requests', type=int, default=1000)
+    cache_parser.add_argument('--threads', type=int, default=4)
+    cache_parser.add_argument('--products', type=int, default=1000, help='extra synthetic products')
+    cache_parser.add_argument('--backends', nargs='+', default=['none', 'local', 'sqlite'],
+                              choices=['none', *sorted(app_module.CACHE_BACKENDS)])
+    cache_parser.set_defaults(func=bench_cache)
+
+    stream_parser = subparsers.add_parser('stream', help='peak RSS of full-catalog vs. streamed products API')
+    stream_parser.add_argument('--products', type=int, nargs='+', default=[10000, 100000, 1000000])
+    stream_parser.set_defaults(func=bench_stream)
+
+    pricing_parser = subparsers.add_parser('pricing', help='nested-loop vs. hash-join cart pricing')
+    pricing_parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 100, 1000])
+    pricing_parser.set_defaults(func=bench_pricing)
+
+    flash_parser = subparsers.add_parser('flash-sale', help='concurrent buyers competing for limited stock')
+    flash_parser.add_argument('--buyers', type=int, default=300)
+    flash_parser.add_argument('--stock', type=int, default=50)
+    flash_parser.add_argument('--processes', type=int, default=4)
+    flash_parser.add_argument('--mode', choices=['sync', 'async'], default='sync')
+    flash_parser.set_defaults(func=bench_flash_sale)
+
+    storm_parser = subparsers.add_parser('login-storm', help='catalog latency during a burst of logins')
+    storm_parser.add_argument('--attackers', type=int, default=16, help='concurrent login threads')
+    storm_parser.add_argument('--readers', type=int, default=2, help='concurrent catalog threads')
+    storm_parser.add_argument('--seconds', type=float, default=10)
+    storm_parser.set_defaults(func=bench_login_storm)
+
+    startup_parser = subparsers.add_parser('startup', help='worker cold-start time, fresh import vs. preload fork')
+    startup_parser.add_argument('--runs', type=int, default=10)
+    startup_parser.set_defaults(func=bench_startup)
+
+    metrics_parser = subparsers.add_parser('metrics', help='Prometheus instrumentation overhead per route')
+    metrics_parser.add_argument('--requests', type=int, default=500)
+    metrics_parser.add_argument('--rounds', type=int, default=5)
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    render_parser = subparsers.add_parser('render', help='CPU time per catalog page view per HTML cache layer')
+    render_parser.add_argument('--requests', type=int, default=500)
+    render_parser.add_argument('--products', type=int, default=60, help='extra synthetic products')
+    render_parser.set_defaults(func=bench_render)
+
+    asgi_parser = subparsers.add_parser('asgi', help='gunicorn sync workers vs. uvicorn over HTTP')
+    asgi_parser.add_argument('--connections', type=int, nargs='+', default=[10, 100, 1000])
+    asgi_parser.add_argument('--seconds', type=float, default=10)
+    asgi_parser.add_argument('--workers', type=int, default=4, help='server processes')
+    asgi_parser.set_defaults(func=bench_asgi)
+
+    http_cache_parser = subparsers.add_parser('http-cache', help='response compression and ETag revalidation')
+    http_cache_parser.add_argument('--requests', type=int, default=50, help='requests per route and mode')
+    http_cache_parser.add_argument('--products', type=int, default=200, help='extra synthetic products')
+    http_cache_parser.add_argument('--mbps', type=float, default=10, help='client link speed for the estimate')
+    http_cache_parser.set_defaults(func=bench_http_cache)
+
+    load_parser = subparsers.add_parser('load', help='shopping flows over HTTP, checked against a baseline')
+    load_parser.add_argument('--users', type=int, default=20, help='concurrent shoppers')
+    load_parser.add_argument('--seconds', type=float, default=30)
+    load_parser.add_argument('--products', type=int, default=10000, help='synthetic catalog size')
+    load_parser.add_argument('--workers', type=int, default=4, help='gunicorn workers (WEB_CONCURRENCY)')
+    load_parser.add_argument('--buy-ratio', type=float, default=0.3, help='share of visits that check out')
+    load_parser.add_argument('--baseline', default=LOAD_BASELINE, help='baseline JSON file')
+    load_parser.add_argument('--save-baseline', action='store_true', help='record this run as the baseline')
+    load_parser.add_argument('--tolerance', type=float, default=0.2,
+                             help='allowed drop in req/s and rise in p95 before a step fails')
+    load_parser.set_defaults(func=bench_load)
+
+    import_parser = subparsers.add_parser('import', help='bulk catalog import throughput and memory')
+    import_parser.add_argument('--products', type=int, nargs='+', default=[100000, 1000000])
+    import_parser.set_defaults(func=bench_import)
+
+    orders_parser = subparsers.add_parser('orders', help='order history latency for a user with many orders')
+    orders_parser.add_argument('--orders', type=int, nargs='+', default=[1000, 10000, 50000])
+    orders_parser.add_argument('--repeat', type=int, default=5)
+    orders_parser.set_defaults(func=bench_orders)
+
+    analytics_parser = subparsers.add_parser('analytics', help='dashboard queries: raw scans vs. sales rollups')
+    analytics_parser.add_argument('--orders', type=int, nargs='+', default=[10000, 1000000])
+    analytics_parser.add_argument('--repeat', type=int, default=5)
+    analytics_parser.set_defaults(func=bench_analytics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Gunicorn settings for the Flask E-Commerce application
+Loaded automatically when gunicorn starts from this directory.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+timeout = 120
+# Run create_app() once in the master; workers fork with templates compiled
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Start the order workers in each worker; threads do not survive the fork from the master"""
+    import app as app_module
+    if app_module.CHECKOUT_MODE == 'async':
+        app_module.start_order_workers()
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges (in-flight requests, pool connections) from /metrics"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
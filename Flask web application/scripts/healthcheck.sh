@@ -0,0 +1,20 @@
+#!/bin/bash
+
+# Container health probe without curl or a Python interpreter.
+# Sends one HTTP/1.0 request over bash's /dev/tcp and succeeds on a 200 status line.
+#
+# Usage: healthcheck.sh [path] [port]    (defaults: /health and $PORT or 5000)
+#   liveness:  healthcheck.sh /health
+#   readiness: healthcheck.sh /ready
+
+path="${1:-/health}"
+port="${2:-${PORT:-5000}}"
+host="${HEALTHCHECK_HOST:-127.0.0.1}"
+timeout="${HEALTHCHECK_TIMEOUT:-3}"
+
+exec 3<>"/dev/tcp/${host}/${port}" || exit 1
+printf 'GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n' "$path" "$host" >&3
+read -r -t "$timeout" _ status _ <&3 || exit 1
+exec 3<&-
+
+[ "$status" = "200" ]
@@ -80,6 +80,12 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    // Live stock for pages that may have been served from cache
+    const stockElements = document.querySelectorAll('[data-stock-product]');
+    if (stockElements.length) {
+        refreshStock(stockElements);
+    }
+
     // Auto-hide alerts
     const alerts = document.querySelectorAll('.alert');
     alerts.forEach(alert => {
@@ -93,6 +99,38 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 // Helper functions
+function refreshStock(elements) {
+    const ids = [...new Set([...elements].map(el => el.dataset.stockProduct))];
+    fetch(`/api/stock?ids=${ids.join(',')}`)
+        .then(response => response.json())
+        .then(data => {
+            elements.forEach(el => {
+                const stock = data.stock[el.dataset.stockProduct];
+                if (stock === undefined) {
+                    return;
+                }
+                if (el.dataset.stockQuantity) {
+                    // Cart line: only warn when the quantity can no longer be met
+                    const short = stock < Number(el.dataset.stockQuantity);
+                    el.textContent = short ? (stock > 0 ? `Only ${stock} left` : 'Out of stock') : '';
+                    el.classList.toggle('text-danger', short);
+                } else {
+                    // Product page: switch the badge both ways, since the page may be cached either way
+                    const inStock = stock > 0;
+                    const badge = el.querySelector('[data-stock-badge]');
+                    badge.classList.toggle('text-success', inStock);
+                    badge.classList.toggle('text-danger', !inStock);
+                    badge.innerHTML = inStock
+                        ? '<i class="fas fa-check-circle"></i> In Stock'
+                        : '<i class="fas fa-times-circle"></i> Out of Stock';
+                    el.querySelector('[data-stock-detail]').textContent =
+                        inStock ? `${stock} items available` : 'This item is currently unavailable';
+                }
+            });
+        })
+        .catch(error => console.error('Error:', error));
+}
+
 function addLoadingState(button) {
     const originalText = button.innerHTML;
     button.innerHTML = '<span class="spinner-border spinner-border-sm me-2" role="status"></span>Loading...';
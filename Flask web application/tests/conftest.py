@@ -2,24 +2,81 @@ import pytest
 import os
 import sys
 import tempfile
+import urllib.parse
+import uuid
 
 # Add parent directory to path to import app module
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import app as app_module
 
+@pytest.fixture(scope='session')
+def postgres_url():
+    """Admin URL of the PostgreSQL server the postgresql tests run against
+
+    TEST_POSTGRES_URL points at an existing server; otherwise a throwaway
+    server is started with pgserver. Skips when neither is available.
+    """
+    url = os.environ.get('TEST_POSTGRES_URL')
+    if url:
+        yield url
+        return
+    if app_module.psycopg2 is None:
+        pytest.skip('psycopg2 is not installed')
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip('set TEST_POSTGRES_URL or install pgserver to run the postgresql tests')
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='pgdata'), cleanup_mode='delete')
+    try:
+        yield server.get_uri()
+    finally:
+        server.cleanup()
+
+def _postgres_admin(admin_url, statement):
+    conn = app_module.psycopg2.connect(admin_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(statement)
+    finally:
+        conn.close()
+
 @pytest.fixture
-def client():
+def database(request):
+    """A fresh, empty database on the backend the test is parametrized with"""
+    if request.param == 'sqlite':
+        db_fd, db_path = tempfile.mkstemp()
+        try:
+            yield db_path
+        finally:
+            os.close(db_fd)
+            os.unlink(db_path)
+        return
+    admin_url = request.getfixturevalue('postgres_url')
+    name = f'test_{uuid.uuid4().hex}'
+    _postgres_admin(admin_url, f'CREATE DATABASE {name}')
+    try:
+        yield urllib.parse.urlparse(admin_url)._replace(path=f'/{name}').geturl()
+    finally:
+        _postgres_admin(admin_url, f'DROP DATABASE {name} WITH (FORCE)')
+
+def pytest_generate_tests(metafunc):
+    # Tests using the client (or a bare database) run once per database backend
+    if 'database' in metafunc.fixturenames:
+        metafunc.parametrize('database', ['sqlite', 'postgresql'], indirect=True)
+
+@pytest.fixture
+def client(database):
     """Create a test client"""
-    # Create a temporary database file
-    db_fd, db_path = tempfile.mkstemp()
-    
     # Store original DATABASE value
     original_database = app_module.DATABASE
-    app_module.DATABASE = db_path
+    app_module.DATABASE = database
     
     app_module.app.config['TESTING'] = True
     app_module.app.config['SECRET_KEY'] = 'test-secret-key'
+    app_module.auth_rate_limiter.reset()
+    app_module.health_probes.reset()
     
     try:
         with app_module.app.test_client() as client:
@@ -28,9 +85,9 @@ def client():
             yield client
     finally:
         # Restore original DATABASE value
+        app_module.close_db_pools()
+        app_module.catalog_cache.clear()
         app_module.DATABASE = original_database
-        os.close(db_fd)
-        os.unlink(db_path)
 
 @pytest.fixture
 def auth_client(client):
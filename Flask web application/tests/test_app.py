@@ -1,6 +1,8 @@
 import pytest
 import json
+import os
 from tests.conftest import client, auth_client
+import app as app_module
 
 def test_home_page(client):
     """Test the home page"""
@@ -162,6 +164,58 @@ def test_orders_page_logged_in(auth_client):
     response = auth_client.get('/orders')
     assert response.status_code == 200
 
+def _seed_order_history(count):
+    """Orders for the logged-in test user, two per second so pages split ties, each with two items"""
+    def work(conn):
+        for i in range(count):
+            order_id = conn.execute(
+                'INSERT INTO orders (user_id, total_amount, created_at) VALUES (1, ?, ?) RETURNING id',
+                (10.0 + i, f'2024-01-01 00:00:{i // 2:02d}')
+            ).fetchone()[0]
+            conn.executemany('INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, ?, ?)',
+                             [(order_id, 1, 1, 999.99), (order_id, 4, 2, 19.99)])
+    app_module.db_write(work)
+
+def test_order_history_api_pages_with_items(auth_client, monkeypatch):
+    """Test that order history pages newest first by (created_at, id) and loads items once per page"""
+    _seed_order_history(5)
+    monkeypatch.setattr(app_module, 'SQL_PROFILE', True)
+    app_module.close_db_pools()
+    app_module.sql_profiler.reset()
+
+    seen, cursor = [], None
+    while True:
+        response = auth_client.get('/api/orders', query_string={'limit': 2, **({'cursor': cursor} if cursor else {})})
+        assert response.status_code == 200
+        page = response.get_json()
+        assert len(page['orders']) <= 2
+        seen.extend(page['orders'])
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert [order['id'] for order in seen] == [5, 4, 3, 2, 1]
+    assert [(item['name'], item['quantity']) for item in seen[0]['items']] == [('Laptop', 1), ('Coffee Mug', 2)]
+
+    item_queries = [s for s in app_module.sql_profiler.top(50) if 'FROM order_items' in s['sql']]
+    assert sum(s['calls'] for s in item_queries) == 3  # one per page, not one per order
+
+def test_order_history_api_validation(client, auth_client):
+    """Test that the order history API needs a login and rejects bad cursors and limits"""
+    assert auth_client.get('/api/orders?cursor=bogus').status_code == 400
+    assert auth_client.get('/api/orders?limit=0').status_code == 400
+    auth_client.get('/logout')
+    assert client.get('/api/orders').status_code == 401
+
+def test_orders_page_shows_items_and_older_link(auth_client, monkeypatch):
+    """Test that the orders page lists line items and links to the next page"""
+    monkeypatch.setattr(app_module, 'ORDER_HISTORY_PAGE_SIZE', 2)
+    _seed_order_history(3)
+    html = auth_client.get('/orders').get_data(as_text=True)
+    assert 'Order #3' in html and 'Order #1' not in html
+    assert '2 &times; Coffee Mug' in html
+    assert 'Older orders' in html
+    assert auth_client.get('/orders?cursor=bogus').status_code == 302
+
 def test_api_products(client):
     """Test products API endpoint"""
     response = client.get('/api/products')
@@ -176,6 +230,209 @@ def test_health_check(client):
     data = json.loads(response.data)
     assert data['status'] == 'healthy'
 
+def test_readiness_probes(client):
+    """Test that /ready reports every dependency and caches the result"""
+    response = client.get('/ready')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'ready'
+    assert set(data['checks']) == {'database', 'pool', 'order_queue', 'disk'}
+    assert data['checks']['database']['schema_version'] == app_module.MIGRATIONS[-1][0]
+
+    runs = app_module.health_probes.runs
+    client.get('/ready')
+    assert app_module.health_probes.runs == runs
+
+def test_readiness_fails_on_unhealthy_dependency(client, monkeypatch):
+    """Test that a failing or raising probe turns /ready into 503 while /health stays up"""
+    monkeypatch.setattr(app_module, 'HEALTH_QUEUE_MAX_DEPTH', -1)
+    monkeypatch.setitem(app_module.health_probes.probes, 'disk', lambda: 1 / 0)
+    response = client.get('/ready')
+    assert response.status_code == 503
+    checks = json.loads(response.data)['checks']
+    assert not checks['order_queue']['ok']
+    assert 'division by zero' in checks['disk']['error']
+    assert client.get('/health').status_code == 200
+
+def metric_value(text, name, **labels):
+    """Value of one sample in Prometheus text output, 0 when absent"""
+    from prometheus_client.parser import text_string_to_metric_families
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == name and all(sample.labels.get(k) == v for k, v in labels.items()):
+                return sample.value
+    return 0
+
+def test_metrics_endpoint(auth_client):
+    """Test that /metrics exposes request, query, pool, cache and checkout metrics"""
+    before = auth_client.get('/metrics').data.decode()
+    auth_client.get('/products')
+    auth_client.get('/products')
+    auth_client.get('/add_to_cart/1')
+    auth_client.post('/checkout', data={'idempotency_key': 'metrics-1'})
+    auth_client.post('/checkout', data={'idempotency_key': 'metrics-1'})
+    response = auth_client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    after = response.data.decode()
+
+    def delta(name, **labels):
+        return metric_value(after, name, **labels) - metric_value(before, name, **labels)
+
+    assert delta('flask_http_request_total', method='GET', endpoint='products', status='200') == 2
+    assert delta('flask_http_request_duration_seconds_count', method='GET', endpoint='products') == 2
+    assert delta('ecommerce_db_query_duration_seconds_count', statement='SELECT products') >= 1
+    assert delta('ecommerce_cache_requests_total', cache='catalog', result='hit') >= 1
+    assert delta('ecommerce_checkouts_total', mode='sync', outcome='placed') == 1
+    assert delta('ecommerce_checkouts_total', mode='sync', outcome='duplicate') == 1
+    assert metric_value(after, 'flask_http_requests_in_progress') == 1  # the scrape itself
+    assert 'ecommerce_db_pool_connections{state="idle"}' in after
+
+def test_statement_labels():
+    """Test that statements are labelled by verb and first table"""
+    assert app_module.statement_label('SELECT * FROM products WHERE id = ?') == 'SELECT products'
+    assert app_module.statement_label('\n  INSERT INTO orders (user_id) VALUES (?)') == 'INSERT orders'
+    assert app_module.statement_label('UPDATE products SET stock = stock - ?') == 'UPDATE products'
+    assert app_module.statement_label('BEGIN IMMEDIATE') == 'BEGIN'
+
+def test_sql_profile_ranks_statements(client, monkeypatch):
+    """Test that profiling records rows and parameter types per statement, and the debug endpoint ranks them"""
+    assert client.get('/debug/sql').status_code == 404
+    monkeypatch.setattr(app_module, 'SQL_PROFILE', True)
+    monkeypatch.setattr(app_module, 'DEBUG_API_TOKEN', 'secret')
+    app_module.close_db_pools()
+    app_module.sql_profiler.reset()
+    assert client.get('/api/v2/products?limit=3').status_code == 200
+
+    auth = {'Authorization': 'Bearer secret'}
+    statements = client.get('/debug/sql?limit=50', headers=auth).get_json()['statements']
+    page = next(s for s in statements if s['sql'].startswith('SELECT') and 'FROM products' in s['sql'])
+    assert page['calls'] == 1
+    assert page['rows'] == 4  # one extra row to detect the next page
+    assert page['parameters'] == '(int, int)'
+    assert statements == sorted(statements, key=lambda s: s['total_ms'], reverse=True)
+
+    assert client.delete('/debug/sql', headers=auth).status_code == 204
+    assert app_module.sql_profiler.top() == []
+
+def test_sql_profile_endpoint_requires_token(client, monkeypatch):
+    """Test that the SQL profile is off without a token and rejects a wrong one"""
+    monkeypatch.setattr(app_module, 'SQL_PROFILE', True)
+    assert client.get('/debug/sql').status_code == 404
+    monkeypatch.setattr(app_module, 'DEBUG_API_TOKEN', 'secret')
+    assert client.get('/debug/sql').status_code == 401
+    assert client.get('/debug/sql', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.delete('/debug/sql').status_code == 401
+
+def test_slow_query_log_explains_plan(client, monkeypatch, caplog):
+    """Test that statements over the threshold are logged with their query plan"""
+    monkeypatch.setattr(app_module, 'SQL_PROFILE', True)
+    monkeypatch.setattr(app_module, 'SQL_SLOW_QUERY_MS', 0)
+    monkeypatch.setattr(app_module, 'SQL_EXPLAIN_SLOW', True)
+    app_module.close_db_pools()
+    with caplog.at_level('WARNING', logger='app'):
+        client.get('/product/1')
+    slow = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Slow query')]
+    plan = 'Scan on products' if app_module.is_postgres(app_module.DATABASE) else 'plan: SEARCH products'
+    assert any('FROM products WHERE id = ?' in message and plan in message for message in slow)
+
+def test_catalog_api_requires_token(client, monkeypatch):
+    """Test that the bulk catalog API is off without a token and rejects a wrong one"""
+    assert client.get('/api/catalog/export').status_code == 404
+    monkeypatch.setattr(app_module, 'CATALOG_API_TOKEN', 'secret')
+    response = client.post('/api/catalog/import', data='', headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+def test_catalog_api_import_and_export(client, monkeypatch):
+    """Test importing an NDJSON body and streaming the catalog back as CSV"""
+    monkeypatch.setattr(app_module, 'CATALOG_API_TOKEN', 'secret')
+    headers = {'Authorization': 'Bearer secret'}
+    body = '\n'.join(json.dumps({'sku': f'BULK-{i}', 'name': f'Bulk {i}', 'price': i, 'stock': 1})
+                     for i in range(1, 4))
+    response = client.post('/api/catalog/import?format=ndjson', data=body, headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['rows'] == 3
+
+    response = client.get('/api/catalog/export?format=csv', headers=headers)
+    assert response.headers['Content-Type'].startswith('text/csv')
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 1 + 5 + 3
+    assert lines[-1] == 'BULK-3,Bulk 3,,3.0,1,,'
+
+    response = client.post('/api/catalog/import?format=ndjson', data='{not json', headers=headers)
+    assert response.status_code == 400
+
+def test_analytics_api_requires_token(client, monkeypatch):
+    """Test that the analytics API is off without a token and rejects a wrong one"""
+    assert client.get('/api/analytics/revenue').status_code == 404
+    monkeypatch.setattr(app_module, 'ANALYTICS_API_TOKEN', 'secret')
+    assert client.get('/api/analytics/products', headers={'Authorization': 'Bearer nope'}).status_code == 401
+    headers = {'Authorization': 'Bearer secret'}
+    assert client.get('/api/analytics/revenue?from=yesterday', headers=headers).status_code == 400
+    assert client.get('/api/analytics/products?sort=price', headers=headers).status_code == 400
+
+def test_checkout_updates_sales_rollups(auth_client, monkeypatch):
+    """Test that checkouts are counted per day, product, category and customer as they commit"""
+    monkeypatch.setattr(app_module, 'ANALYTICS_API_TOKEN', 'secret')
+    headers = {'Authorization': 'Bearer secret'}
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/add_to_cart/4')
+    auth_client.get('/add_to_cart/4')
+    auth_client.post('/checkout', data={'idempotency_key': 'first'})
+    auth_client.get('/add_to_cart/4')
+    auth_client.post('/checkout', data={'idempotency_key': 'second'})
+
+    revenue = auth_client.get('/api/analytics/revenue', headers=headers).get_json()
+    assert revenue['totals'] == {'orders': 2, 'units': 4, 'revenue': 1059.96}
+    assert len(revenue['days']) == 1
+
+    products = auth_client.get('/api/analytics/products?sort=units', headers=headers).get_json()['products']
+    assert [(p['name'], p['orders'], p['units']) for p in products] == [('Coffee Mug', 2, 3), ('Laptop', 1, 1)]
+    categories = auth_client.get('/api/analytics/categories', headers=headers).get_json()['categories']
+    assert [(c['category'], c['revenue']) for c in categories] == [('Electronics', 999.99), ('Home', 59.97)]
+    customers = auth_client.get('/api/analytics/customers', headers=headers).get_json()['customers']
+    assert [(c['username'], c['orders']) for c in customers] == [('testuser', 2)]
+
+def test_sales_compactor_and_backfill_agree(client, monkeypatch):
+    """Test that batch-mode orders wait for the compactor, and a backfill rebuilds the same rollups"""
+    def rollups():
+        conn = app_module.get_db_connection()
+        try:
+            # Revenue is a REAL running total, so compare it to the cent
+            return {table: sorted((*row[:3], round(row[3], 2)) for row in conn.execute(f'SELECT * FROM {table}'))
+                    for table, _, _ in app_module.SALES_ROLLUPS}
+        finally:
+            conn.close()
+
+    monkeypatch.setattr(app_module, 'ANALYTICS_ROLLUP', 'batch')
+    for cart in ({1: 1}, {2: 2, 3: 1}, {2: 1}):
+        app_module.place_order(None, cart)
+    assert rollups()['sales_daily'] == []
+    assert app_module.compact_sales(batch_size=2) == 3
+    compacted = rollups()
+    assert compacted['sales_by_product'] == [(1, 1, 1, 999.99), (2, 2, 3, 2099.97), (3, 1, 1, 199.99)]
+    assert compacted['sales_by_user'] == []  # guest orders have no customer row
+
+    assert app_module.backfill_sales(chunk_size=2) == 3
+    assert rollups() == compacted
+
+def test_metrics_aggregate_across_processes(tmp_path):
+    """Test that multiprocess mode sums the metrics of every worker process"""
+    import subprocess
+    import sys
+    metrics_dir = tmp_path / 'prometheus'
+    metrics_dir.mkdir()
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(metrics_dir), 'DATABASE': str(tmp_path / 'shop.db'),
+           'CATALOG_CACHE_BACKEND': 'local'}
+    cwd = os.path.dirname(os.path.abspath(app_module.__file__))
+    worker = "import app; c = app.create_app().test_client(); [c.get('/health') for _ in range(3)]"
+    for _ in range(2):
+        subprocess.run([sys.executable, '-c', worker], env=env, cwd=cwd, check=True)
+    scrape = "import app; print(app.app.test_client().get('/metrics').data.decode())"
+    output = subprocess.run([sys.executable, '-c', scrape], env=env, cwd=cwd, check=True,
+                            capture_output=True, text=True).stdout
+    assert metric_value(output, 'flask_http_request_total', endpoint='health', status='200') == 6
+
 def test_404_error(client):
     """Test 404 error page"""
     response = client.get('/nonexistent-page')
@@ -206,3 +463,724 @@ def test_session_cart_persistence(client):
     # Check cart again
     response = client.get('/cart')
     assert response.status_code == 200
+
+def test_request_teardown_releases_connections(client):
+    """Test that connections leaked by a request are returned to the pool"""
+    with app_module.app.test_request_context('/'):
+        app_module.get_db_connection()
+        assert app_module.get_pool().stats()['in_use'] == 1
+    assert app_module.get_pool().stats()['in_use'] == 0
+
+def test_product_search_prefix_match(client):
+    """Test that search matches word prefixes and only returns matching products"""
+    response = client.get('/products?search=lap')
+    assert response.status_code == 200
+    assert b'Laptop' in response.data
+    assert b'Coffee Mug' not in response.data
+
+def test_product_search_ignores_fts_syntax(client):
+    """Test that FTS5 operators in user input are treated as plain text"""
+    response = client.get('/products?search=%22laptop%22+OR+NEAR(')
+    assert response.status_code == 200
+
+def test_product_search_pagination(client):
+    """Test that search results are paged"""
+    with app_module.app.app_context():
+        conn = app_module.get_db_connection()
+        results, has_next = app_module.search_products(conn, 'c', per_page=2)
+        assert len(results) == 2
+        assert has_next
+        page_two, _ = app_module.search_products(conn, 'c', page=2, per_page=2)
+        assert {row['id'] for row in results}.isdisjoint(row['id'] for row in page_two)
+        conn.close()
+
+def test_catalog_reads_are_cached(client):
+    """Test that catalog pages are served from the cache until it is invalidated"""
+    client.get('/api/products')
+    conn = app_module.get_db_connection()
+    conn.execute("UPDATE products SET name = 'Renamed Laptop' WHERE id = 1")
+    conn.commit()
+    conn.close()
+
+    stats_before = app_module.catalog_cache.stats()
+    data = json.loads(client.get('/api/products').data)
+    assert data[0]['name'] == 'Laptop'
+    assert app_module.catalog_cache.stats()['hits'] == stats_before['hits'] + 1
+
+    app_module.invalidate_catalog()
+    data = json.loads(client.get('/api/products').data)
+    assert data[0]['name'] == 'Renamed Laptop'
+
+def test_cached_product_not_found(client):
+    """Test that a missing product is cached as missing and still redirects"""
+    assert client.get('/product/999').status_code == 302
+    assert client.get('/product/999').status_code == 302
+
+def test_home_does_not_initialize_database(client, tmp_path, monkeypatch):
+    """Test that a missing schema is reported instead of migrated inside a request"""
+    monkeypatch.setattr(app_module, 'DATABASE', str(tmp_path / 'empty.db'))
+    monkeypatch.setattr(app_module, 'init_db', lambda: pytest.fail('init_db called from a request'))
+    response = client.get('/')
+    assert response.status_code == 503
+    assert b'No products available' in response.data
+    app_module.close_db_pools()
+
+def test_anonymous_pages_are_cached(client):
+    """Test that catalog pages are reused for anonymous visitors until the catalog changes"""
+    first = client.get('/products').data
+    conn = app_module.get_db_connection()
+    conn.execute("UPDATE products SET name = 'Renamed Laptop' WHERE id = 1")
+    conn.commit()
+    conn.close()
+
+    hits = app_module.catalog_cache.stats()['hits']
+    assert client.get('/products').data == first
+    assert app_module.catalog_cache.stats()['hits'] == hits + 1
+
+    app_module.invalidate_catalog()
+    assert b'Renamed Laptop' in client.get('/products').data
+
+def test_checkout_invalidates_only_its_products(auth_client):
+    """Test that an order refreshes its products' pages without dropping the rest of the catalog"""
+    visitor = app_module.app.test_client()
+    for path in ('/products', '/product/1', '/product/2'):
+        visitor.get(path)
+    auth_client.get('/add_to_cart/1')
+    auth_client.post('/checkout', data={'idempotency_key': 'scoped'})
+
+    hits = app_module.catalog_cache.stats()['hits']
+    visitor.get('/products')
+    visitor.get('/product/2')
+    assert app_module.catalog_cache.stats()['hits'] == hits + 2
+    assert b'9 items available' in visitor.get('/product/1').data
+
+def test_logged_in_pages_are_not_shared(auth_client):
+    """Test that pages with a user's nav are rendered per request"""
+    response = auth_client.get('/products')
+    assert b'testuser' in response.data
+    auth_client.get('/logout')
+    response = auth_client.get('/products')
+    assert b'testuser' not in response.data
+    assert b'Login' in response.data
+
+def test_catalog_pages_revalidate_by_content(client):
+    """Test that anonymous catalog pages are public with a weak ETag that follows the rendered page"""
+    response = client.get('/products')
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == app_module.HTTP_CACHE_POLICIES['public']
+    assert etag.startswith('W/')
+
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = client.head('/products')  # HEAD carries the same caching metadata as GET
+    assert response.headers['Cache-Control'] == app_module.HTTP_CACHE_POLICIES['public']
+    assert response.headers['ETag'] == etag
+    assert client.head('/products', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/products?category=Home').headers['ETag'] != etag
+
+    # A fresh cache (another worker, a restart) renders the same page and so the same tag
+    app_module.catalog_cache.clear()
+    assert client.get('/products', headers={'If-None-Match': etag}).status_code == 304
+
+    conn = app_module.get_db_connection()
+    conn.execute("UPDATE products SET name = 'Renamed Laptop' WHERE id = 1")
+    conn.commit()
+    conn.close()
+    app_module.invalidate_catalog()
+    response = client.get('/products', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Renamed Laptop' in response.data
+    assert response.headers['ETag'] != etag
+
+def test_private_pages_are_not_cached(auth_client):
+    """Test that per-user pages are never stored or shared"""
+    response = auth_client.get('/products')
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+    assert 'ETag' not in response.headers
+    auth_client.get('/add_to_cart/1')
+    assert auth_client.get('/cart').headers['Cache-Control'] == 'no-store'
+    assert auth_client.get('/checkout').headers['Cache-Control'] == 'no-store'
+    assert auth_client.get('/orders').headers['Cache-Control'] == 'private, no-cache'
+
+def test_responses_are_compressed(client, monkeypatch):
+    """Test gzip/brotli negotiation, the size threshold and streamed bodies"""
+    import gzip
+    plain = client.get('/products')
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    assert 'Content-Encoding' not in plain.headers
+
+    response = client.get('/products', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert int(response.headers['Content-Length']) == len(response.data) < len(plain.data)
+    assert gzip.decompress(response.data) == plain.data
+    if app_module.brotli:
+        response = client.get('/products', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['Content-Encoding'] == 'br'
+        assert app_module.brotli.decompress(response.data) == plain.data
+
+    assert 'Content-Encoding' not in client.get('/health', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'Content-Encoding' not in client.head('/products', headers={'Accept-Encoding': 'gzip'}).headers
+
+    response = client.get('/api/v2/products?format=ndjson', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(gzip.decompress(response.data).decode().strip().split('\n')) == 5
+
+    # Strong ETags are weakened once compressed and still revalidate
+    response = client.get('/api/v2/products', headers={'Accept-Encoding': 'gzip'})
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    response = client.get('/api/v2/products', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+
+def test_product_card_fragment_follows_stock(client):
+    """Test that a product card is re-rendered when its row changes"""
+    product = dict(app_module.get_product(1))
+    with app_module.app.test_request_context('/products'):
+        card = app_module.cached_fragment('fragments/product_card.html', product=product, show_stock=True)
+        assert card is app_module.cached_fragment('fragments/product_card.html', product=product, show_stock=True)
+        product['stock'] = 0
+        sold_out = app_module.cached_fragment('fragments/product_card.html', product=product, show_stock=True)
+    assert 'In Stock (10)' in card
+    assert 'Out of Stock' in sold_out
+
+def test_templates_are_compiled_at_startup():
+    """Test that warm_templates compiles every page and fragment"""
+    compiled = app_module.warm_templates()
+    assert compiled >= 15
+    assert len(app_module.app.jinja_env.cache) >= compiled
+
+def test_api_v2_keyset_pagination(client):
+    """Test that cursors walk the whole catalog without gaps or repeats"""
+    ids = []
+    url = '/api/v2/products?limit=2'
+    while url:
+        data = json.loads(client.get(url).data)
+        ids.extend(item['id'] for item in data['items'])
+        url = f"/api/v2/products?limit=2&cursor={data['next_cursor']}" if data['next_cursor'] else None
+    assert ids == [1, 2, 3, 4, 5]
+
+def test_api_v2_field_selection(client):
+    """Test that only the requested fields (plus id) are returned"""
+    data = json.loads(client.get('/api/v2/products?fields=name,price').data)
+    assert set(data['items'][0]) == {'id', 'name', 'price'}
+    assert client.get('/api/v2/products?fields=password_hash').status_code == 400
+    assert client.get('/api/v2/products?cursor=not-a-cursor').status_code == 400
+
+def test_api_v2_conditional_get(client):
+    """Test that an unchanged page answers If-None-Match with 304"""
+    response = client.get('/api/v2/products?limit=3')
+    etag = response.headers['ETag']
+    response = client.get('/api/v2/products?limit=3', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_api_v2_streaming_formats(client):
+    """Test NDJSON and streamed JSON array output"""
+    response = client.get('/api/v2/products?format=ndjson&fields=name')
+    lines = response.data.decode().strip().split('\n')
+    assert response.mimetype == 'application/x-ndjson'
+    assert len(lines) == 5
+    assert json.loads(lines[0]) == {'id': 1, 'name': 'Laptop'}
+
+    response = client.get('/api/v2/products?format=array&category=Electronics')
+    assert len(json.loads(response.data)) == 3
+
+def test_cart_cookie_stays_small(client):
+    """Test that the session cookie does not grow with the number of cart lines"""
+    sizes = []
+    for product_id in range(1, 6):
+        response = client.get(f'/add_to_cart/{product_id}')
+        sizes.append(len(response.headers.get('Set-Cookie', '')))
+    # Only the cart id, line count and flash message travel in the cookie
+    assert max(sizes) < 320
+
+    response = client.get('/cart')
+    for name in (b'Laptop', b'Smartphone', b'Headphones', b'Coffee Mug', b'T-Shirt'):
+        assert name in response.data
+
+def test_cart_quantities_and_removal(client):
+    """Test that repeated adds increment one line and removal drops it"""
+    client.get('/add_to_cart/1')
+    client.get('/add_to_cart/1')
+    client.get('/add_to_cart/2')
+    with client.session_transaction() as sess:
+        cart_id = sess['cart_id']
+        assert sess['cart_count'] == 2
+    assert app_module.cart_store.get(cart_id) == {1: 2, 2: 1}
+
+    client.get('/remove_from_cart/1')
+    assert app_module.cart_store.get(cart_id) == {2: 1}
+
+def test_cart_quote_uses_exact_money(client):
+    """Test the cart quote endpoint and its decimal arithmetic"""
+    for _ in range(3):
+        client.get('/add_to_cart/4')  # Coffee Mug, 19.99
+    client.get('/add_to_cart/5')      # T-Shirt, 29.99
+
+    data = json.loads(client.get('/api/cart/quote').data)
+    assert data['item_count'] == 4
+    assert data['total'] == '89.96'
+    assert data['tax'] == '7.20'
+    assert data['grand_total'] == '97.16'
+    assert [item['line_total'] for item in data['items']] == ['59.97', '29.99']
+
+def test_checkout_page_shows_order_summary(auth_client):
+    """Test that the checkout summary is priced from the cart"""
+    auth_client.get('/add_to_cart/1')
+    response = auth_client.get('/checkout')
+    assert b'Laptop' in response.data
+    assert b'$999.99' in response.data
+
+def test_checkout_decrements_stock(auth_client):
+    """Test that a placed order reserves its stock"""
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/add_to_cart/1')
+    response = auth_client.post('/checkout', data={'idempotency_key': 'order-1'})
+    assert response.status_code == 302
+    assert '/order_confirmation/' in response.headers['Location']
+
+    conn = app_module.get_db_connection()
+    stock = conn.execute('SELECT stock FROM products WHERE id = 1').fetchone()['stock']
+    items = conn.execute('SELECT product_id, quantity FROM order_items').fetchall()
+    conn.close()
+    assert stock == 8
+    assert [tuple(item) for item in items] == [(1, 2)]
+
+def test_checkout_is_idempotent(auth_client):
+    """Test that replaying a checkout POST does not create a second order"""
+    auth_client.get('/add_to_cart/2')
+    first = auth_client.post('/checkout', data={'idempotency_key': 'retry-me'})
+    second = auth_client.post('/checkout', data={'idempotency_key': 'retry-me'})
+    assert first.headers['Location'] == second.headers['Location']
+
+    conn = app_module.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == 1
+    conn.close()
+
+def test_checkout_out_of_stock_rolls_back(auth_client):
+    """Test that an order that cannot be fully reserved changes nothing"""
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 0 WHERE id = 2')
+    conn.commit()
+    conn.close()
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/add_to_cart/2')
+
+    response = auth_client.post('/checkout', follow_redirects=True)
+    assert b'Not enough stock for: Smartphone' in response.data
+
+    conn = app_module.get_db_connection()
+    assert conn.execute('SELECT stock FROM products WHERE id = 1').fetchone()['stock'] == 10
+    assert conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0] == 0
+    conn.close()
+
+def _stock(product_id):
+    conn = app_module.get_db_connection()
+    try:
+        return conn.execute('SELECT stock FROM products WHERE id = ?', (product_id,)).fetchone()['stock']
+    finally:
+        conn.close()
+
+def test_checkout_page_holds_stock(auth_client):
+    """Test that opening checkout holds the cart and placing the order consumes the hold"""
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/add_to_cart/1')
+    assert b'reserved for 10 minutes' in auth_client.get('/checkout').data
+    assert _stock(1) == 8
+    auth_client.get('/checkout')  # re-opening adjusts rather than stacks the hold
+    assert _stock(1) == 8
+    assert json.loads(auth_client.get('/api/stock?ids=1').data) == {'stock': {'1': 10}}
+
+    response = auth_client.post('/checkout', data={'idempotency_key': 'held-1'})
+    assert '/order_confirmation/' in response.headers['Location']
+    assert _stock(1) == 8
+    conn = app_module.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM stock_holds').fetchone()[0] == 0
+    conn.close()
+
+def _holds():
+    conn = app_module.get_db_connection()
+    try:
+        return {row['product_id']: (row['quantity'], row['expires_at'])
+                for row in conn.execute('SELECT product_id, quantity, expires_at FROM stock_holds')}
+    finally:
+        conn.close()
+
+def test_reopening_checkout_never_extends_or_drops_holds(auth_client, monkeypatch):
+    """Test that refreshing checkout keeps the first expiry, keeps partial holds and skips no-op writes"""
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/checkout')
+    expires_at = _holds()[1][1]
+
+    writes, invalidated = [], []
+    real_write, real_invalidate = app_module.db_write, app_module.invalidate_stock
+    monkeypatch.setattr(app_module, 'db_write', lambda work: writes.append(work) or real_write(work))
+    monkeypatch.setattr(app_module, 'invalidate_stock',
+                        lambda ids: invalidated.append(set(ids)) or real_invalidate(ids))
+    auth_client.get('/checkout')
+    assert writes == [] and invalidated == []
+
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 0 WHERE id = 1')
+    conn.commit()
+    conn.close()
+    now = app_module.time.time()
+    monkeypatch.setattr(app_module.time, 'time', lambda: now + 60)
+    auth_client.get('/add_to_cart/1')
+    auth_client.get('/checkout')
+    assert _holds() == {1: (1, expires_at)}  # the unit already held stays held, on the first expiry
+    assert _stock(1) == 0
+
+def test_expired_stock_holds_are_released(auth_client, monkeypatch):
+    """Test that holds past their TTL go back to stock"""
+    auth_client.get('/add_to_cart/2')
+    auth_client.get('/checkout')
+    assert _stock(2) == 14
+    assert app_module.release_expired_holds() == 0
+
+    monkeypatch.setattr(app_module.time, 'time', lambda: 10 ** 12)
+    assert app_module.release_expired_holds() == 1
+    assert _stock(2) == 15
+
+def test_stock_api(client):
+    """Test the live stock lookup and its validation"""
+    data = json.loads(client.get('/api/stock?ids=1,3,999').data)
+    assert data == {'stock': {'1': 10, '3': 20}}
+    assert client.get('/api/stock?ids=1').headers['Cache-Control'] == 'no-store'
+    assert client.get('/api/stock?ids=a').status_code == 400
+    assert client.get('/api/stock').status_code == 400
+    ids = ','.join(str(i) for i in range(app_module.STOCK_API_MAX_IDS + 1))
+    assert client.get(f'/api/stock?ids={ids}').status_code == 400
+
+def test_out_of_stock_product_page_refreshes_stock(client):
+    """Test that the live stock hook is rendered whether or not the product is in stock"""
+    assert b'data-stock-product="2"' in client.get('/product/2').data
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 0 WHERE id = 2')
+    conn.commit()
+    conn.close()
+    app_module.invalidate_stock([2])
+    data = client.get('/product/2').data
+    assert b'Out of Stock' in data
+    assert b'data-stock-product="2"' in data
+
+def test_order_workers_start_with_each_server_worker(monkeypatch):
+    """Test that gunicorn workers start order workers at fork time in async mode only"""
+    import runpy
+    hooks = runpy.run_path(os.path.join(os.path.dirname(app_module.__file__), 'gunicorn.conf.py'))
+    started = []
+    monkeypatch.setattr(app_module, 'start_order_workers', lambda: started.append(os.getpid()))
+    hooks['post_fork'](None, None)
+    assert started == []
+    monkeypatch.setattr(app_module, 'CHECKOUT_MODE', 'async')
+    hooks['post_fork'](None, None)
+    assert started == [os.getpid()]
+
+def test_async_checkout_queues_and_processes(auth_client, monkeypatch):
+    """Test that async checkout returns a queued order that workers confirm"""
+    monkeypatch.setattr(app_module, 'CHECKOUT_MODE', 'async')
+    monkeypatch.setattr(app_module, 'ORDER_WORKER_THREADS', 0)
+    auth_client.get('/add_to_cart/3')
+    response = auth_client.post('/checkout', data={'idempotency_key': 'async-1'})
+    order_id = int(response.headers['Location'].rsplit('/', 1)[1])
+
+    status = json.loads(auth_client.get(f'/api/orders/{order_id}/status').data)
+    assert status == {'id': order_id, 'status': 'queued'}
+    assert b'Order Received' in auth_client.get(f'/order_confirmation/{order_id}').data
+    assert app_module.order_queue.depth() == 1
+
+    assert app_module.drain_order_queue() == {order_id: 'pending'}
+    status = json.loads(auth_client.get(f'/api/orders/{order_id}/status').data)
+    assert status['status'] == 'pending'
+    assert app_module.order_queue.depth() == 0
+
+def test_async_checkout_rejects_when_sold_out(auth_client, monkeypatch):
+    """Test that a queued order is rejected without side effects if stock ran out meanwhile"""
+    monkeypatch.setattr(app_module, 'CHECKOUT_MODE', 'async')
+    monkeypatch.setattr(app_module, 'ORDER_WORKER_THREADS', 0)
+    auth_client.get('/add_to_cart/3')
+    auth_client.get('/add_to_cart/4')
+    response = auth_client.post('/checkout')
+    order_id = int(response.headers['Location'].rsplit('/', 1)[1])
+
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 0 WHERE id = 4')
+    conn.commit()
+    conn.close()
+
+    assert app_module.drain_order_queue() == {order_id: 'rejected'}
+    conn = app_module.get_db_connection()
+    assert conn.execute('SELECT stock FROM products WHERE id = 3').fetchone()['stock'] == 20
+    assert conn.execute('SELECT COUNT(*) FROM order_items').fetchone()[0] == 0
+    conn.close()
+
+def test_async_checkout_keeps_held_stock_until_processed(auth_client, monkeypatch):
+    """Test that units held at checkout stay reserved for a queued order"""
+    monkeypatch.setattr(app_module, 'CHECKOUT_MODE', 'async')
+    monkeypatch.setattr(app_module, 'ORDER_WORKER_THREADS', 0)
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 1 WHERE id = 3')
+    conn.commit()
+    conn.close()
+    auth_client.get('/add_to_cart/3')
+    auth_client.get('/checkout')  # holds the last unit
+    response = auth_client.post('/checkout', data={'idempotency_key': 'held-async-1'})
+    order_id = int(response.headers['Location'].rsplit('/', 1)[1])
+
+    assert _stock(3) == 0
+    assert app_module.hold_stock('another-cart', {3: 1}) == [3]  # a second shopper opens checkout
+    assert app_module.drain_order_queue() == {order_id: 'pending'}
+    assert _stock(3) == 0
+
+def test_rejected_async_order_returns_its_held_stock(auth_client, monkeypatch):
+    """Test that a queued order rejected for another line gives its held units back"""
+    monkeypatch.setattr(app_module, 'CHECKOUT_MODE', 'async')
+    monkeypatch.setattr(app_module, 'ORDER_WORKER_THREADS', 0)
+    auth_client.get('/add_to_cart/3')
+    auth_client.get('/checkout')
+    auth_client.get('/add_to_cart/4')
+    response = auth_client.post('/checkout')
+    order_id = int(response.headers['Location'].rsplit('/', 1)[1])
+    assert _stock(3) == 19
+
+    conn = app_module.get_db_connection()
+    conn.execute('UPDATE products SET stock = 0 WHERE id = 4')
+    conn.commit()
+    conn.close()
+    assert app_module.drain_order_queue() == {order_id: 'rejected'}
+    assert _stock(3) == 20
+
+def test_order_status_requires_owner(client):
+    """Test that order status is not visible to anonymous users"""
+    assert client.get('/api/orders/1/status').status_code == 401
+
+def test_login_rate_limited_per_ip(client, monkeypatch):
+    """Test that repeated login attempts from one IP are throttled"""
+    monkeypatch.setattr(app_module.auth_rate_limiter, 'limit', 3)
+    for _ in range(3):
+        assert client.post('/login', data={'username': 'x', 'password': 'y'}).status_code == 200
+    response = client.post('/login', data={'username': 'x', 'password': 'y'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == str(int(app_module.AUTH_RATE_WINDOW))
+
+    other = client.post('/login', data={'username': 'x', 'password': 'y'},
+                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert other.status_code == 200
+
+def test_login_rate_limited_per_forwarded_client(client, monkeypatch):
+    """Test that behind a trusted proxy each forwarded client gets its own budget"""
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    monkeypatch.setattr(app_module.app, 'wsgi_app', ProxyFix(app_module.app.wsgi_app, x_for=1))
+    monkeypatch.setattr(app_module.auth_rate_limiter, 'limit', 2)
+    proxy = {'REMOTE_ADDR': '172.18.0.5'}
+
+    def login(client_ip):
+        return client.post('/login', data={'username': 'x', 'password': 'y'}, environ_base=proxy,
+                           headers={'X-Forwarded-For': client_ip}).status_code
+
+    assert [login('203.0.113.1') for _ in range(3)] == [200, 200, 429]
+    assert login('203.0.113.2') == 200
+
+def test_login_turned_away_when_hashing_saturated(client, monkeypatch):
+    """Test admission control when the hashing pool has no free slots"""
+    client.post('/register', data={'username': 'busy', 'email': 'busy@example.com', 'password': 'pw'})
+    monkeypatch.setattr(app_module, 'auth_pool', app_module.HashingPool(workers=1, queue=0))
+    app_module.auth_pool._slots.acquire()
+    response = client.post('/login', data={'username': 'busy', 'password': 'pw'})
+    assert response.status_code == 503
+    assert app_module.auth_pool.rejected == 1
+
+def test_hash_timeout_is_busy_and_keeps_its_slot(client, monkeypatch):
+    """Test that a hash outliving the timeout answers 503 and holds its slot until it ends"""
+    import threading
+    client.post('/register', data={'username': 'slow', 'email': 'slow@example.com', 'password': 'pw'})
+    pool = app_module.HashingPool(workers=1, queue=0, timeout=0.05)
+    monkeypatch.setattr(app_module, 'auth_pool', pool)
+    release = threading.Event()
+    monkeypatch.setattr(app_module, 'check_password_hash', lambda *args: release.wait(5))
+
+    assert client.post('/login', data={'username': 'slow', 'password': 'pw'}).status_code == 503
+    assert pool.timed_out == 1
+    assert client.post('/login', data={'username': 'slow', 'password': 'pw'}).status_code == 503
+    assert pool.rejected == 1
+
+    release.set()
+    pool._get_executor().submit(lambda: None).result(timeout=5)
+    assert pool._slots.acquire(blocking=False)
+    pool._slots.release()
+
+def test_login_rehashes_outdated_password(client, monkeypatch):
+    """Test transparent rehash when the cost profile changes"""
+    monkeypatch.setattr(app_module, 'AUTH_HASH_PROFILE', 'low')
+    client.post('/register', data={'username': 'old', 'email': 'old@example.com', 'password': 'pw'})
+    monkeypatch.setattr(app_module, 'AUTH_HASH_PROFILE', 'interactive')
+
+    response = client.post('/login', data={'username': 'old', 'password': 'pw'})
+    assert response.status_code == 302
+    conn = app_module.get_db_connection()
+    stored = conn.execute("SELECT password_hash FROM users WHERE username = 'old'").fetchone()[0]
+    conn.close()
+    assert stored.startswith('pbkdf2:sha256:600000$')
+    assert not app_module.needs_rehash(stored)
+
+def test_login_succeeds_when_rehash_is_busy(client, monkeypatch):
+    """Test that a skipped rehash does not fail a login with the right password"""
+    monkeypatch.setattr(app_module, 'AUTH_HASH_PROFILE', 'low')
+    client.post('/register', data={'username': 'old', 'email': 'old@example.com', 'password': 'pw'})
+    monkeypatch.setattr(app_module, 'AUTH_HASH_PROFILE', 'interactive')
+
+    def busy(password):
+        raise app_module.AuthBusyError()
+    monkeypatch.setattr(app_module, 'hash_password', busy)
+    response = client.post('/login', data={'username': 'old', 'password': 'pw'})
+    assert response.status_code == 302
+    conn = app_module.get_db_connection()
+    stored = conn.execute("SELECT password_hash FROM users WHERE username = 'old'").fetchone()[0]
+    conn.close()
+    assert app_module.needs_rehash(stored)
+
+def asgi_request(method, path, query=b'', body=b'', headers=()):
+    """Drive the ASGI entry point for one request, return (status, headers, body chunks)"""
+    import asyncio
+    import asgi
+
+    incoming = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        await asyncio.Event().wait()  # the client stays connected until the response is done
+
+    async def send(message):
+        sent.append(message)
+
+    headers = [*headers, ('content-length', str(len(body)))]
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(name.encode(), value.encode()) for name, value in headers],
+             'client': ('127.0.0.1', 50000), 'server': ('testserver', 80), 'scheme': 'http'}
+    asyncio.run(asgi.application(scope, receive, send))
+    start = sent[0]
+    assert start['type'] == 'http.response.start'
+    assert sent[-1] == {'type': 'http.response.body', 'body': b'', 'more_body': False}
+    return start['status'], dict(start['headers']), [m['body'] for m in sent[1:] if m['body']]
+
+def test_asgi_serves_routes(client):
+    """Test that the ASGI entry point answers the same routes as the WSGI app"""
+    status, headers, chunks = asgi_request('GET', '/health')
+    assert status == 200
+    assert json.loads(b''.join(chunks))['status'] == 'healthy'
+
+    status, headers, chunks = asgi_request('GET', '/products', query=b'search=laptop')
+    assert status == 200
+    assert b'Laptop' in b''.join(chunks)
+
+def test_asgi_form_post(client):
+    """Test that request bodies reach the route through the ASGI bridge"""
+    status, headers, _ = asgi_request(
+        'POST', '/register', body=b'username=asgi&email=asgi%40example.com&password=pw',
+        headers=[('content-type', 'application/x-www-form-urlencoded')])
+    assert status == 302
+    assert headers[b'location'] == b'/login'
+
+def test_asgi_streams_in_chunks(client, monkeypatch):
+    """Test that streamed responses are forwarded as several body messages"""
+    import asgi
+    monkeypatch.setattr(asgi, 'ASGI_CHUNK_SIZE', 1)
+    status, headers, chunks = asgi_request('GET', '/api/v2/products', query=b'format=ndjson')
+    assert status == 200
+    assert headers[b'content-type'] == b'application/x-ndjson'
+    assert len(chunks) == 5
+    assert json.loads(chunks[0])['name'] == 'Laptop'
+
+@pytest.mark.parametrize('disconnect', ['send-error', 'http.disconnect'])
+def test_asgi_client_disconnect_stops_route_thread(client, monkeypatch, disconnect):
+    """Test that a client leaving mid-stream releases the route thread and closes the body"""
+    import asyncio
+    import threading
+    import asgi
+    monkeypatch.setattr(asgi, 'ASGI_CHUNK_SIZE', 1)
+    monkeypatch.setattr(asgi, 'ASGI_STREAM_BUFFER', 1)
+    closed = threading.Event()
+
+    def endless(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        try:
+            while True:
+                yield b'x'
+        finally:
+            closed.set()
+
+    bridge = asgi.WSGIBridge(endless, threads=1)
+    scope = {'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': []}
+
+    async def run():
+        gone = asyncio.Event()
+        incoming = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if incoming:
+                return incoming.pop(0)
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if len(sent) == 3:
+                if disconnect == 'send-error':
+                    raise OSError('connection reset')
+                gone.set()
+
+        try:
+            await asyncio.wait_for(bridge(scope, receive, send), timeout=5)
+        except OSError:
+            assert disconnect == 'send-error'
+
+    asyncio.run(run())
+    assert closed.wait(5)
+    # The only pool thread is free again
+    assert bridge.executor.submit(lambda: 'free').result(timeout=5) == 'free'
+
+@pytest.fixture
+def built_assets(tmp_path, monkeypatch):
+    """Build the static assets into a temporary dist directory"""
+    monkeypatch.setattr(app_module, 'ASSET_DIST_DIR', str(tmp_path))
+    manifest = app_module.build_assets(output=str(tmp_path))
+    yield manifest
+    app_module.asset_manifest.cache_clear()
+    app_module.asset_files.cache_clear()
+
+def test_build_assets_fingerprints_and_precompresses(client, built_assets, tmp_path):
+    """Test that assets get content-hashed names, compressed variants and template URLs"""
+    import gzip
+    hashed = built_assets['css/style.css']
+    assert hashed.startswith('css/style.') and hashed.endswith('.css') and hashed != 'css/style.css'
+    original = open(os.path.join(app_module.app.static_folder, 'css', 'style.css'), 'rb').read()
+    assert gzip.decompress((tmp_path / (hashed + '.gz')).read_bytes()) == original
+    assert json.loads((tmp_path / 'manifest.json').read_text()) == built_assets
+
+    response = client.get('/login')
+    assert f'/static/dist/{hashed}'.encode() in response.data
+    assert f"/static/dist/{built_assets['js/main.js']}".encode() in response.data
+
+def test_static_middleware_negotiates_encoding(client, built_assets):
+    """Test that built assets are served immutable in the best accepted encoding"""
+    url = f"/static/dist/{built_assets['js/main.js']}"
+    response = client.get(url, headers={'Accept-Encoding': 'gzip, br'})
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == app_module.ASSET_CACHE_CONTROL
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert response.headers['Content-Encoding'] == ('br' if app_module.brotli else 'gzip')
+
+    response = client.get(url, headers={'Accept-Encoding': 'br;q=0, gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+    response = client.get(url)
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == open(os.path.join(app_module.app.static_folder, 'js', 'main.js'), 'rb').read()
+
+    assert client.head(url).data == b''
+    assert client.get('/static/dist/js/main.0123456789ab.js').status_code == 404
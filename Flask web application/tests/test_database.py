@@ -2,6 +2,7 @@ import pytest
 import sqlite3
 import tempfile
 import os
+import time
 import app as app_module
 
 @pytest.fixture
@@ -20,6 +21,7 @@ def db_connection():
     try:
         # Create tables using the init_db function
         app_module.init_db()
+        app_module.catalog_cache.clear()
         
         # Return a fresh connection to the test database
         conn.close()
@@ -30,6 +32,8 @@ def db_connection():
         
     finally:
         conn.close()
+        app_module.close_db_pools()
+        app_module.catalog_cache.clear()
         app_module.DATABASE = original_database
         os.close(db_fd)
         os.unlink(db_path)
@@ -233,3 +237,404 @@ def test_order_creation():
         conn.close()
         os.close(db_fd)
         os.unlink(db_path)
+
+def test_connection_pool_reuses_connections(db_connection):
+    """Test that closed handles go back to the pool and are reused"""
+    pool = app_module.get_pool()
+    first = app_module.get_db_connection()
+    raw = first._conn
+    first.close()
+    assert first.closed
+
+    second = app_module.get_db_connection()
+    assert second._conn is raw
+    assert second.execute('SELECT COUNT(*) FROM products').fetchone()[0] >= 5
+    second.close()
+
+    stats = pool.stats()
+    assert stats['reused'] >= 1
+    assert stats['in_use'] == 0
+    assert stats['idle'] <= stats['size']
+
+def test_connection_pool_rolls_back_on_release(db_connection):
+    """Test that uncommitted work is discarded when a handle is released"""
+    conn = app_module.get_db_connection()
+    conn.execute("INSERT INTO products (name, price) VALUES ('Uncommitted', 1.0)")
+    conn.close()
+
+    count = db_connection.execute(
+        "SELECT COUNT(*) AS count FROM products WHERE name = 'Uncommitted'"
+    ).fetchone()
+    assert count['count'] == 0
+
+def test_connection_pool_respects_size(db_connection):
+    """Test that the pool never keeps more idle connections than its size"""
+    pool = app_module.ConnectionPool(app_module.DATABASE, size=2, health_check_interval=0)
+    handles = [pool.acquire() for _ in range(4)]
+    assert pool.stats()['in_use'] == 4
+    for handle in handles:
+        handle.close()
+
+    stats = pool.stats()
+    assert stats['idle'] == 2
+    assert stats['discarded'] == 2
+    pool.close()
+
+def test_tuning_profile_enables_wal(db_connection):
+    """Test that the default tuning profile switches the database to WAL"""
+    conn = app_module.get_db_connection()
+    try:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+    finally:
+        conn.close()
+
+def test_unknown_tuning_profile():
+    """Test that a misspelled profile name fails loudly"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        with pytest.raises(ValueError):
+            app_module.apply_tuning_profile(conn, 'turbo')
+    finally:
+        conn.close()
+
+def test_db_write_rolls_back_on_error(db_connection):
+    """Test that a failing write leaves no partial rows behind"""
+    def failing_write(conn):
+        conn.execute("INSERT INTO products (name, price) VALUES ('Partial', 1.0)")
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        app_module.db_write(failing_write)
+
+    count = db_connection.execute(
+        "SELECT COUNT(*) AS count FROM products WHERE name = 'Partial'"
+    ).fetchone()
+    assert count['count'] == 0
+
+def test_db_write_retries_when_busy(db_connection, monkeypatch):
+    """Test that busy errors are retried and other errors are not"""
+    monkeypatch.setattr(app_module, 'DB_WRITE_RETRY_DELAY', 0)
+    attempts = []
+
+    def flaky_write(conn):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise sqlite3.OperationalError('database is locked')
+        return conn.execute("INSERT INTO products (name, price) VALUES ('Retried', 1.0)").lastrowid
+
+    assert app_module.db_write(flaky_write) is not None
+    assert len(attempts) == 3
+
+    with pytest.raises(sqlite3.OperationalError):
+        app_module.db_write(lambda conn: conn.execute('SELECT * FROM missing_table'))
+
+def test_migrations_record_schema_version(db_connection):
+    """Test that init_db applies every migration and records the version"""
+    latest = app_module.MIGRATIONS[-1][0]
+    assert app_module.get_schema_version(db_connection) == latest
+
+    indexes = {row['name'] for row in db_connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"
+    ).fetchall()}
+    assert {'idx_orders_user_created', 'idx_products_category', 'idx_order_items_order'} <= indexes
+
+def test_migrations_are_idempotent(db_connection):
+    """Test that re-running init_db neither fails nor duplicates the sample catalog"""
+    before = db_connection.execute('SELECT COUNT(*) AS count FROM products').fetchone()['count']
+    app_module.init_db()
+    after = db_connection.execute('SELECT COUNT(*) AS count FROM products').fetchone()['count']
+    assert before == after
+
+def test_import_does_not_touch_database(tmp_path):
+    """Test that importing the app module opens no database"""
+    import subprocess
+    import sys
+    db_path = tmp_path / 'untouched.db'
+    subprocess.run([sys.executable, '-c', 'import app'], check=True,
+                   cwd=os.path.dirname(os.path.abspath(app_module.__file__)),
+                   env={**os.environ, 'DATABASE': str(db_path), 'CATALOG_CACHE_BACKEND': 'local'})
+    assert not db_path.exists()
+
+def test_create_app_migrates_once(tmp_path, monkeypatch):
+    """Test that create_app migrates a new database once and is a no-op afterwards"""
+    monkeypatch.setattr(app_module, 'DATABASE', str(tmp_path / 'startup.db'))
+    monkeypatch.setitem(app_module._startup, 'done', False)
+    try:
+        assert app_module.create_app() is app_module.app
+        conn = app_module.get_db_connection()
+        assert app_module.get_schema_version(conn) == app_module.MIGRATIONS[-1][0]
+        conn.close()
+        assert not app_module.init_db_if_needed()
+
+        calls = []
+        monkeypatch.setattr(app_module, 'init_db_if_needed', lambda: calls.append(1))
+        app_module.create_app()
+        assert calls == []
+    finally:
+        app_module.close_db_pools()
+        app_module.catalog_cache.clear()
+
+def test_create_app_without_auto_migrate(tmp_path, monkeypatch):
+    """Test that AUTO_MIGRATE=false leaves schema setup to `flask migrate`"""
+    db_path = tmp_path / 'deploy.db'
+    monkeypatch.setattr(app_module, 'DATABASE', str(db_path))
+    monkeypatch.setitem(app_module._startup, 'done', False)
+    app_module.create_app(auto_migrate=False)
+    assert not db_path.exists()
+
+def test_order_history_uses_index(db_connection):
+    """Test that the order history query is served by the composite index"""
+    plan = db_connection.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC', (1,)
+    ).fetchall()
+    detail = ' '.join(row['detail'] for row in plan)
+    assert 'idx_orders_user_created' in detail
+    assert 'TEMP B-TREE' not in detail
+
+def test_search_index_tracks_product_changes(db_connection):
+    """Test that the search index follows inserts, updates and deletes"""
+    def search(text):
+        conn = app_module.get_db_connection()
+        try:
+            return [row['name'] for row in app_module.search_products(conn, text)[0]]
+        finally:
+            conn.close()
+
+    db_connection.execute("INSERT INTO products (name, description, price) VALUES ('Kettle', 'Electric kettle', 39.0)")
+    db_connection.commit()
+    assert search('kett') == ['Kettle']
+
+    db_connection.execute("UPDATE products SET name = 'Teapot' WHERE name = 'Kettle'")
+    db_connection.commit()
+    assert search('teapot') == ['Teapot']
+
+    db_connection.execute("DELETE FROM products WHERE name = 'Teapot'")
+    db_connection.commit()
+    assert search('teapot') == []
+    assert app_module.rebuild_search_index() >= 5
+
+def test_search_ranks_name_matches_first(db_connection):
+    """Test that bm25 ranking favours products whose name matches"""
+    db_connection.execute(
+        "INSERT INTO products (name, description, price) VALUES ('Bag', 'Fits a laptop and a charger', 49.0)"
+    )
+    db_connection.commit()
+    conn = app_module.get_db_connection()
+    try:
+        results, _ = app_module.search_products(conn, 'laptop')
+    finally:
+        conn.close()
+    assert [row['name'] for row in results] == ['Laptop', 'Bag']
+
+def test_import_products_upserts_by_sku(db_connection):
+    """Test that bulk import inserts, updates by SKU, rejects bad records and rebuilds deferred indexes"""
+    import io
+    indexes_before = db_connection.execute(
+        "SELECT name FROM sqlite_master WHERE tbl_name = 'products' ORDER BY name").fetchall()
+    csv_text = (
+        'sku,name,description,price,stock,category\n'
+        'SKU-000001,Laptop Pro,Refreshed laptop,1099.5,7,Electronics\n'
+        'NEW-1,Desk Lamp,Brass reading lamp,45,12,Home\n'
+        'NEW-2,,Nameless,1,1,Home\n'
+        'NEW-3,Broken,Bad price,abc,1,Home\n'
+    )
+    records = app_module.read_product_records(io.StringIO(csv_text), 'csv')
+    report = app_module.import_products(records, chunk_size=1, defer_indexes=True)
+
+    assert report['rows'] == 2
+    assert report['rejected'] == 2
+    assert report['errors'][0].startswith('record 3:')
+    laptop = db_connection.execute("SELECT * FROM products WHERE sku = 'SKU-000001'").fetchone()
+    assert (laptop['id'], laptop['name'], laptop['price'], laptop['stock']) == (1, 'Laptop Pro', 1099.5, 7)
+    assert db_connection.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 6
+    # The category index and search triggers are back, and search sees the imported names
+    assert db_connection.execute(
+        "SELECT name FROM sqlite_master WHERE tbl_name = 'products' ORDER BY name").fetchall() == indexes_before
+    conn = app_module.get_db_connection()
+    try:
+        rows, _ = app_module.search_products(conn, 'lamp')
+    finally:
+        conn.close()
+    assert [row['sku'] for row in rows] == ['NEW-1']
+
+def test_export_products_round_trips(db_connection):
+    """Test that an NDJSON export re-imports without changing the catalog"""
+    import io
+    import json
+    exported = ''.join(app_module.export_products('ndjson'))
+    lines = [json.loads(line) for line in exported.splitlines()]
+    assert len(lines) == 5
+    assert set(lines[0]) == set(app_module.CATALOG_FIELDS)
+    before = db_connection.execute('SELECT * FROM products ORDER BY id').fetchall()
+    report = app_module.import_products(app_module.read_product_records(io.StringIO(exported), 'ndjson'))
+    assert report['rows'] == 5
+    assert db_connection.execute('SELECT * FROM products ORDER BY id').fetchall() == before
+    csv_lines = ''.join(app_module.export_products('csv')).splitlines()
+    assert csv_lines[0] == ','.join(app_module.CATALOG_FIELDS)
+    assert len(csv_lines) == 6
+
+def test_postgres_sql_translation():
+    """Test that placeholders and SQLite column types are rewritten for PostgreSQL"""
+    assert app_module.postgres_sql("SELECT * FROM t WHERE a = ? AND b LIKE '50%?'") == \
+        "SELECT * FROM t WHERE a = %s AND b LIKE '50%%?'"
+    create = app_module.postgres_sql('CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, price REAL) WITHOUT ROWID')
+    assert create == 'CREATE TABLE t (id SERIAL PRIMARY KEY, price DOUBLE PRECISION) '
+    assert app_module.database_from_url('sqlite:////data/shop.db') == '/data/shop.db'
+    assert app_module.is_postgres('postgresql://shop@db/shop')
+    assert not app_module.is_postgres('shop.db')
+
+def test_schema_search_and_import_on_each_backend(database, monkeypatch):
+    """Test that migrations, ranked search and SKU upserts behave the same on every backend"""
+    import io
+    monkeypatch.setattr(app_module, 'DATABASE', database)
+    try:
+        app_module.init_db()
+        app_module.init_db()
+        conn = app_module.get_db_connection()
+        try:
+            assert app_module.get_schema_version(conn) == app_module.MIGRATIONS[-1][0]
+            assert conn.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 5
+        finally:
+            conn.close()
+
+        csv_text = 'sku,name,description,price,stock\nNEW-1,Bag,Fits a laptop and a charger,49,3\n'
+        report = app_module.import_products(app_module.read_product_records(io.StringIO(csv_text), 'csv'),
+                                            defer_indexes=True)
+        assert report['rows'] == 1
+        conn = app_module.get_db_connection()
+        try:
+            results, _ = app_module.search_products(conn, 'lapt')
+        finally:
+            conn.close()
+        assert [row['name'] for row in results] == ['Laptop', 'Bag']
+    finally:
+        app_module.close_db_pools()
+        app_module.catalog_cache.clear()
+
+def test_catalog_reads_go_to_replicas(db_connection, tmp_path, monkeypatch):
+    """Test that cached catalog reads use a replica while other reads and writes stay on the primary"""
+    replica = str(tmp_path / 'replica.db')
+    backup = sqlite3.connect(replica)
+    db_connection.backup(backup)
+    backup.execute("UPDATE products SET name = 'Replica Laptop' WHERE id = 1")
+    backup.commit()
+    backup.close()
+    monkeypatch.setattr(app_module, 'DATABASE_REPLICAS', [replica])
+
+    assert app_module.get_product(1)['name'] == 'Replica Laptop'
+    conn = app_module.get_db_connection()
+    try:
+        assert conn.execute('SELECT name FROM products WHERE id = 1').fetchone()[0] == 'Laptop'
+    finally:
+        conn.close()
+
+def test_catalog_reloads_after_a_change_use_the_primary(db_connection, tmp_path, monkeypatch):
+    """Test that a lagging replica cannot cache stale or missing rows right after an invalidation"""
+    replica = str(tmp_path / 'replica.db')
+    backup = sqlite3.connect(replica)
+    db_connection.backup(backup)
+    backup.close()
+    monkeypatch.setattr(app_module, 'DATABASE_REPLICAS', [replica])
+    db_connection.execute("INSERT INTO products (name, price, stock, category) VALUES ('New', 5, 1, 'Home')")
+    db_connection.execute('UPDATE products SET stock = 3 WHERE id = 2')
+    db_connection.commit()
+
+    app_module.invalidate_catalog()
+    assert app_module.get_product(6)['name'] == 'New'
+    app_module.get_product(2)
+    app_module.invalidate_stock([2])
+    assert app_module.get_product(2)['stock'] == 3
+
+    # Once the lag window has passed, reloads go back to the replica
+    app_module.invalidate_catalog()
+    now = app_module.time.monotonic()
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: now + app_module.REPLICA_MAX_LAG + 1)
+    assert app_module.get_product(6) is None
+
+def test_local_cache_lru_and_ttl(monkeypatch):
+    """Test LRU eviction and TTL expiry of the in-process cache"""
+    backend = app_module.LocalCacheBackend(max_entries=2)
+    backend.set('a', 1, ttl=60)
+    backend.set('b', 2, ttl=60)
+    backend.get('a')
+    backend.set('c', 3, ttl=60)
+    assert backend.get('b') is None  # least recently used
+    assert backend.get('a') == 1
+    assert backend.evictions == 1
+
+    now = app_module.time.monotonic()
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: now + 120)
+    assert backend.get('a') is None
+
+def test_catalog_cache_hit_rate_and_invalidation():
+    """Test read-through caching, hit-rate metrics and generation invalidation"""
+    cache = app_module.CatalogCache(app_module.LocalCacheBackend())
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return ['row']
+
+    assert cache.get_or_load('k', loader) == ['row']
+    assert cache.get_or_load('k', loader) == ['row']
+    assert len(loads) == 1
+    assert cache.stats()['hit_rate'] == 0.5
+
+    cache.invalidate()
+    cache.get_or_load('k', loader)
+    assert len(loads) == 2
+
+def test_sqlite_cache_is_shared_between_instances(tmp_path):
+    """Test that two workers' caches see each other's entries and invalidations"""
+    path = str(tmp_path / 'cache.db')
+    first = app_module.CatalogCache(app_module.SQLiteCacheBackend(path))
+    second = app_module.CatalogCache(app_module.SQLiteCacheBackend(path))
+
+    first.get_or_load('products', lambda: [{'id': 1}])
+    assert second.get_or_load('products', lambda: pytest.fail('should be a hit')) == [{'id': 1}]
+
+    second.invalidate()
+    assert first.get_or_load('products', lambda: [{'id': 2}]) == [{'id': 2}]
+
+def test_unknown_cache_backend():
+    """Test that a misspelled backend name fails loudly"""
+    with pytest.raises(ValueError):
+        app_module.create_catalog_cache('memcache')
+    assert not app_module.create_catalog_cache('none').enabled
+
+@pytest.mark.parametrize('store_name', ['memory', 'sqlite', 'cache'])
+def test_cart_stores(db_connection, store_name, tmp_path, monkeypatch):
+    """Test add/remove/clear and expiry for every cart store"""
+    monkeypatch.setattr(app_module, 'CATALOG_CACHE_PATH', str(tmp_path / 'cache.db'))
+    store = app_module.create_cart_store(store_name)
+    assert store.add('c1', 1) == 1
+    assert store.add('c1', 1, 2) == 1
+    assert store.add('c1', 3) == 2
+    assert store.get('c1') == {1: 3, 3: 1}
+    assert store.remove('c1', 1) == 1
+    assert store.get('c1') == {3: 1}
+    store.clear('c1')
+    assert store.get('c1') == {}
+
+    store.add('c2', 1)
+    now = time.time()
+    monkeypatch.setattr(app_module.time, 'time', lambda: now + app_module.CART_TTL + 1)
+    assert store.get('c2') == {}
+    store.purge_expired()
+    monkeypatch.setattr(app_module.time, 'time', lambda: now)
+    if store_name != 'cache':
+        assert store.get('c2') == {}
+
+def test_unknown_cart_store():
+    """Test that a misspelled store name fails loudly"""
+    with pytest.raises(ValueError):
+        app_module.create_cart_store('redis')
+
+def test_price_lines_skips_missing_products():
+    """Test one-pass pricing against an id index"""
+    products = {1: {'id': 1, 'price': 0.1}, 2: {'id': 2, 'price': 0.2}}
+    quote = app_module.price_lines({1: 3, 2: 1, 99: 1}, products)
+    assert quote['total'] == app_module.Decimal('0.50')  # not 0.5000000000000001
+    assert quote['missing'] == [99]
+    assert [item['quantity'] for item in quote['items']] == [3, 1]